@@ -1,41 +1,52 @@
 #!/usr/bin/python
 import os
 import sys
+from functools import partial
 from subprocess import check_call, call, PIPE, STDOUT
 from time import localtime, strftime
 import config
 from config import logger
+import annotation_index
+import bam
+import classifier
+import expression_index
+import ingest
+import metrics
+import model_store
+import sharding
+import pipeline
+import tags
 
 SRCDIR = config.WORKER_SOURCE_PATH
+MAPPING_LOCI_BASENAME = "mapping_loci"
 
 # for HTML generation
 import csv
-from mako.template import Template
-from mako.lookup import TemplateLookup
+import templating
 
 
 def render_template(template_name, **kwargs):
     """
     Custom rendering function that uses the Mako template engine (instead of Flask-default Jinja2)
     """
-    mako_lookup = TemplateLookup(directories=[config.WORKER_TEMPLATES_PATH])
-    mytemplate = Template(filename=config.WORKER_TEMPLATES_PATH + template_name + ".mako.html", lookup=mako_lookup)
-    return mytemplate.render(WEBPATH=config.WEB_URL, phase=2, **kwargs)
+    return templating.render(config.WORKER_TEMPLATES_PATH, template_name, WEBPATH=config.WEB_URL, phase=2, **kwargs)
 
 
 def create_expression_table_HTML(
     rundir,
     table_file="",
     template_file="result_expression_table",
-    html_prefix="ncRNA_table_",
+    table="ncRNA",
     sort_key=lambda n: n[4],
     reverse=True,
 ):
     """
-    Create a dict containing, for each ncRNA type, lists of file rows
+    Create a dict containing, for each ncRNA type, lists of file rows. The rows are
+    indexed for the table API (see expression_index.py); the HTML page of each type
+    shows the first page, further pages are fetched by the browser.
     """
     ncrna_expression = {}
-    ncrna_expression_file = csv.reader(open(rundir + table_file, "rU"), delimiter="\t")
+    ncrna_expression_file = csv.reader(open(rundir + table_file, newline=""), delimiter="\t")
     for row in ncrna_expression_file:
         ncrna_type = row[6]
         if ncrna_type in ncrna_expression:
@@ -47,12 +58,20 @@ def create_expression_table_HTML(
     for ncrna_type in list(ncrna_expression.keys()):
         ncrna_expression[ncrna_type] = sorted(ncrna_expression[ncrna_type], key=sort_key, reverse=reverse)
 
-    # Render HTML file
+    # Index and render HTML file
+    job_hash = os.path.basename(os.path.normpath(rundir))
     for ncrna_type in list(ncrna_expression.keys()):
-        with open(rundir + html_prefix + ncrna_type + ".html", "w") as f:
+        expression_index.write_table(rundir, table, ncrna_type, ncrna_expression[ncrna_type])
+        with open(rundir + table + "_table_" + ncrna_type + ".html", "w") as f:
             f.write(
                 render_template(
-                    template_file, ncrna_expression=ncrna_expression[ncrna_type], ncrna_type=ncrna_type, rundir=rundir
+                    template_file,
+                    ncrna_expression=ncrna_expression[ncrna_type][: config.TABLE_PAGE_SIZE],
+                    ncrna_type=ncrna_type,
+                    rundir=rundir,
+                    total=len(ncrna_expression[ncrna_type]),
+                    page_size=config.TABLE_PAGE_SIZE,
+                    api_url=f"{config.WEB_URL}api/result/{job_hash}/{table}/{ncrna_type}",
                 )
             )
 
@@ -80,9 +99,13 @@ def sort_ncrna_records(seq, order_list):
 def get_classifier_statistics(statfile="my.modelstat"):
     """Parse classifier information out of my.modelstat"""
     lines = [line.strip() for line in open(statfile)]
+    stored_model = [line.split(": ")[1] for line in lines if line.startswith("# model reused from the model store")]
 
-    # Remove anything before cross validation
-    lines = lines[lines.index("=== Stratified cross-validation ===") :]
+    # Remove anything before cross validation, or the evaluation of a stored model
+    if "=== %s ===" % classifier.STORED_MODEL_EVALUATION in lines:
+        lines = lines[lines.index("=== %s ===" % classifier.STORED_MODEL_EVALUATION) :]
+    else:
+        lines = lines[lines.index("=== Stratified cross-validation ===") :]
 
     # Now parse textfile 'dirty'
     matrix_idx = lines.index("=== Confusion Matrix ===") + 3
@@ -93,14 +116,19 @@ def get_classifier_statistics(statfile="my.modelstat"):
         line_split = lines[matrix_idx + k].split()
         confusion_matrix.append(line_split[0:ncrna_count])
         ncrna_classes.append(line_split[-1])
-    return {"ncrna_count": ncrna_count, "ncrna_classes": ncrna_classes, "confusion_matrix": confusion_matrix}
+    return {
+        "ncrna_count": ncrna_count,
+        "ncrna_classes": ncrna_classes,
+        "confusion_matrix": confusion_matrix,
+        "stored_model": stored_model[0] if stored_model else None,
+    }
 
 
 def create_main_HTML(rundir, job_infos):
     """Creates Result HTML"""
     # Get data needed for the template
     analysis_infos = {}
-    info_file = csv.reader(open(rundir + "upload.info", "rU"), delimiter=":")
+    info_file = csv.reader(open(rundir + "upload.info", newline=""), delimiter=":")
     for row in info_file:
         if len(row) > 1:
             analysis_infos[row[0]] = row[2].strip()
@@ -109,7 +137,7 @@ def create_main_HTML(rundir, job_infos):
 
     # Create list containg class, #genes, reads and expression for each ncRNA class
     reads_infos = {}
-    reads_file = csv.reader(open(rundir + "reads.info", "rU"), delimiter=":")
+    reads_file = csv.reader(open(rundir + "reads.info", newline=""), delimiter=":")
     for row in reads_file:
         if len(row) > 1:
             reads_infos[row[0]] = [row[3].strip(), row[4].strip()]
@@ -126,7 +154,7 @@ def create_main_HTML(rundir, job_infos):
     # Fetch data for predictions
     if job_infos["prediction_succesful"] == "1":
         predictions = create_expression_table_HTML(
-            rundir, "predictions.expression.bed", "result_predictions_table", "predictions_table_"
+            rundir, "predictions.expression.bed", "result_predictions_table", "predictions"
         )
         analysis_infos["predictions"] = [[k, genes, 0, 0] for k, genes in list(predictions.items())]
         sort_ncrna_records(analysis_infos["predictions"], ["miRNA", "snoRNA_CD", "snoRNA_HACA", "tRNA"])
@@ -142,7 +170,7 @@ def create_main_HTML(rundir, job_infos):
         user_annotation = create_expression_table_HTML(
             rundir,
             "user_annotation.expression.bed",
-            html_prefix="user_annotation_table_",
+            table="user_annotation",
             sort_key=lambda n: n[0] + "a" + n[1],
             reverse=False,
         )
@@ -161,225 +189,99 @@ def create_error_HTML(rundir, job_infos, error_msg="", error_pre=""):
         )
 
 
-def try_to_extract_uploaded_file(filename, target_file_basename, original_filename, rundir, stderr):
-    """Tries to decompress uploaded file"""
-    # Save a zipped copy of origignal filename (may get removed later)
-    check_call("gzip -c " + rundir + filename + " >" + rundir + filename + ".gz", shell=True, stderr=stderr)
+class AnalysisError(Exception):
+    """Failure of an analysis step, with the message (and details) shown to the user"""
 
-    # Extract
-    supported_archives = (".zip", ".gz", ".tar.gz")
-    if original_filename.lower().endswith(supported_archives):  # if archive
-        logger.info("Trying to extract " + original_filename)
-        check_call(
-            ["/bin/bash", SRCDIR + "analysis/extract.sh", rundir, filename, original_filename, target_file_basename],
-            stderr=stderr,
-        )
-    else:  # not an archive -> just copy uploaded file to target name + original file suffix
-        logger.info("Copying file" + original_filename)
-        original_filename_suffix = os.path.splitext(original_filename)[1].lower()  # get file extension
-        check_call(["cp", rundir + filename, rundir + target_file_basename + original_filename_suffix])
+    def __init__(self, message, details=""):
+        Exception.__init__(self, message)
+        self.message = message
+        self.details = details
 
-    # remove (potentially uncompressed) original to save space (unchecked, might be removed by gunzip earlier)
-    call(["rm", rundir + filename], stderr=stderr)
 
+def read_log(job, filename, separator="\n"):
+    """Return the stripped lines of a log file of the job, joined by separator"""
+    job["stderr"].flush()
+    job["runlog"].flush()
+    return separator.join([line.strip() for line in open(job["rundir"] + filename)])
 
-def analyze(rundir):
-    """Main driver script"""
-    if not rundir.endswith("/"):  # for robustness, add "/"
-        rundir = rundir + "/"
-
-    # Setup error log file
-    stderr = open(rundir + config.STDERR_FILENAME, "aw")
-    runlog_file = open(rundir + config.RUNLOG_FILENAME, "aw")
 
-    job_infos = {}
-    info_file = csv.reader(open(rundir + config.PARAMS_FILENAME, "rU"), delimiter="\t")
-    for row in info_file:
-        if len(row) > 1:
-            job_infos[row[0]] = row[1].strip()
-
-    job_infos["job_start_time"] = strftime("%Y-%m-%d %H:%M:%S", localtime())
-
-    # ------------------------------------------------------------------------------------------
-    # STEP 1: Make sure BED or BAM file is present. Extract compressed archive, if necessary
-    # ------------------------------------------------------------------------------------------
-    mapping_loci_basename = "mapping_loci"
+def extract_mapping_loci(job):
+    """Steps 1 and 3: make sure a BED or BAM file is present (extract archives)"""
+    rundir, job_infos = job["rundir"], job["job_infos"]
     try:
-        try_to_extract_uploaded_file(
-            "mapping_loci.upload", mapping_loci_basename, job_infos["filename"], rundir, stderr
-        )
-
-        if os.path.exists(rundir + mapping_loci_basename + ".bed"):
-            job_infos["mapping_loci_filetype"] = "bed"
-        elif os.path.exists(rundir + mapping_loci_basename + ".bam"):
-            job_infos["mapping_loci_filetype"] = "bam"
-        else:
-            raise IOError("No bam/bed file found")
-
+        job["mapping_loci_file"] = ingest.unpack(rundir, MAPPING_LOCI_BASENAME)
+        job_infos["mapping_loci_filetype"] = os.path.splitext(job["mapping_loci_file"])[1][1:]
         logger.info(job_infos["mapping_loci_filetype"] + " file found.")
     except:
-        stderr.close()
-        stderr_text = "\n".join([line.strip() for line in open(rundir + config.STDERR_FILENAME)])
-        create_error_HTML(
-            rundir,
-            job_infos,
+        logger.exception("Upload could not be unpacked")
+        raise AnalysisError(
             "The uploaded file or archive did not contain or contain more than the required BED or BAM file. Ideally, the filename suffix should indicate its type and therefore end with either .bed or .bam.",
-            stderr_text,
+            read_log(job, config.STDERR_FILENAME),
         )
-        return config.RETURN_CODE_ERROR
 
-    # ------------------------------------------------------------------------------------------
-    # STEP 2: Extract user_annotation
-    # ------------------------------------------------------------------------------------------
-    if job_infos["user_annotation"] != "NONE":
-        try:
-            try_to_extract_uploaded_file(
-                "user_annotation.upload", "user_annotation", job_infos["user_annotation"], rundir, stderr
-            )
-            if not os.path.exists(rundir + "user_annotation.bed"):
-                raise IOError("No user_annotation bam/bed file found")
-        except:
-            create_error_HTML(rundir, job_infos, "User annotation could not be extracted")
-            return config.RETURN_CODE_ERROR
 
-    # ------------------------------------------------------------------------------------------
-    # STEP 3: Convert BAM to BED if necessary
-    # ------------------------------------------------------------------------------------------
+def extract_user_annotation(job):
+    """Step 2: extract the user annotation"""
+    rundir = job["rundir"]
+    try:
+        if not ingest.unpack(rundir, "user_annotation").endswith(".bed"):
+            raise IOError("No user_annotation bam/bed file found")
+    except:
+        raise AnalysisError("User annotation could not be extracted")
+
+
+def collapse_tags(job):
+    """Step 4: check integrity of the BED file (BAM files are decoded in-process) and collapse reads to tags"""
+    rundir, job_infos = job["rundir"], job["job_infos"]
+    mapping_loci_filename = job["mapping_loci_file"]
+    outputs = (
+        rundir + "upload.tags",
+        rundir + "upload.info",
+        rundir + "length.out",
+        rundir + "multipleMappings.out",
+    )
     if job_infos["mapping_loci_filetype"] == "bam":
         try:
-            check_call(
-                [
-                    "perl",
-                    SRCDIR + "analysis/map2bed.pl",
-                    "-i",
-                    rundir + mapping_loci_basename + ".bam",
-                    "-f",
-                    "3",
-                    "-o",
-                    rundir + mapping_loci_basename + ".bed",
-                    "-z",
-                ],
-                stdout=runlog_file,
-                stderr=stderr,
+            tags.collapse_records(bam.iter_tag_records(mapping_loci_filename, tmpdir=rundir), *outputs, tmpdir=rundir)
+        except MemoryError:
+            raise AnalysisError(
+                "We currently do not have sufficent memory to process your file in acceptable time. Sorry, we are working on getting better machines!"
             )
+        except Exception as e:
+            logger.exception("BAM file could not be read")
+            raise AnalysisError("BAM file could not be converted properly.", str(e))
+        finally:
+            # Remove BAM files extracted from archives, a BAM upload is kept as the copy of the upload
+            if mapping_loci_filename != ingest.stored_file(rundir, MAPPING_LOCI_BASENAME):
+                call(["rm", "-f", mapping_loci_filename], stderr=job["stderr"])
+        logger.info("Collapsed the reads of the BAM file to tags")
+        return
 
-            # Remove uneeded BAM files
-            check_call(["rm", rundir + mapping_loci_basename + ".bam"], stderr=stderr)
-
-            if not os.path.exists(rundir + mapping_loci_basename + ".bed"):
-                raise IOError("BED file not present")
-        except:
-            stderr.close()
-            stderr_text = "\n".join([line.strip() for line in open(rundir + config.STDERR_FILENAME)])
-            create_error_HTML(rundir, job_infos, "BAM file could not be converted properly.", stderr_text)
-            return config.RETURN_CODE_ERROR
-        logger.info("Converted BAM 2 BED format")
-
-    # ------------------------------------------------------------------------------------------
-    # STEP 4: Check integrity of BED FILE
-    # ------------------------------------------------------------------------------------------
-    mapping_loci_filename = rundir + mapping_loci_basename + ".bed"
     try:
         # ./checkBed.pl -i reads.bed
-        check_call([SRCDIR + "analysis/checkBed.pl", "-i", mapping_loci_filename], stdout=runlog_file, stderr=stderr)
-        # ./readsToTags.pl -i reads.bed -s upload.info -l length.out -m multipleMappings.out -o tags.bed
         check_call(
-            [
-                SRCDIR + "analysis/readsToTags.pl",
-                "-i",
-                mapping_loci_filename,
-                "-s",
-                rundir + "upload.info",
-                "-l",
-                rundir + "length.out",
-                "-m",
-                rundir + "multipleMappings.out",
-                "-o",
-                rundir + "tags.bed",
-            ],
-            stdout=runlog_file,
-            stderr=stderr,
+            [SRCDIR + "analysis/checkBed.pl", "-i", mapping_loci_filename], stdout=job["runlog"], stderr=job["stderr"]
         )
+        tags.collapse_tags(mapping_loci_filename, *outputs, tmpdir=rundir)
     except:
-        stderr.close()
-        runlog_file.close()
-        stderr_text = "<br\>".join([line.strip() for line in open(rundir + config.STDERR_FILENAME)])
-        runlog_text = "\n".join([line.strip() for line in open(rundir + config.RUNLOG_FILENAME)])
-
-        if stderr_text.find("memory") != -1:
-            create_error_HTML(
-                rundir,
-                job_infos,
-                "We currently do not have sufficent memory to process your file in acceptable time. Sorry, we are working on getting better machines!",
-            )
-        else:
-            create_error_HTML(rundir, job_infos, "Your mapping file has invalid file format.", runlog_text)
-        return config.RETURN_CODE_ERROR
+        out_of_memory = isinstance(sys.exc_info()[1], MemoryError)
+        stderr_text = read_log(job, config.STDERR_FILENAME, "<br\>")
+        runlog_text = read_log(job, config.RUNLOG_FILENAME)
 
-    # ------------------------------------------------------------------------------------------
-    # REWRITE DONE UNTIL HERE. @todo: Rename files accordingly in the remaining.
-    # ------------------------------------------------------------------------------------------
+        if out_of_memory or stderr_text.find("memory") != -1:
+            raise AnalysisError(
+                "We currently do not have sufficent memory to process your file in acceptable time. Sorry, we are working on getting better machines!"
+            )
+        raise AnalysisError("Your mapping file has invalid file format.", runlog_text)
 
-    call(["mv", rundir + "tags.bed", rundir + "upload.bed"])  # rename to upload.bed
 
-    # ------------------------------------------------------------------------------------------
-    # STEP 5: Run quantification
-    # ------------------------------------------------------------------------------------------
-    # annotated ncRNAs
-    species = config.SPECIES[job_infos["code"]]
+def quantify_ncrnas(job):
+    """Step 5: quantify annotated ncRNAs, processed in shards of chromosomes"""
+    rundir, species = job["rundir"], job["species"]
     try:
-        check_call(
-            [
-                "Rscript",
-                SRCDIR + "analysis/overlap.R",
-                species["dir"] + "ncRNAs.bed",
-                species["dir"] + "exons.bed",
-                species["dir"] + "introns.bed",
-                rundir + "upload.bed",
-                rundir + "ncRNAs.reads",
-                rundir + "unknown.reads",
-                rundir + "reads.info",
-                rundir,
-            ],
-            stderr=stderr,
-        )
-
-        check_call(
-            [
-                "perl",
-                SRCDIR + "analysis/writeWig.pl",
-                "-i",
-                rundir + "ncRNAs.reads",
-                "-o",
-                rundir,
-                "-p",
-                "ncRNAs.pos.wig",
-                "-n",
-                "ncRNAs.neg.wig",
-            ],
-            stderr=stderr,
-        )
-        check_call(
-            [
-                "perl",
-                SRCDIR + "analysis/getExpression.pl",
-                "-b",
-                rundir + "ncRNAs.reads",
-                "-o",
-                rundir,
-                "-a",
-                species["dir"] + "ncRNAs.bed",
-                "-f",
-                rundir + "ncRNA.expression.bed",
-                "-p",
-                "ncRNAs.pos.wig",
-                "-n",
-                "ncRNAs.neg.wig",
-                "-s",
-                species["id"],
-            ],
-            stderr=stderr,
-        )
+        job["species_index"] = annotation_index.open_index(species)
+        job["shard_dirs"] = sharding.split_reads(rundir + "upload.tags", rundir + "shards/")
+        sharding.quantify_ncrnas(job["shard_dirs"], species, job["species_index"], rundir)
 
         ## do some renaming for arabidopsis
         # if species['id'].startswith("ath"):
@@ -388,182 +290,200 @@ def analyze(rundir):
         #    call("sed 's/=chr/=Chr/' {0}ncRNAs.pos.wig.save | sed '/chloroplast/q' | head -n -1 > {0}ncRNAs.pos.wig".format(rundir), shell=True, stderr = stderr)
         #    call("sed 's/=chr/=Chr/' {0}ncRNAs.neg.wig.save | sed '/chloroplast/q' | head -n -1 > {0}ncRNAs.neg.wig".format(rundir), shell=True, stderr = stderr)
     except:
-        create_error_HTML(rundir, job_infos, "Your reads could not be overlapped with ncRNA annotations.")
-        return config.RETURN_CODE_ERROR
+        raise AnalysisError("Your reads could not be overlapped with ncRNA annotations.")
+
 
-    # ------------------------------------------------------------------------------------------
-    # STEP 6: Run prediction of new candidate ncRNAs
-    # ------------------------------------------------------------------------------------------
+def predict_ncrnas(job):
+    """Step 6: run prediction of new candidate ncRNAs and quantify them"""
+    rundir, species, stderr = job["rundir"], job["species"], job["stderr"]
+    stderr.flush()
+    sharding.cluster_reads(job["shard_dirs"], species, rundir, rundir + config.STDERR_FILENAME)
     try:
-        check_call(
-            ["/bin/bash", SRCDIR + "analysis/runblockbuster.sh", SRCDIR, rundir, species["dir"] + "ncRNAs.bed"],
-            stderr=stderr,
-        )
-        check_call(
-            [
-                "perl",
-                SRCDIR + "analysis/trainClassifier.pl",
-                "-trainSet",
-                rundir + "ncRNAs.clusters.flagged",
-                "-model",
-                rundir + "my.model",
-                "-statistic",
-                rundir + "my.modelstat",
-                "-o",
-                rundir,
-            ],
-            stdout=stderr,
-            stderr=STDOUT,
-        )
-        if not os.path.exists(rundir + "my.model"):
-            check_call(["cp", species["dir"] + "my.model", rundir + "my.model"])
-        check_call(
-            [
-                "perl",
-                SRCDIR + "analysis/runClassifier.pl",
-                "-testSet",
-                rundir + "unknown.clusters",
-                "-model",
-                rundir + "my.model",
-                "-predictions",
-                rundir + "predictions.bed",
-                "-o",
-                rundir,
-            ],
-            stdout=stderr,
-            stderr=STDOUT,
+        stored_model = model_store.train_file(
+            rundir + "ncRNAs.clusters.flagged", rundir + "my.model", rundir + "my.modelstat", species["id"]
         )
+        job["job_infos"]["classifier_model"] = "stored" if stored_model else "trained"
+        if stored_model:
+            job["job_infos"]["classifier_fingerprint"] = stored_model
+            job["runlog"].write("Classifier model reused from the model store, fingerprint: %s\n" % stored_model)
+    except ValueError as e:
+        stderr.write("Classifier not trained, using the model of the species: %s\n" % e)
+    if not os.path.exists(rundir + "my.model"):
+        check_call(["cp", species["dir"] + "my.model", rundir + "my.model"])
+    classifier.predict_file(rundir + "unknown.clusters", rundir + "my.model", rundir + "predictions.bed")
+
+    # Quantify predictions
+    sharding.quantify_annotation(
+        job["shard_dirs"],
+        rundir + "predictions.bed",
+        "unknown.reads",
+        "predictions",
+        rundir,
+        species["id"],
+        job["species_index"].rnaz_markers(),
+    )
+    job["job_infos"]["prediction_succesful"] = "1"
 
-        # Quantify predictions
-        check_call(
-            [
-                "Rscript",
-                SRCDIR + "analysis/overlapPredictions.R",
-                rundir + "predictions.bed",
-                rundir + "unknown.reads",
-                rundir + "predictions.reads",
-                rundir,
-            ],
-            stderr=stderr,
-        )
-        check_call(
-            [
-                "perl",
-                SRCDIR + "analysis/writeWig.pl",
-                "-i",
-                rundir + "predictions.reads",
-                "-o",
-                rundir,
-                "-p",
-                "predictions.pos.wig",
-                "-n",
-                "predictions.neg.wig",
-            ],
-            stderr=stderr,
-        )
-        check_call(
-            [
-                "perl",
-                SRCDIR + "analysis/getExpression.pl",
-                "-b",
-                rundir + "predictions.reads",
-                "-o",
-                rundir,
-                "-a",
-                rundir + "predictions.bed",
-                "-f",
-                rundir + "predictions.expression.bed",
-                "-p",
-                "predictions.pos.wig",
-                "-n",
-                "predictions.neg.wig",
-                "-r",
-                species["dir"] + "RNAz.bed",
-                "-s",
-                species["id"],
-            ],
-            stderr=stderr,
+
+def quantify_user_annotation(job):
+    """Step 7: quantify the user annotation"""
+    rundir = job["rundir"]
+    try:
+        sharding.quantify_annotation(
+            job["shard_dirs"],
+            rundir + "user_annotation.bed",
+            "upload.tags",
+            "user_annotation",
+            rundir,
+            job["species"]["id"],
+            job["species_index"].rnaz_markers(),
         )
-        job_infos["prediction_succesful"] = "1"
     except:
-        job_infos["prediction_succesful"] = "0"
+        logger.exception("Exception during analysis")
+        raise
+    job["job_infos"]["user_annotation_succesful"] = "1"
 
-    # ------------------------------------------------------------------------------------------
-    # STEP 7: Quantify user annotation
-    # ------------------------------------------------------------------------------------------
-    job_infos["user_annotation_succesful"] = "0"  # must be set always # TODO: no! alter create main HTML
-    if job_infos["user_annotation"] != "NONE":
-        try:
-            check_call(
-                [
-                    "Rscript",
-                    SRCDIR + "analysis/overlapPredictions.R",
-                    rundir + "user_annotation.bed",
-                    rundir + "upload.bed",
-                    rundir + "user_annotation.reads",
-                ],
-                stderr=stderr,
-            )
-            check_call(
-                [
-                    "perl",
-                    SRCDIR + "analysis/writeWig.pl",
-                    "-i",
-                    rundir + "user_annotation.reads",
-                    "-o",
-                    rundir,
-                    "-p",
-                    "user_annotation.pos.wig",
-                    "-n",
-                    "user_annotation.neg.wig",
-                ],
-                stderr=stderr,
-            )
-            check_call(
-                [
-                    "perl",
-                    SRCDIR + "analysis/getExpression.pl",
-                    "-b",
-                    rundir + "user_annotation.reads",
-                    "-o",
-                    rundir,
-                    "-a",
-                    rundir + "user_annotation.bed",
-                    "-f",
-                    rundir + "user_annotation.expression.bed",
-                    "-p",
-                    "user_annotation.pos.wig",
-                    "-n",
-                    "user_annotation.neg.wig",
-                    "-r",
-                    species["dir"] + "RNAz.bed",
-                    "-s",
-                    species["id"],
-                ],
-                stderr=stderr,
-            )
-            job_infos["user_annotation_succesful"] = "1"
-        except:
-            job_infos["user_annotation_succesful"] = "0"  # do nothing
-            logger.exception("Exception during analysis")
-            # create_error_HTML(rundir, job_infos, "The user annotation could not be processed." )
-            # return config.RETURN_CODE_ERROR
 
-    # ------------------------------------------------------------------------------------------
-    # STEP 7: Create pictures,result HTML and cleanup
-    # ------------------------------------------------------------------------------------------
+def create_report(job):
+    """Step 8: create pictures and result HTML"""
+    rundir, job_infos = job["rundir"], job["job_infos"]
     job_infos["job_finish_time"] = strftime("%Y-%m-%d %H:%M:%S", localtime())
-
     try:
         # Create nice figures
-        check_call(["Rscript", SRCDIR + "analysis/createQualityControlFigures.R", rundir], stderr=stderr)
+        check_call(["Rscript", SRCDIR + "analysis/createQualityControlFigures.R", rundir], stderr=job["stderr"])
 
         create_main_HTML(rundir, job_infos)
         job_infos["job_completed_succesfully"] = 1
     except:
-        create_error_HTML(rundir, job_infos, "Quality control and analysis statistics could not be created.")
         logger.exception("Exception during analysis")
+        raise AnalysisError("Quality control and analysis statistics could not be created.")
+
+
+def build_pipeline(job):
+    """The step graph of a job; prediction and user annotation are optional branches"""
+    steps = [
+        pipeline.Step(
+            "extract_mapping_loci",
+            partial(extract_mapping_loci, job),
+            outputs=[MAPPING_LOCI_BASENAME],
+        ),
+        pipeline.Step(
+            "collapse_tags",
+            partial(collapse_tags, job),
+            inputs=[MAPPING_LOCI_BASENAME],
+            outputs=["upload.tags", "upload.info", "length.out", "multipleMappings.out"],
+        ),
+        pipeline.Step(
+            "quantify_ncrnas",
+            partial(quantify_ncrnas, job),
+            inputs=["upload.tags", "upload.info"],
+            outputs=[
+                "shards/",
+                "ncRNAs.reads",
+                "unknown.reads",
+                "reads.info",
+                "ncRNAs.pos.wig",
+                "ncRNAs.neg.wig",
+                "ncRNA.expression.bed",
+            ],
+        ),
+        pipeline.Step(
+            "predict_ncrnas",
+            partial(predict_ncrnas, job),
+            inputs=["shards/", "ncRNAs.reads", "unknown.reads", "upload.info"],
+            outputs=[
+                "ncRNAs.clusters",
+                "ncRNAs.clusters.flagged",
+                "unknown.clusters",
+                "my.model",
+                "my.modelstat",
+                "predictions.bed",
+                "predictions.reads",
+                "predictions.pos.wig",
+                "predictions.neg.wig",
+                "predictions.expression.bed",
+            ],
+            optional=True,
+        ),
+        pipeline.Step(
+            "create_report",
+            partial(create_report, job),
+            inputs=["upload.info", "reads.info", "length.out", "multipleMappings.out", "ncRNA.expression.bed"],
+            outputs=["index.html"],
+            after=["predict_ncrnas", "quantify_user_annotation"],
+        ),
+    ]
+    if job["job_infos"]["user_annotation"] != "NONE":
+        steps += [
+            pipeline.Step(
+                "extract_user_annotation",
+                partial(extract_user_annotation, job),
+                outputs=["user_annotation.bed"],
+            ),
+            pipeline.Step(
+                "quantify_user_annotation",
+                partial(quantify_user_annotation, job),
+                inputs=["shards/", "user_annotation.bed", "upload.info"],
+                outputs=[
+                    "user_annotation.reads",
+                    "user_annotation.pos.wig",
+                    "user_annotation.neg.wig",
+                    "user_annotation.expression.bed",
+                ],
+                optional=True,
+            ),
+        ]
+    return pipeline.Pipeline(steps)
+
+
+def analyze(rundir):
+    """Main driver script"""
+    if not rundir.endswith("/"):  # for robustness, add "/"
+        rundir = rundir + "/"
+
+    # Setup error log file
+    stderr = open(rundir + config.STDERR_FILENAME, "a")
+    runlog_file = open(rundir + config.RUNLOG_FILENAME, "a")
+
+    job_infos = {}
+    info_file = csv.reader(open(rundir + config.PARAMS_FILENAME, newline=""), delimiter="\t")
+    for row in info_file:
+        if len(row) > 1:
+            job_infos[row[0]] = row[1].strip()
+
+    job_infos["job_start_time"] = strftime("%Y-%m-%d %H:%M:%S", localtime())
+    job_infos["prediction_succesful"] = "0"
+    job_infos["user_annotation_succesful"] = "0"  # must be set always # TODO: no! alter create main HTML
+
+    job = {
+        "rundir": rundir,
+        "job_infos": job_infos,
+        "stderr": stderr,
+        "runlog": runlog_file,
+        "species": config.SPECIES[job_infos["code"]],
+    }
+    steps = build_pipeline(job)
+    try:
+        steps.run()
+    except pipeline.StepFailed as e:
+        if isinstance(e.cause, AnalysisError):
+            create_error_HTML(rundir, job_infos, e.cause.message, e.cause.details)
+        else:
+            logger.exception("Exception during analysis")
+            create_error_HTML(rundir, job_infos, "The analysis failed unexpectedly.")
         return config.RETURN_CODE_ERROR
+    finally:
+        # Per step timing and the critical path of the job
+        durations = steps.durations()
+        job_infos["step_seconds"] = ",".join("%s:%.1f" % (name, sec) for name, sec in durations.items())
+        job_infos["critical_path"] = ">".join(steps.critical_path())
+        logger.info(
+            f"Step timings for {rundir}: {job_infos['step_seconds']} (critical path {job_infos['critical_path']})"
+        )
+        # CPU time, peak memory and output sizes per step, also in full in the metrics sidecar
+        step_metrics = metrics.step_metrics(steps, rundir)
+        job_infos.update(metrics.params_figures(step_metrics))
+        metrics.write_sidecar(rundir, job_infos, step_metrics)
 
     # Zip all files into one
     call(
@@ -574,18 +494,20 @@ def analyze(rundir):
         stderr=stderr,
     )
 
-    # Remove unnecessary files
+    # Remove unnecessary files and the intermediate tables
     files_to_delete = [
-        mapping_loci_basename + ".bed",
-        "upload.bed",
+        MAPPING_LOCI_BASENAME + ".bed",
+        "upload.tags",
         "unknown.reads",
         "ncRNAs.reads",
         "unknown.clusters",
         "predictions.reads",
+        "user_annotation.reads",
         "ncRNAs.clusters.flagged",
         "ncRNAs.clusters",
+        "shards/",
     ]
-    call("rm " + " ".join([rundir + f for f in files_to_delete]), shell=True, stderr=stderr)
+    call(["rm", "-rf"] + [rundir + f for f in files_to_delete], stderr=stderr)
 
     # Write updated job infos file
     with open(rundir + config.PARAMS_FILENAME, "w") as f:
@@ -605,5 +527,10 @@ if __name__ == "__main__":
     usage = "usage: %prog [options]"
     parser = OptionParser(usage)
     parser.add_option("-i", "--input", dest="dir", action="store", type="str", help="The Input Directory")
+    parser.add_option(
+        "-p", "--processes", dest="processes", action="store", type="int", help="Number of shard processes"
+    )
     (options, args) = parser.parse_args()
+    if options.processes:
+        config.SHARD_WORKERS = options.processes
     analyze(options.dir)
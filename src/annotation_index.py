@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+"""
+Prebuilt per-species annotation index.
+
+The annotation BED files of a species (ncRNAs.bed, exons.bed, introns.bed and
+RNAz.bed in config.SPECIES[...]["dir"]) are parsed once and stored as sorted,
+typed numpy arrays in config.ANNOTATION_INDEX_DIR_WH/<species id>/. Jobs open the
+arrays memory-mapped, so concurrent jobs share them through the page cache and
+skip all annotation parsing. An index is rebuilt automatically as soon as one
+of its source files changes.
+
+Each build is a directory of its own (<species id>.v<build time>), and the link
+<species id> points to the current one. A job resolves the link once and reads
+that build until it ends, holding a shared lock on it; builds that are no longer
+current are removed once no job holds their lock (see remove_unused()).
+
+Build the indexes of all (or some) species ahead of time with:
+    python3 annotation_index.py [SPECIES_ID ...]
+"""
+
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+import config
+from config import logger
+from overlap import IntervalIndex, build_type_indexes, read_bed
+from expression import ANNOTATION_COLUMNS, rnaz_markers
+
+INDEX_VERSION = 1
+SOURCES = ("ncRNAs.bed", "exons.bed", "introns.bed", "RNAz.bed")
+OPTIONAL_SOURCES = ("RNAz.bed",)
+META_FILENAME = "meta.json"
+# Lock file of a build, held shared by the jobs using it
+IN_USE_FILENAME = ".in_use"
+
+
+def _source_stamps(species_dir):
+    """Size and modification time of each source BED file (None if missing)"""
+    stamps = {}
+    for name in SOURCES:
+        try:
+            st = os.stat(species_dir + name)
+            stamps[name] = [st.st_size, st.st_mtime_ns]
+        except FileNotFoundError:
+            stamps[name] = None
+    return stamps
+
+
+def annotation_version(species_dir):
+    """Digest of the source stamps of a species annotation, it changes with any of its files"""
+    stamps = json.dumps(_source_stamps(species_dir), sort_keys=True)
+    return hashlib.sha256(stamps.encode("utf-8")).hexdigest()
+
+
+def missing_sources(species_dir):
+    """The required source BED files missing in species_dir"""
+    return [name for name in SOURCES if name not in OPTIONAL_SOURCES and not os.path.exists(species_dir + name)]
+
+
+def _read_source(species_dir, name, extra_columns=None):
+    """Parse a source BED file; optional sources that are missing yield an empty table"""
+    if name in OPTIONAL_SOURCES and not os.path.exists(species_dir + name):
+        return None
+    return read_bed(species_dir + name, extra_columns)
+
+
+def build_index(species_dir, index_dir):
+    """Parse the annotation BED files of species_dir and write the index arrays to index_dir"""
+    stamps = _source_stamps(species_dir)
+    ncrnas = _read_source(species_dir, "ncRNAs.bed", ANNOTATION_COLUMNS)
+    exons = _read_source(species_dir, "exons.bed")
+    introns = _read_source(species_dir, "introns.bed")
+    rnaz = _read_source(species_dir, "RNAz.bed")
+
+    keys = {}
+    type_indexes = build_type_indexes(ncrnas, exons, introns, keys)
+    meta = {
+        "version": INDEX_VERSION,
+        "sources": stamps,
+        "pairs": list(keys),
+        "types": list(type_indexes),
+        "labels": list(dict.fromkeys(ncrnas["type"])),
+        "rnaz_chroms": None,
+    }
+
+    # Interval indexes per annotation type, as used to classify reads
+    for i, index in enumerate(type_indexes.values()):
+        np.save(os.path.join(index_dir, "type%d.start_keys.npy" % i), index.start_keys)
+        np.save(os.path.join(index_dir, "type%d.max_end_keys.npy" % i), index.max_end_keys)
+
+    # ncRNA table in file order, as used for expression tables
+    pairs = np.array([keys[pair] for pair in zip(ncrnas["chrom"], ncrnas["strand"])], dtype=np.int32)
+    np.save(os.path.join(index_dir, "ncRNAs.pair.npy"), pairs)
+    for col in ("start", "end"):
+        np.save(os.path.join(index_dir, "ncRNAs.%s.npy" % col), ncrnas[col])
+    for col in ANNOTATION_COLUMNS:
+        np.save(os.path.join(index_dir, "ncRNAs.%s.npy" % col), ncrnas[col].astype(str))
+
+    # RNAz sample positions
+    if rnaz is not None:
+        chrom_codes, marker_keys = rnaz_markers(rnaz)
+        meta["rnaz_chroms"] = list(chrom_codes)
+        np.save(os.path.join(index_dir, "RNAz.keys.npy"), marker_keys)
+
+    with open(os.path.join(index_dir, META_FILENAME), "w") as f:
+        json.dump(meta, f)
+
+
+class AnnotationIndex:
+    """Memory-mapped view on one build of the index of a species, which is kept while the view is open"""
+
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        # raises FileNotFoundError if the build was removed meanwhile
+        self.in_use = open(os.path.join(index_dir, IN_USE_FILENAME))
+        fcntl.flock(self.in_use, fcntl.LOCK_SH)
+        if not os.path.exists(os.path.join(index_dir, META_FILENAME)):
+            self.in_use.close()
+            raise FileNotFoundError("annotation index %s was removed" % index_dir)
+        with open(os.path.join(index_dir, META_FILENAME)) as f:
+            self.meta = json.load(f)
+        self.keys = dict((tuple(pair), i) for i, pair in enumerate(self.meta["pairs"]))
+        self.labels = self.meta["labels"]
+
+    def close(self):
+        self.in_use.close()
+
+    def _load(self, name):
+        return np.load(os.path.join(self.index_dir, name), mmap_mode="r")
+
+    def type_indexes(self):
+        """Interval indexes per annotation type (exon, intron, ncRNA classes), see overlap.build_type_indexes()"""
+        return dict(
+            (
+                t,
+                IntervalIndex.from_sorted_keys(
+                    self.keys, self._load("type%d.start_keys.npy" % i), self._load("type%d.max_end_keys.npy" % i)
+                ),
+            )
+            for i, t in enumerate(self.meta["types"])
+        )
+
+    def ncrnas(self):
+        """The ncRNA annotation as table with chrom, start, end, strand and ANNOTATION_COLUMNS"""
+        pairs = self._load("ncRNAs.pair.npy")
+        pair_chroms = np.array([chrom for chrom, strand in self.meta["pairs"]], dtype=object)
+        pair_strands = np.array([strand for chrom, strand in self.meta["pairs"]], dtype=object)
+        table = {
+            "chrom": pair_chroms[pairs],
+            "strand": pair_strands[pairs],
+            "start": self._load("ncRNAs.start.npy"),
+            "end": self._load("ncRNAs.end.npy"),
+        }
+        for col in ANNOTATION_COLUMNS:
+            table[col] = self._load("ncRNAs.%s.npy" % col).astype(object)
+        return table
+
+    def rnaz_markers(self):
+        """RNAz sample positions as returned by expression.rnaz_markers(), None without RNAz annotation"""
+        if self.meta["rnaz_chroms"] is None:
+            return None
+        chrom_codes = dict((chrom, i) for i, chrom in enumerate(self.meta["rnaz_chroms"]))
+        return chrom_codes, self._load("RNAz.keys.npy")
+
+
+def _is_fresh(index_dir, species_dir):
+    """Check whether the index exists and was built from the current source files"""
+    try:
+        with open(os.path.join(index_dir, META_FILENAME)) as f:
+            meta = json.load(f)
+    except (IOError, ValueError):
+        return False
+    return meta.get("version") == INDEX_VERSION and meta.get("sources") == _source_stamps(species_dir)
+
+
+def remove_unused(species):
+    """Remove the builds of the index of a species that are not current and not used by a job"""
+    link = config.ANNOTATION_INDEX_DIR_WH + species["id"]
+    current = os.path.realpath(link)
+    for name in os.listdir(config.ANNOTATION_INDEX_DIR_WH):
+        build_dir = config.ANNOTATION_INDEX_DIR_WH + name
+        if not name.startswith(species["id"] + ".v") or build_dir == current:
+            continue
+        try:
+            with open(os.path.join(build_dir, IN_USE_FILENAME)) as in_use:
+                fcntl.flock(in_use, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                shutil.rmtree(build_dir)
+        except FileNotFoundError:
+            pass  # removed meanwhile
+        except BlockingIOError:
+            logger.info(f"Annotation index {build_dir} is still in use")
+
+
+def ensure_index(species, force=False):
+    """
+    Return the directory of the current build of the index of a species (an entry of
+    config.SPECIES), building it first if it is missing or outdated
+    """
+    link = config.ANNOTATION_INDEX_DIR_WH + species["id"]
+    if not force and os.path.islink(link) and _is_fresh(link, species["dir"]):
+        return os.path.realpath(link)
+
+    os.makedirs(config.ANNOTATION_INDEX_DIR_WH, exist_ok=True)
+    with open(link + ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)  # one build per species, concurrent jobs wait for it
+        if force or not os.path.islink(link) or not _is_fresh(link, species["dir"]):
+            logger.info("Building annotation index for " + species["id"])
+            build_dir = tempfile.mkdtemp(prefix="." + species["id"] + ".", dir=config.ANNOTATION_INDEX_DIR_WH)
+            try:
+                build_index(species["dir"], build_dir)
+                open(os.path.join(build_dir, IN_USE_FILENAME), "w").close()
+                os.chmod(build_dir, 0o755)
+                version = "%s.v%d" % (species["id"], time.time_ns())
+                os.rename(build_dir, config.ANNOTATION_INDEX_DIR_WH + version)
+            except:
+                shutil.rmtree(build_dir, ignore_errors=True)
+                raise
+            if os.path.isdir(link) and not os.path.islink(link):
+                # index of a release without builds, removed as unused build below
+                open(os.path.join(link, IN_USE_FILENAME), "w").close()
+                os.rename(link, "%s.v%d" % (link, 0))
+            # switch to the new build atomically, jobs that opened a former one keep reading it
+            os.symlink(version, link + ".new")
+            os.replace(link + ".new", link)
+            remove_unused(species)
+    return os.path.realpath(link)
+
+
+def open_index(species):
+    """
+    Open the current build of the (up-to-date) annotation index of a species, see ensure_index().
+    Other processes of the job open the same build with AnnotationIndex(index.index_dir).
+    """
+    while True:
+        index_dir = ensure_index(species)
+        try:
+            return AnnotationIndex(index_dir)
+        except FileNotFoundError:
+            continue  # replaced and removed between resolving and opening it
+
+
+def build_all(species_ids=None, force=False):
+    """Build the indexes of the given species ids (default: all species in config.SPECIES)"""
+    for name, species in config.SPECIES.items():
+        if species_ids and species["id"] not in species_ids:
+            continue
+        try:
+            ensure_index(species, force)
+            remove_unused(species)
+        except Exception:
+            logger.exception(f"Annotation index for {name} could not be built")
+
+
+if __name__ == "__main__":
+    from optparse import OptionParser
+
+    parser = OptionParser("usage: %prog [options] [SPECIES_ID ...]")
+    parser.add_option("-f", "--force", dest="force", action="store_true", help="Rebuild even if up-to-date")
+    options, args = parser.parse_args()
+    build_all(args, options.force)
@@ -0,0 +1,274 @@
+"""
+Streaming reader of BAM files, replacing map2bed.pl (samtools view piped through
+Perl) for BAM uploads.
+
+BGZF blocks are inflated in parallel by a thread pool (zlib releases the GIL),
+the alignment records are decoded in order and aggregated to tags as map2bed.pl
+did, so that tags.collapse_records() takes them without an intermediate BED file.
+Alignments are grouped by read sequence with the external sort of tags.py, so
+memory is bounded as in the collapse of BED uploads.
+"""
+
+import collections
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from itertools import groupby
+
+import config
+import tags
+
+BAM_MAGIC = b"BAM\x01"
+CIGAR_OPS = "MIDNSHP=X"
+SEQ_CODES = "=ACMGRSVTWYHKDBN"
+# Two bases for each byte of the 4-bit encoded sequence
+SEQ_PAIRS = [SEQ_CODES[b >> 4] + SEQ_CODES[b & 15] for b in range(256)]
+COMPLEMENT = str.maketrans("ACGTUacgtu", "TGCAAtgcaa")
+AUX_SIZES = {"A": 1, "c": 1, "C": 1, "s": 2, "S": 2, "i": 4, "I": 4, "f": 4}
+# BGZF blocks inflated by one task of the thread pool
+BLOCKS_PER_TASK = 64
+
+FLAG_PAIRED_FIRST = 64
+FLAG_PAIRED_SECOND = 128
+FLAG_SECONDARY = 256
+FLAG_SUPPLEMENTARY = 2048
+
+_record_header = struct.Struct("<iiBBHHHi12x")
+
+Alignment = collections.namedtuple("Alignment", "read_name chrom pos flag cigar seq alternatives")
+
+
+class BAMFormatError(ValueError):
+    pass
+
+
+def _read_blocks(f):
+    """Compressed data (deflate stream) and uncompressed size of each BGZF block of a file"""
+    while True:
+        header = f.read(12)
+        if not header:
+            return
+        if len(header) < 12 or header[:4] != b"\x1f\x8b\x08\x04":
+            raise BAMFormatError("Not a BGZF block")
+        extra = f.read(struct.unpack_from("<H", header, 10)[0])
+        block_size = None
+        offset = 0
+        while offset + 4 <= len(extra):
+            subfield_length = struct.unpack_from("<H", extra, offset + 2)[0]
+            if extra[offset : offset + 2] == b"BC":
+                block_size = struct.unpack_from("<H", extra, offset + 4)[0] + 1
+            offset += 4 + subfield_length
+        if block_size is None:
+            raise BAMFormatError("BGZF block without size")
+        body = f.read(block_size - 12 - len(extra))
+        if len(body) < block_size - 12 - len(extra):
+            raise BAMFormatError("Truncated BGZF block")
+        yield body[:-8], struct.unpack_from("<I", body, len(body) - 4)[0]
+
+
+def _inflate(blocks):
+    data = []
+    for compressed, size in blocks:
+        block = zlib.decompress(compressed, -15)
+        if len(block) != size:
+            raise BAMFormatError("Corrupt BGZF block")
+        data.append(block)
+    return b"".join(data)
+
+
+def iter_bgzf(f, threads=None):
+    """Uncompressed data of a BGZF file in chunks, inflated by a pool of threads (config.BAM_THREADS)"""
+    threads = threads or config.BAM_THREADS
+    blocks = _read_blocks(f)
+    with ThreadPoolExecutor(threads) as pool:
+        pending = collections.deque()
+        while True:
+            batch = [block for _, block in zip(range(BLOCKS_PER_TASK), blocks)]
+            if batch:
+                pending.append(pool.submit(_inflate, batch))
+            # keep a few tasks per thread in flight, and memory bounded
+            while pending and (len(pending) > 2 * threads or not batch):
+                yield pending.popleft().result()
+            if not batch:
+                return
+
+
+class _Buffer:
+    """Decompressed data of a BAM file, read from the chunks of iter_bgzf"""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.data = b""
+        self.pos = 0
+
+    def fill(self, n):
+        """Make n bytes available at pos, returns False at the end of the file"""
+        while len(self.data) - self.pos < n:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                return False
+            self.data = self.data[self.pos :] + chunk
+            self.pos = 0
+        return True
+
+    def read(self, n):
+        if not self.fill(n):
+            raise BAMFormatError("Truncated BAM file")
+        self.pos += n
+        return self.data[self.pos - n : self.pos]
+
+
+def _aux_string(data, start, end, tag):
+    """Value of a string (type Z) auxiliary field of an alignment, None if missing"""
+    while start + 3 <= end:
+        name, value_type = data[start : start + 2], chr(data[start + 2])
+        start += 3
+        if value_type in ("Z", "H"):
+            value_end = data.index(b"\0", start)
+            if name == tag and value_type == "Z":
+                return data[start:value_end].decode("ascii")
+            start = value_end + 1
+        elif value_type == "B":
+            count = struct.unpack_from("<i", data, start + 1)[0]
+            start += 5 + count * AUX_SIZES[chr(data[start])]
+        else:
+            start += AUX_SIZES[value_type]
+    return None
+
+
+def iter_alignments(f, threads=None):
+    """
+    Alignments of a BAM file object as Alignment tuples (1-based pos, cigar as (length, op) pairs,
+    sequence as stored, alternative hits of the XA tag or None), unmapped reads excluded
+    """
+    buf = _Buffer(iter_bgzf(f, threads))
+    if buf.read(4) != BAM_MAGIC:
+        raise BAMFormatError("Not a BAM file")
+    buf.read(struct.unpack("<i", buf.read(4))[0])  # SAM header text
+    references = []
+    for _ in range(struct.unpack("<i", buf.read(4))[0]):
+        name = buf.read(struct.unpack("<i", buf.read(4))[0])
+        buf.read(4)  # reference length
+        references.append(name.rstrip(b"\0").decode("ascii"))
+
+    while buf.fill(4):
+        record = buf.read(struct.unpack("<i", buf.read(4))[0])
+        ref_id, pos, name_length, _, _, n_cigar, flag, seq_length = _record_header.unpack_from(record)
+        if ref_id < 0:
+            continue
+        offset = _record_header.size + name_length
+        cigar = [(op >> 4, CIGAR_OPS[op & 15]) for op in struct.unpack_from("<%dI" % n_cigar, record, offset)]
+        offset += 4 * n_cigar
+        packed_length = (seq_length + 1) // 2
+        if seq_length:
+            seq = "".join([SEQ_PAIRS[b] for b in record[offset : offset + packed_length]])[:seq_length]
+        else:
+            seq = "*"
+        aux = offset + packed_length + seq_length
+        alternatives = _aux_string(record, aux, len(record), b"XA") if b"XAZ" in record[aux:] else None
+        yield Alignment(
+            record[_record_header.size : _record_header.size + name_length - 1].decode("ascii"),
+            references[ref_id],
+            pos + 1,
+            flag,
+            cigar,
+            seq,
+            alternatives,
+        )
+
+
+def _splice_parts(cigar, start):
+    """
+    (start, end) of the parts of a spliced alignment (cigar string), as getSpliceParts of map2bed.pl
+    computed them, including the digits of other operations adding up to the next M, D or N
+    """
+    parts = []
+    length = 0
+    value = ""
+    for c in cigar:
+        if c.isdigit():
+            value += c
+        elif c in "MD":
+            length += int(value or 0)
+            value = ""
+        elif c == "N":
+            parts.append((start, start + length + 1))
+            start = start + length + int(value or 0)
+            length = 0
+            value = ""
+    parts.append((start, start + length + 1))
+    return parts
+
+
+def _loci(chrom, start, cigar, strand):
+    """Loci (chrom, start, end, strand) of an alignment, one per part of spliced ones"""
+    if any(op == "N" for _, op in cigar):
+        cigar_string = "".join("%d%s" % (length, op) for length, op in cigar)
+        return [(chrom, s, e, strand) for s, e in _splice_parts(cigar_string, start)]
+    return [(chrom, start, start + 1 + sum(length for length, op in cigar if op in "MD"), strand)]
+
+
+def _parse_cigar(cigar):
+    ops, number = [], ""
+    for c in cigar:
+        if c.isdigit():
+            number += c
+        else:
+            ops.append((int(number or 0), c))
+            number = ""
+    return ops
+
+
+def _iter_sequence_loci(bam_file, threads):
+    """
+    (sequence, number of the alignment, 1 for primary alignments else 0, loci) of each alignment
+    of a BAM file, see iter_tag_records()
+    """
+    with open(bam_file, "rb") as f:
+        for number, alignment in enumerate(iter_alignments(f, threads)):
+            if alignment.flag & (FLAG_PAIRED_FIRST | FLAG_PAIRED_SECOND):
+                raise BAMFormatError(
+                    "It seems your file consists of paired end reads. Unfortunately, we do not support these experiments."
+                )
+            # map2bed.pl took any flag for the reverse strand
+            strand = "-" if alignment.flag else "+"
+            seq = alignment.seq
+            if strand == "-":
+                seq = seq[::-1].translate(COMPLEMENT)
+            loci = _loci(alignment.chrom, alignment.pos, alignment.cigar, strand)
+            if alignment.alternatives and not alignment.alternatives.startswith("Q"):
+                for hit in alignment.alternatives.split(";"):
+                    if not hit:
+                        continue
+                    chrom, pos, cigar = hit.split(",")[:3]
+                    hit_strand = "+" if "+" in pos else "-"
+                    loci += _loci(chrom, int(pos.lstrip("+-")), _parse_cigar(cigar), hit_strand)
+            primary = 0 if alignment.flag & (FLAG_SECONDARY | FLAG_SUPPLEMENTARY) else 1
+            yield seq, number, primary, loci
+
+
+def iter_tag_records(bam_file, threads=None, tmpdir=None, chunk_size=None):
+    """
+    Mapping loci of the distinct read sequences (tags) of a BAM file as BED records
+    (chrom, start, end, tag, number of reads, strand) for tags.collapse_records(), with the
+    coordinates and tag names map2bed.pl wrote. The reads of a tag are its primary alignments,
+    as map2bed.pl counted distinct read names. Raises BAMFormatError for paired end reads.
+    """
+    chunk_size = chunk_size or config.TAG_SORT_CHUNK_SIZE
+
+    def by_tag(by_sequence):
+        for seq, alignments in groupby(by_sequence, key=lambda r: r[0]):
+            first, read_count, loci = None, 0, set()
+            for _, number, primary, alignment_loci in alignments:
+                first = number if first is None else first
+                read_count += primary
+                loci.update(alignment_loci)
+            # a tag of secondary alignments only is one read, as its read name was for map2bed.pl
+            yield first, read_count or 1, sorted(loci)
+
+    by_sequence = tags._external_sort(_iter_sequence_loci(bam_file, threads), lambda r: r[:2], chunk_size, tmpdir)
+    # tags numbered in the order of their first alignment, as map2bed.pl did
+    by_first = tags._external_sort(by_tag(by_sequence), lambda r: r[0], chunk_size, tmpdir)
+    for tag, (_, read_count, loci) in enumerate(by_first, 1):
+        for chrom, start, end, strand in loci:
+            yield chrom, start, end, "tag_%d" % tag, read_count, strand
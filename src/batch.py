@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+"""
+Batch analysis of several small RNA libraries of one species, for comparing samples.
+
+    python3 batch.py -c SPECIES -o OUTPUT_DIR [-n NAME,...] [-p PROCESSES] LIBRARY [LIBRARY ...]
+
+Each library gets a directory OUTPUT_DIR/<sample>/ in which its reads are collapsed
+to tags as in a job (steps 1-4 of analysis.py, samples in parallel). The annotation
+index of the species is then opened once, and the reads of all samples are overlapped
+with it and quantified against the ncRNAs in one pass over the shared annotation
+(expression.quantify_samples()). Per sample, reads.info, the ncRNA read density tracks
+and ncRNA.expression.bed are written as in a job. OUTPUT_DIR holds the joint tables,
+one row per ncRNA expressed in any sample and one column per sample:
+    ncRNA.rpm_matrix.tsv          expression in reads per million (as in the expression tables)
+    ncRNA.read_count_matrix.tsv   overlapping reads (readCnt)
+and samples.tsv with the status of each sample.
+"""
+
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from optparse import OptionParser
+
+import numpy as np
+
+import config
+from config import logger
+import analysis
+import annotation_index
+import columnar
+import coverage
+import expression
+import ingest
+import overlap
+
+RPM_MATRIX_FILENAME = "ncRNA.rpm_matrix.tsv"
+READ_COUNT_MATRIX_FILENAME = "ncRNA.read_count_matrix.tsv"
+SAMPLES_FILENAME = "samples.tsv"
+MATRIX_ANNOTATION_COLUMNS = ("id", "chrom", "start", "end", "strand", "type")
+
+
+def sample_names(libraries, names=None):
+    """Names of the samples of libraries: the given ones or the file names without suffixes, made unique"""
+    names = list(names or [os.path.basename(library).split(".")[0] for library in libraries])
+    if len(names) != len(libraries):
+        raise ValueError("%d names given for %d libraries" % (len(names), len(libraries)))
+    seen = {}
+    for i, name in enumerate(names):
+        seen[name] = seen.get(name, 0) + 1
+        if seen[name] > 1:
+            names[i] = "%s_%d" % (name, seen[name])
+    return names
+
+
+def prepare_sample(library, sample_dir):
+    """
+    Steps 1-4 of the analysis for one library: store it in sample_dir like an upload and collapse
+    its reads to the table sample_dir/upload.tags. Returns None, or the error message on failure.
+    """
+    os.makedirs(sample_dir, exist_ok=True)
+    with open(sample_dir + config.STDERR_FILENAME, "a") as stderr, open(
+        sample_dir + config.RUNLOG_FILENAME, "a"
+    ) as runlog:
+        job = {"rundir": sample_dir, "job_infos": {}, "stderr": stderr, "runlog": runlog}
+        try:
+            ingest.ingest_file(library, sample_dir, analysis.MAPPING_LOCI_BASENAME)
+            analysis.extract_mapping_loci(job)
+            analysis.collapse_tags(job)
+            # the unpacked BED file, as analyze() removes it
+            if os.path.exists(sample_dir + analysis.MAPPING_LOCI_BASENAME + ".bed"):
+                os.remove(sample_dir + analysis.MAPPING_LOCI_BASENAME + ".bed")
+        except analysis.AnalysisError as e:
+            return e.message
+        except Exception as e:
+            logger.exception(f"Library {library} could not be prepared")
+            return str(e)
+    return None
+
+
+def prepare_samples(libraries, sample_dirs, processes=None):
+    """prepare_sample() for all libraries in a process pool, returns the error messages (None if prepared)"""
+    processes = min(processes or config.SHARD_WORKERS, len(libraries))
+    if processes <= 1:
+        return [prepare_sample(library, sample_dir) for library, sample_dir in zip(libraries, sample_dirs)]
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        return list(pool.map(prepare_sample, libraries, sample_dirs))
+
+
+def quantify_samples(sample_dirs, species):
+    """
+    Step 5 for the collapsed reads of all samples with one annotation index: write the per sample results,
+    returns the ncRNA table and the (expr, readCnt, overlapping reads) arrays of samples x ncRNAs
+    """
+    index = annotation_index.open_index(species)
+    type_indexes, ncrnas = index.type_indexes(), index.ncrnas()
+    samples = []
+    for sample_dir in sample_dirs:
+        info = overlap.quantify_ncrna_overlap(
+            type_indexes,
+            index.labels,
+            sample_dir + "upload.tags",
+            sample_dir + "ncRNAs.reads",
+            sample_dir + "unknown.reads",
+        )
+        overlap.write_reads_info(info, sample_dir + "reads.info")
+        coverage.write_coverage_tracks(
+            sample_dir + "ncRNAs.reads",
+            sample_dir + "ncRNAs.pos.wig",
+            sample_dir + "ncRNAs.neg.wig",
+            config.COVERAGE_TRACK_FORMAT,
+        )
+        samples.append(columnar.read_table(sample_dir + "ncRNAs.reads", expression.READ_COLUMNS))
+
+    expr, norm_reads, read_counts, overlapping = expression.quantify_samples(samples, ncrnas)
+    for s, sample_dir in enumerate(sample_dirs):
+        rows = np.flatnonzero(overlapping[s] > 0)
+        expression.write_expression_rows(
+            (rows, expr[s, rows], norm_reads[s, rows], read_counts[s, rows]),
+            ncrnas,
+            sample_dir + "ncRNA.expression.bed",
+            sample_dir,
+            "ncRNAs.pos.wig",
+            "ncRNAs.neg.wig",
+            species["id"],
+        )
+    return ncrnas, expr, read_counts, overlapping
+
+
+def write_matrix(filename, ncrnas, rows, names, values, value_format):
+    """Write values (samples x ncRNAs) of the ncRNA rows as table with one column per sample"""
+    with open(filename, "w") as f:
+        f.write("\t".join(MATRIX_ANNOTATION_COLUMNS + tuple(names)) + "\n")
+        for i in rows:
+            cols = [str(ncrnas[col][i]) for col in MATRIX_ANNOTATION_COLUMNS]
+            f.write("\t".join(cols + [value_format(v) for v in values[:, i]]) + "\n")
+
+
+def analyze_batch(libraries, output_dir, species_code, names=None, processes=None):
+    """Analyze libraries of the species into output_dir, returns the number of samples quantified"""
+    output_dir = os.path.join(output_dir, "")
+    species = config.SPECIES[species_code]
+    names = sample_names(libraries, names)
+    sample_dirs = [output_dir + name + "/" for name in names]
+    errors = prepare_samples(libraries, sample_dirs, processes)
+    prepared = [s for s, error in enumerate(errors) if error is None]
+    for s, error in enumerate(errors):
+        if error is not None:
+            logger.error(f"Sample {names[s]} ({libraries[s]}) left out: {error}")
+
+    total_reads = [0.0] * len(libraries)
+    if prepared:
+        ncrnas, expr, read_counts, overlapping = quantify_samples([sample_dirs[s] for s in prepared], species)
+        for s in prepared:
+            total_reads[s] = expression.read_total_read_count(sample_dirs[s] + "upload.info")
+        # reads per million as in the expression tables: expression per base, relative to the library size
+        lengths = ncrnas["end"] - ncrnas["start"] + 1
+        rpm = expr / lengths / np.array([total_reads[s] for s in prepared])[:, None] * 1000000
+        rows = np.flatnonzero((overlapping > 0).any(axis=0))
+        prepared_names = [names[s] for s in prepared]
+        write_matrix(output_dir + RPM_MATRIX_FILENAME, ncrnas, rows, prepared_names, rpm, lambda v: "%.4g" % v)
+        write_matrix(
+            output_dir + READ_COUNT_MATRIX_FILENAME,
+            ncrnas,
+            rows,
+            prepared_names,
+            read_counts,
+            overlap.format_perl_number,
+        )
+
+    with open(output_dir + SAMPLES_FILENAME, "w") as f:
+        f.write("sample\tlibrary\tstatus\treads\tmessage\n")
+        for s, name in enumerate(names):
+            status = "quantified" if errors[s] is None else "failed"
+            f.write("\t".join([name, libraries[s], status, "%d" % total_reads[s], errors[s] or ""]) + "\n")
+    return len(prepared)
+
+
+if __name__ == "__main__":
+    parser = OptionParser("usage: %prog -c SPECIES -o OUTPUT_DIR [options] LIBRARY [LIBRARY ...]")
+    parser.add_option("-c", dest="species_code", help="Species, e.g. 'Fruit Fly (dm3)'")
+    parser.add_option("-o", dest="output_dir", help="Output directory")
+    parser.add_option("-n", dest="names", help="Sample names, comma separated (default: library file names)")
+    parser.add_option("-p", dest="processes", type="int", help="Libraries prepared in parallel")
+    options, libraries = parser.parse_args()
+    if not libraries or not options.output_dir:
+        parser.error("no libraries or output directory given")
+    if options.species_code not in config.SPECIES:
+        parser.error("unknown species %s" % options.species_code)
+
+    os.makedirs(options.output_dir, exist_ok=True)
+    names = options.names.split(",") if options.names else None
+    quantified = analyze_batch(libraries, options.output_dir, options.species_code, names, options.processes)
+    print("%d of %d samples quantified, see %s" % (quantified, len(libraries), options.output_dir))
+    sys.exit(config.RETURN_CODE_OK if quantified == len(libraries) else config.RETURN_CODE_ERROR)
@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+"""
+End to end and per step cost of analysis.analyze() on synthetic libraries (see
+synthetic_library.py) of increasing size, written to a JSON report so that runs of
+different releases can be compared.
+
+    python3 benchmarks/analysis_benchmark.py [-n 1e4,1e5,...] [-f bed|bam] [-c SPECIES] [-o REPORT]
+
+Each library is analyzed in a child process, whose wall time, CPU time and peak
+memory (including all its subprocesses) make the end to end figures. The steps run
+one after another unless -p is given, so that the CPU time and peak memory of the
+processes started by a step can be attributed to it.
+"""
+
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+from hashlib import md5
+from optparse import OptionParser
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(BENCHMARKS_DIR))  # DARIO sources
+import annotation_index
+import config
+import ingest
+import synthetic_library
+
+JOB_TEMPLATE = os.path.join(BENCHMARKS_DIR, "../../example/job_testing_template/", config.PARAMS_FILENAME)
+
+
+def _peak_rss_kb():
+    """Peak resident memory of this process since the last reset (VmHWM), or since its start without /proc"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _reset_peak_rss():
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except IOError:
+        pass
+
+
+def _cpu_seconds(usage):
+    return usage.ru_utime + usage.ru_stime
+
+
+def measured(name, func, measurements):
+    """func, recording wall time, CPU time and peak memory of its run into measurements[name]"""
+
+    def run():
+        _reset_peak_rss()
+        start_self = resource.getrusage(resource.RUSAGE_SELF)
+        start_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        start = time.perf_counter()
+        status = "failed"
+        try:
+            func()
+            status = "done"
+        finally:
+            end_self = resource.getrusage(resource.RUSAGE_SELF)
+            end_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+            # the peak of the children is known only when a child of this step set a new maximum
+            children_peak = end_children.ru_maxrss if end_children.ru_maxrss > start_children.ru_maxrss else 0
+            measurements[name] = {
+                "status": status,
+                "wall_seconds": time.perf_counter() - start,
+                "cpu_seconds": _cpu_seconds(end_self) - _cpu_seconds(start_self),
+                "children_cpu_seconds": _cpu_seconds(end_children) - _cpu_seconds(start_children),
+                "peak_rss_kb": max(_peak_rss_kb(), children_peak),
+            }
+
+    return run
+
+
+def run_analysis(rundir, concurrent, measurements_file):
+    """Run analyze() on rundir with measured steps (in the child process), returns its return code"""
+    import analysis
+
+    build_pipeline = analysis.build_pipeline
+    measurements = {}
+
+    def measured_pipeline(job):
+        steps = build_pipeline(job)
+        if not concurrent:
+            steps.max_workers = 1
+        for step in steps.steps.values():
+            measurements[step.name] = {"status": "skipped"}
+            step.func = measured(step.name, step.func, measurements)
+        return steps
+
+    analysis.build_pipeline = measured_pipeline
+    try:
+        return analysis.analyze(rundir)
+    finally:
+        with open(measurements_file, "w") as f:
+            json.dump(measurements, f)
+
+
+def create_job(workdir, library, species_code):
+    """Run directory of a job analyzing library, as set up by an upload"""
+    job_hash = md5(("%s%f" % (library, time.time())).encode("utf-8")).hexdigest()
+    rundir = os.path.join(workdir, job_hash) + "/"
+    os.mkdir(rundir)
+    params = {}
+    with open(JOB_TEMPLATE) as f:
+        for line in f:
+            cols = line.rstrip("\n").split("\t", 1)
+            if len(cols) > 1:
+                params[cols[0]] = cols[1]
+    params.update(
+        code=species_code,
+        hash=job_hash,
+        filename=os.path.basename(library),
+        total_upload_size=os.path.getsize(library),
+        job_received_at=time.strftime("%Y-%m-%d %H:%M:%S"),
+    )
+    with open(rundir + config.PARAMS_FILENAME, "w") as f:
+        for k, v in params.items():
+            f.write(k + "\t" + str(v) + "\n")
+    ingest.ingest_file(library, rundir, "mapping_loci")
+    return rundir
+
+
+def read_params(rundir):
+    params = {}
+    with open(rundir + config.PARAMS_FILENAME) as f:
+        for line in f:
+            cols = line.rstrip("\n").split("\t", 1)
+            if len(cols) > 1:
+                params[cols[0]] = cols[1]
+    return params
+
+
+def benchmark(workdir, reads, options):
+    """Generate and analyze a library of reads reads, returns its entry of the report"""
+    library = os.path.join(workdir, "library_%d.%s" % (reads, "bam" if options.format == "bam" else "bed.gz"))
+    start = time.perf_counter()
+    tags = synthetic_library.generate(
+        library, reads, options.format, options.lengths, options.multimap_rate, options.annotation_dir, options.seed
+    )
+    entry = {
+        "reads": reads,
+        "tags": tags,
+        "library_bytes": os.path.getsize(library),
+        "generate_seconds": time.perf_counter() - start,
+    }
+    rundir = create_job(workdir, library, options.species_code)
+    measurements_file = os.path.join(workdir, "steps.json")
+    if os.path.exists(measurements_file):
+        os.remove(measurements_file)
+
+    start = time.perf_counter()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            code = run_analysis(rundir, options.concurrent, measurements_file)
+        except BaseException:
+            traceback.print_exc()
+            code = 2
+        os._exit(code)
+    _, status, usage = os.wait4(pid, 0)
+    params = read_params(rundir)
+    entry.update(
+        return_code=os.waitstatus_to_exitcode(status),
+        completed=params.get("job_completed_succesfully") == "1",
+        end_to_end={
+            "wall_seconds": time.perf_counter() - start,
+            "cpu_user_seconds": usage.ru_utime,
+            "cpu_system_seconds": usage.ru_stime,
+            "peak_rss_kb": usage.ru_maxrss,
+        },
+        critical_path=params.get("critical_path", ""),
+    )
+    try:
+        with open(measurements_file) as f:
+            entry["steps"] = json.load(f)
+    except (IOError, ValueError):
+        entry["steps"] = {}
+
+    if not options.keep:
+        shutil.rmtree(rundir, ignore_errors=True)
+        os.remove(library)
+    return entry
+
+
+def revision():
+    """git revision of the sources, None outside of a checkout"""
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=BENCHMARKS_DIR, stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == "__main__":
+    parser = OptionParser("usage: %prog [options]")
+    parser.add_option("-n", dest="reads", default="1e4,1e5,1e6", help="Library sizes in reads, comma separated")
+    parser.add_option("-f", dest="format", default="bed", choices=["bed", "bam"], help="bed or bam")
+    parser.add_option("-l", dest="lengths", default="mirna", help="Read lengths (see synthetic_library.py)")
+    parser.add_option("-m", dest="multimap_rate", type="float", default=0.1, help="Share of multi-mapping tags")
+    parser.add_option(
+        "-a",
+        dest="annotation_dir",
+        help="Annotation directory of the libraries and the analysis, with ncRNAs.bed, exons.bed, introns.bed and "
+        "optionally RNAz.bed (default: dm3 example for the libraries, species directory for the analysis)",
+    )
+    parser.add_option("-c", dest="species_code", default="Fruit Fly (dm3)", help="Species analyzed against")
+    parser.add_option("-s", dest="seed", type="int", default=0, help="Random seed")
+    parser.add_option("-p", dest="concurrent", action="store_true", help="Run independent steps concurrently")
+    parser.add_option("-d", dest="workdir", help="Directory for libraries and jobs (default: temporary)")
+    parser.add_option("-k", dest="keep", action="store_true", help="Keep libraries and job directories")
+    parser.add_option("-o", dest="output", default="benchmark_report.json", help="JSON report")
+    options, args = parser.parse_args()
+    if options.species_code not in config.SPECIES:
+        parser.error("unknown species " + options.species_code)
+    species = config.SPECIES[options.species_code]
+    if options.annotation_dir:
+        # analyze against the annotation the libraries are generated from
+        species["dir"] = os.path.join(os.path.abspath(options.annotation_dir), "")
+    missing = annotation_index.missing_sources(species["dir"])
+    if missing:
+        parser.error("%s missing in the annotation directory %s" % (", ".join(missing), species["dir"]))
+
+    workdir = options.workdir or tempfile.mkdtemp(prefix="dario-benchmark-")
+    os.makedirs(workdir, exist_ok=True)
+    if options.annotation_dir:
+        # index of its own, the index of the species stays as it is
+        config.ANNOTATION_INDEX_DIR_WH = os.path.join(workdir, "annotation_index", "")
+    report = {
+        "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "revision": revision(),
+        "host": platform.node(),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "species": options.species_code,
+        "format": options.format,
+        "lengths": options.lengths,
+        "multimap_rate": options.multimap_rate,
+        "seed": options.seed,
+        "concurrent": bool(options.concurrent),
+        "libraries": [],
+    }
+    print("%12s %10s %10s %10s %12s  %s" % ("reads", "wall [s]", "cpu [s]", "rss [MB]", "status", "slowest step"))
+    for reads in [int(float(n)) for n in options.reads.split(",")]:
+        entry = benchmark(workdir, reads, options)
+        report["libraries"].append(entry)
+        with open(options.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+        end_to_end = entry["end_to_end"]
+        slowest = max(entry["steps"], key=lambda name: entry["steps"][name].get("wall_seconds", 0), default="")
+        print(
+            "%12d %10.1f %10.1f %10.1f %12s  %s"
+            % (
+                reads,
+                end_to_end["wall_seconds"],
+                end_to_end["cpu_user_seconds"] + end_to_end["cpu_system_seconds"],
+                end_to_end["peak_rss_kb"] / 1024.0,
+                "completed" if entry["completed"] else "failed",
+                slowest,
+            )
+        )
+    if not options.workdir and not options.keep:
+        shutil.rmtree(workdir, ignore_errors=True)
+    print("report written to " + options.output)
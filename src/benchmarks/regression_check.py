@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+"""
+Golden-file regression check of the analysis on the example dm3 annotation.
+
+A synthetic library (synthetic_library.py, fixed seed) is analyzed up to the
+prediction and the quantification of a user annotation (every tenth example ncRNA),
+once as a single shard and once in shards of chromosomes. The text outputs of both
+runs, and the reads and clusters tables in their text export (columnar.py), must
+match the checksums in example/regression/expected.sha256.
+
+    python3 benchmarks/regression_check.py [-k DIR] [-u]
+
+-u rewrites the checksums from the single shard run, after an intended change of
+the results. The example has no exon and intron annotation, so these are empty.
+flagKnownClusters.pl is run with a fixed Perl hash seed, its cluster order depends
+on it.
+"""
+
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+from optparse import OptionParser
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+SOURCE_DIR = os.path.dirname(BENCHMARKS_DIR)
+sys.path.append(SOURCE_DIR)  # DARIO sources
+import config
+import columnar
+import ingest
+import sharding
+import synthetic_library
+
+EXAMPLE_DIR = os.path.join(BENCHMARKS_DIR, "../../example/")
+EXPECTED_FILE = os.path.join(EXAMPLE_DIR, "regression/expected.sha256")
+SPECIES_CODE = "Fruit Fly (dm3)"
+READS = 100000
+SEED = 0
+# Outputs compared, tables in their text export
+OUTPUTS = (
+    "upload.tags",
+    "upload.info",
+    "length.out",
+    "multipleMappings.out",
+    "reads.info",
+    "ncRNAs.reads",
+    "unknown.reads",
+    "ncRNAs.pos.wig",
+    "ncRNAs.neg.wig",
+    "ncRNA.expression.bed",
+    "ncRNAs.clusters",
+    "ncRNAs.clusters.flagged",
+    "unknown.clusters",
+    "predictions.bed",
+    "predictions.reads",
+    "predictions.pos.wig",
+    "predictions.neg.wig",
+    "predictions.expression.bed",
+    "user_annotation.reads",
+    "user_annotation.pos.wig",
+    "user_annotation.neg.wig",
+    "user_annotation.expression.bed",
+)
+
+
+def create_species(workdir):
+    """Species directory of the example annotation, with empty exon and intron annotation"""
+    species_dir = os.path.join(workdir, "species", "")
+    shutil.copytree(os.path.join(EXAMPLE_DIR, "annotations/dm3"), species_dir)
+    for name in ("exons.bed", "introns.bed"):
+        open(species_dir + name, "w").close()
+    return species_dir
+
+
+def write_user_annotation(species_dir, filename):
+    with open(species_dir + "ncRNAs.bed") as f, open(filename, "w") as out:
+        out.writelines(line for i, line in enumerate(f) if i % 10 == 0)
+
+
+def run_analysis(rundir, library, shards):
+    """Run the analysis steps up to the prediction and user annotation in shards processes"""
+    import analysis
+
+    os.makedirs(rundir)
+    ingest.ingest_file(library, rundir, analysis.MAPPING_LOCI_BASENAME)
+    write_user_annotation(config.SPECIES[SPECIES_CODE]["dir"], rundir + "user_annotation.bed")
+    config.SHARD_WORKERS = shards
+    sharding.SHARDS_PER_WORKER = 1 if shards == 1 else 4
+    job = {
+        "rundir": rundir,
+        "job_infos": {"user_annotation": "user_annotation.bed"},
+        "stderr": open(rundir + config.STDERR_FILENAME, "a"),
+        "runlog": open(rundir + config.RUNLOG_FILENAME, "a"),
+        "species": config.SPECIES[SPECIES_CODE],
+    }
+    try:
+        for step in (
+            analysis.extract_mapping_loci,
+            analysis.collapse_tags,
+            analysis.quantify_ncrnas,
+            analysis.predict_ncrnas,
+            analysis.quantify_user_annotation,
+        ):
+            step(job)
+    finally:
+        job["stderr"].close()
+        job["runlog"].close()
+
+
+def checksums(rundir):
+    """SHA-256 of each output of a run, of the text export for tables"""
+    sums = {}
+    for name in OUTPUTS:
+        path = rundir + name
+        if columnar.is_table(path):
+            text_file = path + ".txt"
+            columnar.export(path, text_file)
+            path = text_file
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        sums[name] = digest.hexdigest()
+    return sums
+
+
+def read_expected():
+    expected = {}
+    with open(EXPECTED_FILE) as f:
+        for line in f:
+            digest, name = line.split()
+            expected[name] = digest
+    return expected
+
+
+def write_expected(sums):
+    os.makedirs(os.path.dirname(EXPECTED_FILE), exist_ok=True)
+    with open(EXPECTED_FILE, "w") as f:
+        for name in OUTPUTS:
+            f.write("%s  %s\n" % (sums[name], name))
+
+
+if __name__ == "__main__":
+    parser = OptionParser("usage: %prog [options]")
+    parser.add_option("-k", dest="workdir", help="Keep library, annotation and runs in this directory")
+    parser.add_option("-u", dest="update", action="store_true", help="Rewrite the expected checksums")
+    options, args = parser.parse_args()
+
+    os.environ["PERL_HASH_SEED"] = "0"
+    os.environ["PERL_PERTURB_KEYS"] = "0"
+    workdir = options.workdir or tempfile.mkdtemp(prefix="dario-regression-")
+    os.makedirs(workdir, exist_ok=True)
+    species = dict(config.SPECIES[SPECIES_CODE], dir=create_species(workdir))
+    config.SPECIES[SPECIES_CODE] = species
+    config.ANNOTATION_INDEX_DIR_WH = os.path.join(workdir, "annotation_index", "")
+    config.MODEL_STORE_PATH = os.path.join(workdir, "model_store", "")  # no models of other runs
+    config.WORKER_SOURCE_PATH = os.path.join(SOURCE_DIR, "")
+
+    library = os.path.join(workdir, "library.bed.gz")
+    synthetic_library.generate(library, READS, seed=SEED, annotation_dir=species["dir"])
+    failed = False
+    try:
+        runs = {}
+        for shards in (1, 4):
+            name = "single" if shards == 1 else "sharded"
+            run_analysis(os.path.join(workdir, name, "regression", ""), library, shards)
+            runs[name] = checksums(os.path.join(workdir, name, "regression", ""))
+        if options.update:
+            write_expected(runs["single"])
+        expected = read_expected()
+        for name, sums in runs.items():
+            differing = [output for output in OUTPUTS if sums[output] != expected.get(output)]
+            for output in differing:
+                print("%s run: %s differs" % (name, output))
+            failed = failed or bool(differing)
+    finally:
+        if not options.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+    if failed:
+        sys.exit("regression check failed" + ("" if options.workdir else ", keep the outputs with -k DIR"))
+    print("all %d outputs of both runs as expected" % len(OUTPUTS))
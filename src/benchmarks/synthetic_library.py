@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+"""
+Synthetic small RNA libraries for benchmarking the analysis, generated from the
+ncRNA and RNAz annotation of a species.
+
+Reads come as tags (distinct sequences) with heavy-tailed read counts. Most tags
+stack at the 5' ends of expressed ncRNAs, some fall into RNAz loci (candidates for
+the prediction) and the rest is scattered over the genome; a fraction of the tags
+maps to further random loci. Libraries are written as mapping loci BED files (one
+line per tag and locus, as map2bed.pl writes them) or as BAM files (one record per
+read, further loci in the XA tag).
+
+    python3 benchmarks/synthetic_library.py -n READS [-f bed|bam] [-m MULTIMAP_RATE] [-l LENGTHS] -o FILE
+"""
+
+import gzip
+import os
+import random
+import struct
+import sys
+import zlib
+from optparse import OptionParser
+
+EXAMPLE_ANNOTATION_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../../example/annotations/dm3/")
+
+# Read length distributions as {length: weight}, also "MIN-MAX" (uniform) or "LENGTH:WEIGHT,..." is accepted
+LENGTH_DISTRIBUTIONS = {
+    "mirna": {18: 1, 19: 2, 20: 4, 21: 12, 22: 30, 23: 14, 24: 6, 25: 3, 26: 2, 27: 1, 28: 1, 29: 1, 30: 1},
+    "pirna": {22: 1, 23: 2, 24: 4, 25: 8, 26: 14, 27: 16, 28: 12, 29: 6, 30: 3},
+    "uniform": dict((length, 1) for length in range(18, 31)),
+}
+# Shape of the Pareto distribution of the reads per tag (mean 6 reads), and its cap
+EXPRESSION_SKEW = 1.2
+MAX_TAG_READS = 100000
+# Maximal number of loci of a multi-mapping tag
+MAX_LOCI = 10
+# Share of the tags of an ncRNA starting at its 5' end, the others start anywhere in it
+FIVE_PRIME_RATE = 0.7
+# Genome beyond the last annotated locus of each chromosome
+CHROM_MARGIN = 100000
+
+BGZF_BLOCK_SIZE = 65280
+COMPLEMENT = str.maketrans("ACGT", "TGCA")
+SEQ_CODES = "=ACMGRSVTWYHKDBN"
+CIGAR_MATCH = 0
+
+
+def parse_lengths(spec):
+    """Read length distribution as (lengths, cumulative weights) from a name or spec of LENGTH_DISTRIBUTIONS"""
+    if spec in LENGTH_DISTRIBUTIONS:
+        weights = LENGTH_DISTRIBUTIONS[spec]
+    elif ":" in spec:
+        weights = dict((int(length), float(weight)) for length, weight in (item.split(":") for item in spec.split(",")))
+    else:
+        low, high = spec.split("-")
+        weights = dict((length, 1) for length in range(int(low), int(high) + 1))
+    lengths = sorted(weights)
+    cumulative, total = [], 0
+    for length in lengths:
+        total += weights[length]
+        cumulative.append(total)
+    return lengths, cumulative
+
+
+def read_loci(bed_file):
+    """Loci (chrom, start, end, strand) of a BED file"""
+    loci = []
+    with open(bed_file) as f:
+        for line in f:
+            cols = line.rstrip("\n").split("\t")
+            if len(cols) >= 3 and not line.startswith(("#", "track")):
+                loci.append((cols[0], int(cols[1]), int(cols[2]), cols[5] if len(cols) > 5 else "."))
+    return loci
+
+
+def chrom_sizes(*loci_lists):
+    """Chromosome sizes covering all loci"""
+    sizes = {}
+    for loci in loci_lists:
+        for chrom, _, end, _ in loci:
+            sizes[chrom] = max(sizes.get(chrom, 0), end + CHROM_MARGIN)
+    return sizes
+
+
+def iter_tags(ncrnas, rnaz, sizes, reads, lengths, multimap_rate=0.1, novel_rate=0.05, background_rate=0.2, seed=0):
+    """
+    Tags as (length, read count, loci) with loci as list of (chrom, start, end, strand), the first
+    one being the origin of the tag; the read counts add up to reads
+    """
+    rng = random.Random(seed)
+    read_lengths, length_weights = lengths
+    # Expression of the ncRNAs follows a power law of their (random) rank
+    ranks = list(range(1, len(ncrnas) + 1))
+    rng.shuffle(ranks)
+    ncrna_weights, total = [], 0.0
+    for rank in ranks:
+        total += 1.0 / rank
+        ncrna_weights.append(total)
+    chroms = sorted(sizes)
+    chrom_weights, total = [], 0
+    for chrom in chroms:
+        total += sizes[chrom]
+        chrom_weights.append(total)
+
+    def random_locus(length):
+        chrom = rng.choices(chroms, cum_weights=chrom_weights)[0]
+        start = rng.randrange(sizes[chrom] - length)
+        return chrom, start, start + length, rng.choice("+-")
+
+    def locus_in(region, length, at_five_prime):
+        chrom, start, end, strand = region
+        if strand not in ("+", "-"):
+            strand = rng.choice("+-")
+        if at_five_prime:
+            start = start if strand == "+" else max(0, end - length)
+        else:
+            start = rng.randrange(start, max(start + 1, end - length))
+        start = max(0, start + rng.randint(-2, 2))
+        return chrom, start, start + length, strand
+
+    remaining = reads
+    while remaining > 0:
+        count = min(int(rng.paretovariate(EXPRESSION_SKEW)), MAX_TAG_READS, remaining)
+        length = rng.choices(read_lengths, cum_weights=length_weights)[0]
+        origin = rng.random()
+        if origin < background_rate:
+            locus = random_locus(length)
+        elif origin < background_rate + novel_rate and rnaz:
+            locus = locus_in(rng.choice(rnaz), length, False)
+        else:
+            region = rng.choices(ncrnas, cum_weights=ncrna_weights)[0]
+            locus = locus_in(region, length, rng.random() < FIVE_PRIME_RATE)
+        loci = [locus]
+        if rng.random() < multimap_rate:
+            extra = 1
+            while extra < MAX_LOCI - 1 and rng.random() < 0.5:
+                extra += 1
+            loci.extend(random_locus(length) for _ in range(extra))
+        yield length, count, loci
+        remaining -= count
+
+
+def write_bed(tags, filename):
+    """Write tags as mapping loci BED (gzipped for *.gz), returns the number of tags"""
+    opener = gzip.open if filename.endswith(".gz") else open
+    count = 0
+    with opener(filename, "wt") as f:
+        for count, (_, reads, loci) in enumerate(tags, 1):
+            for chrom, start, end, strand in loci:
+                f.write("%s\t%d\t%d\ttag_%d\t%d\t%s\t%d\n" % (chrom, start, end, count, reads, strand, len(loci)))
+    return count
+
+
+class BGZFWriter:
+    """Writes data as the BGZF blocks of BAM files"""
+
+    def __init__(self, f, level=6):
+        self.f = f
+        self.level = level
+        self.buffer = bytearray()
+
+    def _write_block(self, data):
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+        compressed = compressor.compress(data) + compressor.flush()
+        self.f.write(b"\x1f\x8b\x08\x04\0\0\0\0\0\xff\x06\0BC\x02\0" + struct.pack("<H", len(compressed) + 25))
+        self.f.write(compressed + struct.pack("<II", zlib.crc32(data), len(data)))
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= BGZF_BLOCK_SIZE:
+            self._write_block(bytes(self.buffer[:BGZF_BLOCK_SIZE]))
+            del self.buffer[:BGZF_BLOCK_SIZE]
+
+    def close(self):
+        if self.buffer:
+            self._write_block(bytes(self.buffer))
+        self._write_block(b"")  # end of file marker
+
+
+def _encode_seq(seq):
+    if len(seq) % 2:
+        seq += "="
+    return bytes(SEQ_CODES.index(seq[i]) << 4 | SEQ_CODES.index(seq[i + 1]) for i in range(0, len(seq), 2))
+
+
+def write_bam(tags, filename, sizes, seed=0):
+    """Write tags as unsorted BAM, one record per read with a random sequence per tag; returns the number of tags"""
+    rng = random.Random(seed)
+    chroms = sorted(sizes)
+    ref_ids = dict((chrom, i) for i, chrom in enumerate(chroms))
+    with open(filename, "wb") as f:
+        bgzf = BGZFWriter(f)
+        text = "@HD\tVN:1.0\tSO:unsorted\n" + "".join("@SQ\tSN:%s\tLN:%d\n" % (c, sizes[c]) for c in chroms)
+        bgzf.write(b"BAM\x01" + struct.pack("<i", len(text)) + text.encode("ascii") + struct.pack("<i", len(chroms)))
+        for chrom in chroms:
+            bgzf.write(
+                struct.pack("<i", len(chrom) + 1) + chrom.encode("ascii") + b"\0" + struct.pack("<i", sizes[chrom])
+            )
+
+        count = read_number = 0
+        for count, (length, reads, loci) in enumerate(tags, 1):
+            seq = "".join(rng.choices("ACGT", k=length))
+            chrom, start, _, strand = loci[0]
+            if strand == "-":  # BAM stores the sequence of the forward strand
+                seq = seq[::-1].translate(COMPLEMENT)
+            # the read data following the read name
+            data = struct.pack("<I", length << 4 | CIGAR_MATCH) + _encode_seq(seq) + b"\xff" * length
+            if len(loci) > 1:
+                hits = "".join(
+                    "%s,%s%d,%dM,0;" % (c, hit_strand, hit_start + 1, length)
+                    for c, hit_start, _, hit_strand in loci[1:]
+                )
+                data += b"XAZ" + hits.encode("ascii") + b"\0"
+            fields = (ref_ids[chrom], start, 255, 0, 1, 16 if strand == "-" else 0, length, -1, -1, 0)
+            for _ in range(reads):
+                read_number += 1
+                name = b"r%d\0" % read_number
+                header = struct.pack("<iiBBHHHiiii", fields[0], fields[1], len(name), *fields[2:])
+                bgzf.write(struct.pack("<i", len(header) + len(name) + len(data)) + header + name + data)
+        bgzf.close()
+    return count
+
+
+def generate(filename, reads, file_format="bed", lengths="mirna", multimap_rate=0.1, annotation_dir=None, seed=0):
+    """Write a library of reads reads to filename, returns the number of tags"""
+    annotation_dir = annotation_dir or EXAMPLE_ANNOTATION_DIR
+    ncrnas = read_loci(os.path.join(annotation_dir, "ncRNAs.bed"))
+    rnaz_file = os.path.join(annotation_dir, "RNAz.bed")
+    rnaz = read_loci(rnaz_file) if os.path.exists(rnaz_file) else []
+    sizes = chrom_sizes(ncrnas, rnaz)
+    tags = iter_tags(ncrnas, rnaz, sizes, reads, parse_lengths(lengths), multimap_rate, seed=seed)
+    if file_format == "bam":
+        return write_bam(tags, filename, sizes, seed)
+    return write_bed(tags, filename)
+
+
+if __name__ == "__main__":
+    parser = OptionParser("usage: %prog [options]")
+    parser.add_option("-n", dest="reads", type="float", default=1e6, help="Number of reads (e.g. 1e6)")
+    parser.add_option("-f", dest="format", default="bed", choices=["bed", "bam"], help="bed or bam")
+    parser.add_option(
+        "-l", dest="lengths", default="mirna", help="Read lengths: mirna, pirna, uniform, MIN-MAX or L:W,..."
+    )
+    parser.add_option("-m", dest="multimap_rate", type="float", default=0.1, help="Share of multi-mapping tags")
+    parser.add_option("-a", dest="annotation_dir", help="Directory with ncRNAs.bed and RNAz.bed (default: dm3 example)")
+    parser.add_option("-s", dest="seed", type="int", default=0, help="Random seed")
+    parser.add_option("-o", dest="output", help="Output file (BED gzipped if ending with .gz)")
+    options, args = parser.parse_args()
+    if not options.output:
+        parser.error("no output file given")
+
+    tags = generate(
+        options.output,
+        int(options.reads),
+        options.format,
+        options.lengths,
+        options.multimap_rate,
+        options.annotation_dir,
+        options.seed,
+    )
+    print("%d reads in %d tags written to %s" % (int(options.reads), tags, options.output), file=sys.stderr)
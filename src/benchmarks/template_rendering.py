@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+Per-rendering cost of the Mako templates: compiling the template for every
+rendering (as before templating.py) against the shared compiled templates.
+
+    python3 benchmarks/template_rendering.py [-n RENDERINGS] [-t TEMPLATES_DIR]
+"""
+
+import os
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+from mako.lookup import TemplateLookup
+from mako.template import Template
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # DARIO sources
+import config
+
+config.TEMPLATE_MODULE_PATH = tempfile.mkdtemp(prefix="dario-mako-") + "/"
+import templating
+
+# Templates rendered per page view (wait page) and per ncRNA type of a job (expression table)
+CASES = {
+    "job_wait": dict(
+        found="Your job is at position 3 of the queue.",
+        pagelink="wait/0123456789abcdef",
+        events_url=config.WEB_URL + "wait/0123456789abcdef/events",
+    ),
+    "result_expression_table": dict(
+        ncrna_type="miRNA",
+        rundir="",
+        total=500,
+        page_size=config.TABLE_PAGE_SIZE,
+        api_url=config.WEB_URL + "api/result/0123456789abcdef/ncRNA/miRNA",
+        ncrna_expression=[
+            ["chr1", str(1000 * i), str(1000 * i + 80), "mir-%d" % i, "0", "+", "miRNA", "12", "3.4", "0.1", "http://"]
+            for i in range(500)
+        ],
+    ),
+}
+
+
+def render_uncached(templates_path, template_name, **kwargs):
+    """Rendering as done before templating.py"""
+    lookup = TemplateLookup(directories=[templates_path])
+    template = Template(filename=templates_path + template_name + ".mako.html", lookup=lookup)
+    return template.render(**kwargs)
+
+
+def measure(render, templates_path, template_name, renderings, kwargs):
+    """Milliseconds per rendering"""
+    start = time.perf_counter()
+    for _ in range(renderings):
+        render(templates_path, template_name, WEBPATH=config.WEB_URL, phase=3, **kwargs)
+    return (time.perf_counter() - start) * 1000 / renderings
+
+
+if __name__ == "__main__":
+    parser = OptionParser("usage: %prog [options]")
+    parser.add_option("-n", dest="renderings", type="int", default=200, help="Renderings per template")
+    parser.add_option(
+        "-t",
+        dest="templates_path",
+        default=os.path.dirname(os.path.dirname(os.path.abspath(__file__))) + "/templates/",
+        help="Templates directory",
+    )
+    options, args = parser.parse_args()
+
+    start = time.perf_counter()
+    count = templating.preload(options.templates_path)
+    print("preload: %d templates in %.1f ms" % (count, (time.perf_counter() - start) * 1000))
+    print("%-26s %12s %12s %8s" % ("template", "before [ms]", "after [ms]", "speedup"))
+    for name, kwargs in CASES.items():
+        before = measure(render_uncached, options.templates_path, name, options.renderings, kwargs)
+        after = measure(templating.render, options.templates_path, name, options.renderings, kwargs)
+        print("%-26s %12.3f %12.3f %7.1fx" % (name, before, after, before / after))
@@ -0,0 +1,522 @@
+"""
+Classification of read clusters into ncRNA classes by their block pattern, in
+process with numpy (formerly trainClassifier.pl and runClassifier.pl with WEKA).
+
+The features of a cluster (clustering.py output with at least two blocks) describe
+its blocks: their distances, lengths, heights relative to the cluster and overlap.
+As the WEKA AttributeSelectedClassifier did, training selects a subset of the
+features (CFS subset evaluation with best first search) and builds a random forest
+on it. Models are stored as numpy .npz archives. The statistics file holds the
+error on the training data and of a stratified cross-validation in WEKA's layout,
+as parsed by analysis.get_classifier_statistics(); for a model reused from the
+model store (model_store.py) it holds the error of that model on the training data.
+
+    python3 classifier.py train CLUSTERS.flagged MODEL STATISTICS
+    python3 classifier.py predict CLUSTERS MODEL PREDICTIONS.bed
+(CLUSTERS in the text format or a clusters table of columnar.py)
+"""
+
+import sys
+import time
+
+import numpy as np
+
+import columnar
+
+FEATURES = (
+    "meanDist",
+    "meanBlockLength",
+    "maxDist",
+    "blockCount",
+    "minBlockLength",
+    "maxHeight",
+    "clusterLength",
+    "maxBlockLength",
+    "blockOverlapRange",
+    "minHeight",
+    "minDist",
+    "blockOverlapHeight",
+)
+CLASSES = ("miRNA", "snoRNA_HACA", "snoRNA_CD", "tRNA")
+MIN_BLOCKS = 2
+# Column of the ncRNA type in the cluster headers of flagKnownClusters.pl
+FLAGGED_TYPE_COLUMN = 9
+TREES = 100
+FOLDS = 10
+SEED = 1
+# Smallest information gain of a split
+MIN_GAIN = 1e-6
+# Bins of the features for the symmetric uncertainty of CFS
+CFS_BINS = 10
+# Non-improving expansions after which the best first search stops
+CFS_STALE = 5
+# Title of the evaluation in the statistics of a stored model, see write_statistics()
+STORED_MODEL_EVALUATION = "Error of the stored model on the training data"
+
+
+def read_clusters(filename, type_column=None):
+    """
+    Clusters of at least MIN_BLOCKS blocks of a clusters file as dict of arrays (chrom, start, end,
+    strand, height, blocks, type) and their blocks (block_cluster, block_start, block_end, block_height).
+    type is the ncRNA type of column type_column of the header if one of CLASSES, else "NA".
+    """
+    header = dict((name, []) for name in ("chrom", "start", "end", "strand", "height", "blocks", "type"))
+    blocks = dict((name, []) for name in ("block_cluster", "block_start", "block_end", "block_height"))
+    remaining = 0
+    with open(filename) as f:
+        for line in f:
+            cols = line.split()
+            if line.startswith(">"):
+                remaining = 0
+                if int(cols[7]) < MIN_BLOCKS:
+                    continue
+                remaining = int(cols[7])
+                for name, col in zip(("chrom", "start", "end", "strand", "height", "blocks"), cols[1:6] + cols[7:8]):
+                    header[name].append(col)
+                ncrna_type = cols[type_column] if type_column is not None and len(cols) > type_column else "NA"
+                header["type"].append(ncrna_type if ncrna_type in CLASSES else "NA")
+            elif remaining and not line.startswith("#"):
+                remaining -= 1
+                blocks["block_cluster"].append(len(header["start"]) - 1)
+                for name, col in zip(("block_start", "block_end", "block_height"), (cols[2], cols[3], cols[5])):
+                    blocks[name].append(col)
+
+    clusters = {"chrom": np.array(header["chrom"], dtype=object), "strand": np.array(header["strand"], dtype=object)}
+    clusters["type"] = np.array(header["type"], dtype=object)
+    for name in ("start", "end", "blocks", "block_cluster", "block_start", "block_end"):
+        clusters[name] = np.array(header.get(name, blocks.get(name)), dtype=np.int64)
+    for name in ("height", "block_height"):
+        clusters[name] = np.array(header.get(name, blocks.get(name)), dtype=np.float64)
+    return clusters
+
+
+def _printed(heights):
+    """Heights with the two decimals of the .clusters text format"""
+    return np.array(["%.2f" % height for height in heights], dtype=np.float64)
+
+
+def read_cluster_table(path):
+    """read_clusters() for a clusters table of columnar.py (clusters without ncRNA type)"""
+    table = columnar.read_table(path)
+    first, heights = columnar.cluster_heights(table)
+    counts = np.diff(np.append(first, len(table["start"])))
+    kept = counts >= MIN_BLOCKS
+    block_kept = np.repeat(kept, counts)
+    return {
+        "chrom": table["chrom"][first[kept]],
+        "strand": table["strand"][first[kept]],
+        "type": np.full(kept.sum(), "NA", dtype=object),
+        "start": np.minimum.reduceat(table["start"], first)[kept] if len(first) else np.zeros(0, dtype=np.int64),
+        "end": np.maximum.reduceat(table["end"], first)[kept] if len(first) else np.zeros(0, dtype=np.int64),
+        "height": _printed(heights[kept]),
+        "blocks": counts[kept],
+        "block_cluster": np.repeat(np.cumsum(kept) - 1, counts)[block_kept],
+        "block_start": np.asarray(table["start"][block_kept]),
+        "block_end": np.asarray(table["end"][block_kept]),
+        "block_height": _printed(table["height"][block_kept]),
+    }
+
+
+def _block_stats(values, first):
+    """Maximum, minimum and mean of the values of each cluster, values grouped by cluster starting at first"""
+    counts = np.diff(np.append(first, len(values)))
+    return (
+        np.maximum.reduceat(values, first),
+        np.minimum.reduceat(values, first),
+        np.add.reduceat(values, first) / counts,
+    )
+
+
+def features(clusters):
+    """Feature matrix (clusters x FEATURES) of clusters of read_clusters()"""
+    n = len(clusters["start"])
+    if not n:
+        return np.zeros((0, len(FEATURES)))
+    cluster, starts, ends = clusters["block_cluster"], clusters["block_start"], clusters["block_end"]
+    first = np.searchsorted(cluster, np.arange(n))
+    values = {"blockCount": clusters["blocks"], "clusterLength": clusters["end"] - clusters["start"]}
+
+    values["maxHeight"], values["minHeight"], _ = _block_stats(
+        clusters["block_height"] / clusters["height"][cluster], first
+    )
+    lengths = (ends - starts).astype(np.float64)
+    values["maxBlockLength"], values["minBlockLength"], values["meanBlockLength"] = _block_stats(lengths, first)
+
+    # distances between consecutive blocks ordered by start and end, one less than blocks per cluster
+    order = np.lexsort((ends, starts, cluster))
+    distances = (starts[order][1:] - ends[order][:-1])[cluster[order][1:] == cluster[order][:-1]]
+    values["maxDist"], values["minDist"], values["meanDist"] = _block_stats(
+        distances.astype(np.float64), first - np.arange(n)
+    )
+
+    # number of blocks covering each position of a cluster, both ends included
+    sizes = clusters["end"] - clusters["start"] + 1
+    offsets = np.cumsum(sizes) - sizes
+    changes = np.zeros(sizes.sum() + 1, dtype=np.int64)
+    np.add.at(changes, offsets[cluster] + np.clip(starts - clusters["start"][cluster], 0, sizes[cluster]), 1)
+    np.add.at(changes, offsets[cluster] + np.clip(ends - clusters["start"][cluster] + 1, 0, sizes[cluster]), -1)
+    coverage = np.cumsum(changes)[:-1]
+    values["blockOverlapRange"] = np.add.reduceat((coverage >= 2).astype(np.int64), offsets) / np.add.reduceat(
+        (coverage >= 1).astype(np.int64), offsets
+    )
+    values["blockOverlapHeight"] = np.maximum.reduceat(coverage, offsets)
+    return np.column_stack([values[name].astype(np.float64) for name in FEATURES])
+
+
+def class_indexes(types):
+    """Indexes of the ncRNA types in CLASSES"""
+    return np.array([CLASSES.index(t) for t in types], dtype=np.int64)
+
+
+def _entropy(counts):
+    """Entropy (bits) of each row of class counts"""
+    totals = counts.sum(axis=-1, keepdims=True)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        p = np.where(counts > 0, counts / totals, 1.0)
+    return -np.sum(np.where(counts > 0, p * np.log2(p), 0.0), axis=-1)
+
+
+def _xlogx(counts):
+    return counts * np.log2(np.maximum(counts, 1))
+
+
+def _best_splits(X, y, node, n_nodes, n_classes):
+    """
+    Information gain and threshold (x < threshold goes left) of the best split of the instances of each node
+    on each column of X, as arrays nodes x columns; gain 0 where a column does not separate the instances
+    """
+    gains = np.zeros((n_nodes, X.shape[1]))
+    thresholds = np.zeros((n_nodes, X.shape[1]))
+    if not len(y):
+        return gains, thresholds
+    sizes = np.bincount(node, minlength=n_nodes)
+    first = np.cumsum(sizes) - sizes
+    totals = np.bincount(node * n_classes + y, minlength=n_nodes * n_classes).reshape(n_nodes, n_classes)
+    # entropies times number of instances, n * H(counts) = n log n - sum(c log c)
+    parent = _xlogx(sizes) - _xlogx(totals).sum(axis=1)
+    for column in range(X.shape[1]):
+        order = np.lexsort((X[:, column], node))
+        xs, ys, nodes = X[order, column], y[order], node[order]
+        counts = np.cumsum(np.eye(n_classes)[ys], axis=0)
+        # class counts of the instances of a node up to each position, and after it
+        left = counts - np.vstack([np.zeros((1, n_classes)), counts])[first][nodes]
+        right = totals[nodes] - left
+        n_left = np.arange(len(ys)) - first[nodes] + 1
+        children = _xlogx(n_left) + _xlogx(sizes[nodes] - n_left) - _xlogx(left).sum(axis=1) - _xlogx(right).sum(axis=1)
+        valid = np.zeros(len(ys), dtype=bool)
+        valid[:-1] = (nodes[1:] == nodes[:-1]) & (xs[1:] > xs[:-1])
+        children[~valid] = np.inf
+        best = np.lexsort((children, nodes))[np.minimum(first, len(ys) - 1)]  # first best position of each node
+        found = (sizes > 0) & np.isfinite(children[best])
+        gains[:, column] = np.where(found, (parent - children[best]) / np.maximum(sizes, 1), 0.0)
+        thresholds[:, column] = np.where(found, (xs[best] + xs[np.minimum(best + 1, len(xs) - 1)]) / 2, 0.0)
+    return gains, thresholds
+
+
+def _build_tree(X, y, n_classes, k, rng):
+    """
+    Unpruned tree of WEKA's RandomTree as node arrays: each node splits on the best of k random features
+    by information gain, or of the other features if none of them separates its instances; leaves hold
+    class distributions. The tree grows one level at a time.
+    """
+    feature, threshold, left, right, distribution = [], [], [], [], []
+    instances = np.arange(len(y))  # instances of inner nodes of the current level
+    node = np.zeros(len(y), dtype=np.int64)  # their node, numbered within the level
+    level_start, n_nodes = 0, 1
+    while len(instances):
+        level_size = n_nodes - level_start
+        counts = np.bincount(node * n_classes + y[instances], minlength=level_size * n_classes)
+        counts = counts.reshape(level_size, n_classes).astype(np.float64)
+        distribution.append(counts / counts.sum(axis=1, keepdims=True))
+
+        mixed = (np.count_nonzero(counts, axis=1) > 1)[node]
+        gains, thresholds = _best_splits(X[instances[mixed]], y[instances[mixed]], node[mixed], level_size, n_classes)
+        tried = np.argsort(rng.random(gains.shape), axis=1)  # features in random order per node
+        tried_gains = np.take_along_axis(gains, tried, axis=1)
+        choice = np.argmax(tried_gains[:, :k], axis=1)
+        if k < X.shape[1]:
+            choice = np.where(
+                tried_gains[:, :k].max(axis=1) > MIN_GAIN, choice, k + np.argmax(tried_gains[:, k:], axis=1)
+            )
+        rows = np.arange(level_size)
+        level_feature = np.where(tried_gains[rows, choice] > MIN_GAIN, tried[rows, choice], -1)
+        inner = level_feature >= 0
+        level_threshold = np.where(inner, thresholds[rows, np.maximum(level_feature, 0)], 0.0)
+        children = n_nodes + 2 * (np.cumsum(inner) - 1)
+        feature.append(level_feature)
+        threshold.append(level_threshold)
+        left.append(np.where(inner, children, -1))
+        right.append(np.where(inner, children + 1, -1))
+
+        keep = inner[node]
+        instances, node = instances[keep], node[keep]
+        goes_left = X[instances, level_feature[node]] < level_threshold[node]
+        node = children[node] + ~goes_left - n_nodes
+        level_start, n_nodes = n_nodes, n_nodes + 2 * int(inner.sum())
+    return [np.concatenate(values) for values in (feature, threshold, left, right, distribution)]
+
+
+def _random_features(n_features):
+    """Features tried per split, as WEKA's RandomForest -K 0"""
+    return int(np.log2(n_features + 1)) + 1
+
+
+def train_forest(X, y, trees=TREES, seed=SEED):
+    """Random forest of bagged trees as dict of node arrays, with the out of bag error"""
+    rng = np.random.default_rng(seed)
+    n, n_classes = len(y), len(CLASSES)
+    k = _random_features(X.shape[1])
+    trees_nodes, roots = [], []
+    oob_votes = np.zeros((n, n_classes))
+    offset = 0
+    for _ in range(trees):
+        sample = rng.integers(0, n, n)
+        feature, threshold, left, right, distribution = _build_tree(X[sample], y[sample], n_classes, k, rng)
+        out_of_bag = np.setdiff1d(np.arange(n), sample)
+        oob_votes[out_of_bag] += _tree_distribution(feature, threshold, left, right, distribution, 0, X[out_of_bag])
+        left, right = np.where(left >= 0, left + offset, -1), np.where(right >= 0, right + offset, -1)
+        trees_nodes.append((feature, threshold, left, right, distribution))
+        roots.append(offset)
+        offset += len(feature)
+    forest = dict(
+        (name, np.concatenate(values))
+        for name, values in zip(("feature", "threshold", "left", "right", "distribution"), zip(*trees_nodes))
+    )
+    forest["roots"] = np.array(roots, dtype=np.int64)
+    voted = oob_votes.sum(axis=1) > 0
+    forest["oob_error"] = np.float64(np.mean(oob_votes[voted].argmax(axis=1) != y[voted]) if voted.any() else 0.0)
+    return forest
+
+
+def _tree_distribution(feature, threshold, left, right, distribution, roots, X):
+    """Leaf distributions of the instances (rows of X) in the trees starting at roots"""
+    node = np.broadcast_to(roots, (len(X),) + np.shape(roots)).copy()
+    rows = np.arange(len(X)).reshape((-1,) + (1,) * np.ndim(roots))
+    while True:
+        inner = feature[node] >= 0
+        if not inner.any():
+            return distribution[node]
+        goes_left = X[rows, np.maximum(feature[node], 0)] < threshold[node]
+        node = np.where(inner, np.where(goes_left, left[node], right[node]), node)
+
+
+def _discretize(x, bins=CFS_BINS):
+    edges = np.unique(np.quantile(x, np.linspace(0, 1, bins + 1)[1:-1]))
+    return np.searchsorted(edges, x, side="right")
+
+
+def _symmetric_uncertainty(a, b):
+    joint = np.bincount(a * (b.max() + 1) + b).astype(np.float64)
+    h_a = _entropy(np.bincount(a).astype(np.float64))
+    h_b = _entropy(np.bincount(b).astype(np.float64))
+    return 2 * (h_a + h_b - _entropy(joint)) / (h_a + h_b) if h_a + h_b > 0 else 0.0
+
+
+def select_features(X, y):
+    """
+    Indexes of the features selected by CFS (correlation based feature subset selection) with a forward
+    best first search, correlations measured by symmetric uncertainty of the binned features
+    """
+    binned = [_discretize(X[:, f]) for f in range(X.shape[1])]
+    with_class = np.array([_symmetric_uncertainty(b, y) for b in binned])
+    between = np.array([[_symmetric_uncertainty(a, b) for b in binned] for a in binned])
+
+    def merit(subset):
+        subset = list(subset)
+        correlation = between[np.ix_(subset, subset)].sum()
+        return with_class[subset].sum() / np.sqrt(correlation) if correlation > 0 else 0.0
+
+    candidates, seen = [(0.0, ())], set()
+    best_merit, best = 0.0, ()
+    stale = 0
+    while candidates and stale < CFS_STALE:
+        candidates.sort()
+        _, subset = candidates.pop()
+        improved = False
+        for f in range(X.shape[1]):
+            expanded = tuple(sorted(subset + (f,)))
+            if f in subset or expanded in seen:
+                continue
+            seen.add(expanded)
+            expanded_merit = merit(expanded)
+            candidates.append((expanded_merit, expanded))
+            if expanded_merit > best_merit + 1e-5:
+                best_merit, best, improved = expanded_merit, expanded, True
+        stale = 0 if improved else stale + 1
+    return np.array(best or range(X.shape[1]), dtype=np.int64)
+
+
+def train(X, y, trees=TREES, seed=SEED):
+    """Model (dict of arrays) of selected features and random forest for feature matrix X and class indexes y"""
+    selected = select_features(X, y)
+    model = train_forest(X[:, selected], y, trees, seed)
+    model["selected"] = selected
+    return model
+
+
+def predict(model, X):
+    """Class probabilities (instances x CLASSES) of the instances of feature matrix X"""
+    if not len(X):
+        return np.zeros((0, len(CLASSES)))
+    votes = _tree_distribution(
+        model["feature"],
+        model["threshold"],
+        model["left"],
+        model["right"],
+        model["distribution"],
+        model["roots"],
+        X[:, model["selected"]],
+    )
+    return votes.mean(axis=1)
+
+
+def cross_validate(X, y, folds=FOLDS, trees=TREES, seed=SEED):
+    """Confusion matrix (actual x predicted) of a stratified cross-validation of train()"""
+    if len(y) < folds:
+        raise ValueError("Too few training clusters (%d) for a %d-fold cross-validation" % (len(y), folds))
+    rng = np.random.default_rng(seed)
+    order = rng.permutation(len(y))
+    order = order[np.argsort(y[order], kind="stable")]
+    fold = np.empty(len(y), dtype=np.int64)
+    fold[order] = np.arange(len(y)) % folds
+    confusion = np.zeros((len(CLASSES), len(CLASSES)), dtype=np.int64)
+    for i in range(folds):
+        model = train(X[fold != i], y[fold != i], trees, seed)
+        np.add.at(confusion, (y[fold == i], predict(model, X[fold == i]).argmax(axis=1)), 1)
+    return confusion
+
+
+def save_model(model, filename):
+    with open(filename, "wb") as f:
+        np.savez(f, **model)
+
+
+def load_model(filename):
+    with np.load(filename) as archive:
+        return dict(archive)
+
+
+def _evaluation_lines(title, confusion):
+    """Summary and confusion matrix of an evaluation in WEKA's layout"""
+    total = confusion.sum()
+    correct = np.trace(confusion)
+    expected = np.sum(confusion.sum(axis=0) * confusion.sum(axis=1)) / float(total) ** 2
+    kappa = (correct / float(total) - expected) / (1 - expected) if expected < 1 else 1.0
+    width = max(3, len(str(confusion.max()))) + 1
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    lines = [
+        "=== %s ===" % title,
+        "",
+        "Correctly Classified Instances     %8d          %8.4g %%" % (correct, 100.0 * correct / total),
+        "Incorrectly Classified Instances   %8d          %8.4g %%"
+        % (total - correct, 100.0 * (total - correct) / total),
+        "Kappa statistic                    %8.4f" % kappa,
+        "Total Number of Instances          %8d" % total,
+        "",
+        "",
+        "=== Confusion Matrix ===",
+        "",
+        "".join(letter.rjust(width) for letter in letters[: len(CLASSES)]) + "   <-- classified as",
+    ]
+    for i, name in enumerate(CLASSES):
+        lines.append(
+            "".join(str(n).rjust(width) for n in confusion[i]) + " | %s = %s" % (letters[i].rjust(width - 1), name)
+        )
+    return lines + ["", ""]
+
+
+def confusion_matrix(model, X, y):
+    """Confusion matrix (true class x predicted class) of a model on the clusters X of classes y"""
+    confusion = np.zeros((len(CLASSES), len(CLASSES)), dtype=np.int64)
+    np.add.at(confusion, (y, predict(model, X).argmax(axis=1)), 1)
+    return confusion
+
+
+def write_statistics(filename, training_file, model, training_confusion, cv_confusion, seconds, fingerprint=None):
+    """
+    Write the statistics of a model. For a model reused from the model store under fingerprint,
+    training_confusion is the error of that model on the training set, and cv_confusion is None.
+    """
+    with open(filename, "w") as f:
+        f.write("# classifier.py output generated %s\n" % time.strftime("%H:%M:%S, %a %b %d, %Y"))
+        f.write("# training set: %s\n" % training_file)
+        if fingerprint:
+            f.write("# model reused from the model store, fingerprint: %s\n" % fingerprint)
+        f.write("#\n\n")
+        f.write(
+            "Selected attributes: %s : %d\n" % (",".join(str(i + 1) for i in model["selected"]), len(model["selected"]))
+        )
+        for i in model["selected"]:
+            f.write("                     %s\n" % FEATURES[i])
+        f.write("\n\nClassifier Model\n")
+        f.write(
+            "Random forest of %d trees, each constructed while considering %d random features.\n"
+            % (len(model["roots"]), _random_features(len(model["selected"])))
+        )
+        f.write("Out of bag error: %.4f\n\n\n\n" % model["oob_error"])
+        if fingerprint:
+            f.write("\n".join(_evaluation_lines(STORED_MODEL_EVALUATION, training_confusion)) + "\n")
+            return
+        f.write("Time taken to build model: %.2f seconds\n\n" % seconds)
+        f.write("\n".join(_evaluation_lines("Error on training data", training_confusion)) + "\n")
+        f.write("\n".join(_evaluation_lines("Stratified cross-validation", cv_confusion)) + "\n")
+
+
+def read_training_set(training_file):
+    """Feature matrix and class indexes of the known ncRNA clusters of a flagKnownClusters.pl output"""
+    clusters = read_clusters(training_file, FLAGGED_TYPE_COLUMN)
+    known = clusters["type"] != "NA"
+    return features(clusters)[known], class_indexes(clusters["type"][known])
+
+
+def train_file(training_file, model_file, statistics_file, trees=TREES, folds=FOLDS):
+    """
+    Train a model on the known ncRNA clusters of a flagKnownClusters.pl output, write it and its statistics.
+    Raises ValueError if there are too few clusters for the cross-validation.
+    """
+    X, y = read_training_set(training_file)
+    cv_confusion = cross_validate(X, y, folds, trees)
+    start = time.time()
+    model = train(X, y, trees)
+    seconds = time.time() - start
+    training_confusion = confusion_matrix(model, X, y)
+    save_model(model, model_file)
+    write_statistics(statistics_file, training_file, model, training_confusion, cv_confusion, seconds)
+    return model
+
+
+def _format_probability(p):
+    return ("%.3f" % p).rstrip("0").rstrip(".")
+
+
+def predict_file(clusters_file, model_file, predictions_file):
+    """Write the predicted class of each cluster as BED line (numbered by class, score = probability)"""
+    clusters = read_cluster_table(clusters_file) if columnar.is_table(clusters_file) else read_clusters(clusters_file)
+    probabilities = predict(load_model(model_file), features(clusters))
+    predicted = probabilities.argmax(axis=1) if len(probabilities) else np.zeros(0, dtype=np.int64)
+    with open(predictions_file, "w") as out:
+        for c, i in enumerate(np.flatnonzero(clusters["type"] == "NA"), 1):
+            ncrna_type = CLASSES[predicted[i]]
+            out.write(
+                "%s\t%d\t%d\t%s_%d\t%s\t\t%s\t%s\n"
+                % (
+                    clusters["chrom"][i],
+                    clusters["start"][i],
+                    clusters["end"][i],
+                    ncrna_type,
+                    c,
+                    _format_probability(probabilities[i, predicted[i]]),
+                    clusters["strand"][i],
+                    ncrna_type,
+                )
+            )
+    return len(predicted)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 5 or sys.argv[1] not in ("train", "predict"):
+        sys.exit(__doc__)
+    if sys.argv[1] == "train":
+        train_file(*sys.argv[2:])
+    else:
+        predict_file(*sys.argv[2:])
@@ -0,0 +1,178 @@
+"""
+Detection of read clusters and blocks with numpy, reimplementing blockbuster
+(analysis/blockbuster-source/blockbuster.c) as it was run with -scale 0.4.
+
+Reads (a reads table of columnar.py, in order) form a cluster as long as chromosome and strand stay
+the same and each read starts at most DISTANCE bases after the end of the previous
+one. Clusters higher than MIN_CLUSTER_HEIGHT (and the last cluster of the genome,
+as in blockbuster) are split into blocks one at a time: the reads not yet assigned are
+smoothed into a sum of Gaussians, and the reads around its highest peak form the
+next block. Blocks of at least MIN_BLOCK_HEIGHT are written to a clusters table,
+which columnar.write_clusters() prints in blockbuster's .clusters format:
+    >cluster_N  chrom  start  end  strand  height  tags  blocks
+    N  chrom  start  end  strand  height  tags    (one line per block)
+Sums are taken in the order blockbuster added them up, so the output is the same.
+"""
+
+import numpy as np
+
+import columnar
+
+SCALE = 0.4  # standard deviation of the Gaussian of a read, relative to half its length
+DISTANCE = 30
+MIN_CLUSTER_HEIGHT = 10
+MIN_BLOCK_HEIGHT = 2
+MERGE = 0  # reads with a mean this close to the peak join its block anyway
+TAG_FILTER = 0  # reads with a lower height are ignored
+PI = 3.14159265  # as in blockbuster
+
+
+def _sequential_sum(values):
+    """Sum adding up one value after the other (numpy's sum adds pairwise)"""
+    return float(np.cumsum(values)[-1]) if len(values) else 0.0
+
+
+def _gaussians(means, variances, heights, size):
+    """
+    Contributions (read, position, value) of the Gaussians of reads to the positions of a cluster,
+    in the order blockbuster's superGaussian added them up
+    """
+    counts = np.floor(2 * variances).astype(np.int64) + 1  # offsets 0 .. 2 * variance of each read
+    read = np.repeat(np.arange(len(means)), counts)
+    offset = np.arange(len(read)) - np.repeat(np.cumsum(counts) - counts, counts)
+    variance = variances[read]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        value = heights[read] * (
+            (1 / (variance * np.sqrt(2 * PI))) * np.exp(-1 * offset.astype(float) ** 2 / (2 * variance) ** 2)
+        )
+    # each offset adds to the position right and then left of the mean
+    right = means[read] + offset
+    left = means[read] - offset
+    positions = np.empty(2 * len(read), dtype=np.int64)
+    positions[0::2] = right
+    positions[1::2] = left
+    valid = np.empty(2 * len(read), dtype=bool)
+    valid[0::2] = right < size
+    valid[1::2] = (left > 0) & (left < size)
+    return np.repeat(read, 2)[valid], positions[valid], np.repeat(value, 2)[valid]
+
+
+def _highest_peak(distribution):
+    """First position of the maximum of the distribution, 0 if it is not positive"""
+    if not len(distribution):
+        return 0
+    peak = int(np.argmax(distribution))
+    if np.isnan(distribution[peak]):
+        distribution = np.where(np.isnan(distribution), -np.inf, distribution)
+        peak = int(np.argmax(distribution))
+    return peak if distribution[peak] > 0 else 0
+
+
+def _weighted_deviation(means, heights):
+    """Standard deviation of the means, each counted ceil(height) times"""
+    weights = np.ceil(np.maximum(heights, 0))
+    total = weights.sum()
+    if total == 0:
+        return 0.0
+    mean = np.sum(weights * means) / total
+    return float(np.sqrt(np.sum(weights * (means - mean) ** 2) / total))
+
+
+def _assign_block(means, variances, heights, peak, merge):
+    """Reads of the block at peak: reads whose Gaussian, widened by the deviation of the block so far, covers it"""
+    block = np.zeros(len(means), dtype=bool)
+    deviation = 0.0
+    while True:
+        added = ~block & (
+            ((means - variances - deviation <= peak) & (means + variances + deviation >= peak))
+            | ((means >= peak - merge) & (means <= peak + merge))
+        )
+        if not added.any():
+            return block
+        block |= added
+        deviation = _weighted_deviation(means[block], heights[block])
+
+
+def assign_blocks(starts, ends, heights, scale=SCALE, merge=MERGE):
+    """Block numbers (1, 2, ...) of the reads of a cluster, 0 for reads left out"""
+    cluster_start = int(starts.min())
+    size = max(int(ends.max()) - cluster_start, 0)
+    means = ((starts + ends) // 2 - cluster_start).astype(float)
+    variances = scale * (np.abs(ends - starts) // 2)
+    read, position, value = _gaussians(means, variances, heights, size)
+    blocks = np.zeros(len(starts), dtype=np.int64)
+    block = 1
+    while True:
+        free = blocks == 0
+        if not free.any():
+            return blocks
+        selected = free[read]
+        peak = _highest_peak(np.bincount(position[selected], weights=value[selected], minlength=size))
+        free = np.flatnonzero(free)
+        members = _assign_block(means[free], variances[free], heights[free], peak, merge)
+        if not members.any():
+            return blocks
+        blocks[free[members]] = block
+        block += 1
+
+
+def cluster_blocks(starts, ends, heights, blocks, min_block_height=MIN_BLOCK_HEIGHT):
+    """(start, end, height, tags) of the blocks of a cluster high enough to be reported"""
+    rows = []
+    for block in range(1, blocks.max() + 1 if len(blocks) else 1):
+        members = blocks == block
+        height = _sequential_sum(heights[members])
+        if height >= min_block_height:
+            rows.append((int(starts[members].min()), int(ends[members].max()), height, int(members.sum())))
+    return rows
+
+
+def cluster_bounds(chroms, strands, starts, ends, distance=DISTANCE):
+    """Indexes of the first read of each cluster, and the end of the last one"""
+    if not len(starts):
+        return np.zeros(1, dtype=np.int64)
+    new = np.ones(len(starts), dtype=bool)
+    new[1:] = (chroms[1:] != chroms[:-1]) | (strands[1:] != strands[:-1]) | (starts[1:] - ends[:-1] > distance)
+    return np.append(np.flatnonzero(new), len(starts))
+
+
+def write_clusters(
+    reads_file,
+    output_file,
+    scale=SCALE,
+    distance=DISTANCE,
+    min_cluster_height=MIN_CLUSTER_HEIGHT,
+    min_block_height=MIN_BLOCK_HEIGHT,
+    final=True,
+):
+    """
+    Cluster the reads of a reads table (height = expr, sorted by chromosome, strand and start)
+    into the clusters table output_file, see columnar.py. final tells whether the reads end
+    the genome, i.e. whether their last cluster is exempt from min_cluster_height.
+    """
+    reads = columnar.read_table(reads_file, ("chrom", "start", "end", "strand", "expr"))
+    keep = reads["expr"] >= TAG_FILTER
+    chroms, strands = reads["chrom"][keep], reads["strand"][keep]
+    starts, ends, heights = reads["start"][keep], reads["end"][keep], reads["expr"][keep]
+
+    bounds = cluster_bounds(chroms, strands, starts, ends, distance)
+    cluster_heights = np.add.reduceat(heights, bounds[:-1]) if len(heights) else np.zeros(0)
+    count = 0
+    with columnar.TableWriter(output_file, "clusters") as out:
+        for i, (first, last) in enumerate(zip(bounds[:-1], bounds[1:])):
+            # blockbuster holds the reads of a cluster in a list in reverse order
+            cluster = slice(last - 1, first - 1 if first > 0 else None, -1)
+            is_last = final and i == len(bounds) - 2
+            if not is_last:
+                height = cluster_heights[i]
+                if abs(height - min_cluster_height) < 1e-6:
+                    height = _sequential_sum(heights[first:last])
+                if not height > min_cluster_height:
+                    continue
+            blocks = assign_blocks(starts[cluster], ends[cluster], heights[cluster], scale)
+            rows = cluster_blocks(starts[cluster], ends[cluster], heights[cluster], blocks, min_block_height)
+            if rows:
+                count += 1
+                for start, end, height, tags in rows:
+                    out.add(count, chroms[first], start, end, strands[first], height, tags)
+    return count
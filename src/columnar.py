@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+"""
+Binary columnar tables for the intermediates passed between analysis steps.
+
+Tags, reads and clusters used to go from step to step as whitespace separated
+text that every step parsed again. A table is a directory holding one raw array
+file per column (<column>.bin) and meta.json with the number of rows, the column
+types and the dictionaries of the string columns: chromosome and strand names
+are stored as int32 codes into their dictionary. Numeric columns are opened
+memory-mapped, and only the columns a step needs are read. Values are stored as
+the text files held them, so results are the same.
+
+Text is written only where it is needed: for the user-facing coverage tracks and
+expression tables, and for the Perl scripts (see export()). A table is printed
+in its text format by
+    python3 columnar.py TABLE_DIR [OUTPUT_FILE]
+"""
+
+import json
+import os
+import sys
+
+import numpy as np
+
+import overlap
+
+TABLE_VERSION = 1
+META_FILENAME = "meta.json"
+# Type of dictionary encoded string columns
+DICTIONARY = "dictionary"
+CODE_DTYPE = np.int32
+# Rows buffered by a TableWriter before they are appended to the column files
+CHUNK_SIZE = 1 << 16
+
+# Tags and reads (upload.tags, ncRNAs.reads, ...), in the column order of the former BED files.
+# Positions are int32 as in BAM files.
+READS = (
+    ("chrom", DICTIONARY),
+    ("start", np.int32),
+    ("end", np.int32),
+    ("tag", np.int32),  # number N of the tag name dario_N
+    ("expr", np.float64),
+    ("strand", DICTIONARY),
+    ("count", np.float64),
+)
+# Blocks of read clusters (ncRNAs.clusters, unknown.clusters), see clustering.py
+CLUSTERS = (
+    ("cluster", np.int32),
+    ("chrom", DICTIONARY),
+    ("start", np.int32),
+    ("end", np.int32),
+    ("strand", DICTIONARY),
+    ("height", np.float64),
+    ("tags", np.int32),
+)
+SCHEMAS = {"reads": READS, "clusters": CLUSTERS}
+
+
+def _column_file(path, name):
+    return os.path.join(path, name + ".bin")
+
+
+class TableWriter:
+    """Write the rows of a table to the directory path in chunks, see append() and write_table()"""
+
+    def __init__(self, path, kind, chunk_size=CHUNK_SIZE):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.kind = kind
+        self.chunk_size = chunk_size
+        self.rows = 0
+        self.dictionaries = dict((name, {}) for name, dtype in SCHEMAS[kind] if dtype == DICTIONARY)
+        self.buffer = dict((name, []) for name, dtype in SCHEMAS[kind])
+        self.files = dict((name, open(_column_file(path, name), "wb")) for name, dtype in SCHEMAS[kind])
+
+    def add(self, *row):
+        """Add one row, with the values in schema order"""
+        for (name, dtype), value in zip(SCHEMAS[self.kind], row):
+            if dtype == DICTIONARY:
+                value = self.dictionaries[name].setdefault(value, len(self.dictionaries[name]))
+            self.buffer[name].append(value)
+        if len(self.buffer["start"]) >= self.chunk_size:
+            self.flush()
+
+    def append(self, table):
+        """Add the rows of a table (dict of column arrays, as returned by read_table())"""
+        self.flush()
+        for name, dtype in SCHEMAS[self.kind]:
+            values = table[name]
+            if dtype == DICTIONARY:
+                dictionary = self.dictionaries[name]
+                names, inverse = np.unique(np.asarray(values, dtype=object), return_inverse=True)
+                codes = np.array([dictionary.setdefault(value, len(dictionary)) for value in names], dtype=CODE_DTYPE)
+                values = codes[inverse]
+            np.ascontiguousarray(values, dtype=CODE_DTYPE if dtype == DICTIONARY else dtype).tofile(self.files[name])
+        self.rows += len(table["start"])
+
+    def flush(self):
+        for name, dtype in SCHEMAS[self.kind]:
+            np.array(self.buffer[name], dtype=CODE_DTYPE if dtype == DICTIONARY else dtype).tofile(self.files[name])
+        self.rows += len(self.buffer["start"])
+        self.buffer = dict((name, []) for name in self.buffer)
+
+    def close(self):
+        """Write the remaining rows and the meta data"""
+        self.flush()
+        for f in self.files.values():
+            f.close()
+        meta = {
+            "version": TABLE_VERSION,
+            "kind": self.kind,
+            "rows": self.rows,
+            "columns": [
+                [name, dtype if dtype == DICTIONARY else np.dtype(dtype).str] for name, dtype in SCHEMAS[self.kind]
+            ],
+            "dictionaries": dict((name, list(codes)) for name, codes in self.dictionaries.items()),
+        }
+        with open(os.path.join(self.path, META_FILENAME), "w") as f:
+            json.dump(meta, f)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:  # no meta data, so the partial table is not taken for a complete one
+            for f in self.files.values():
+                f.close()
+
+
+def write_table(path, table, kind="reads"):
+    """Write a table (dict of column arrays with the columns of the schema kind) to the directory path"""
+    with TableWriter(path, kind) as writer:
+        writer.append(table)
+
+
+def read_meta(path):
+    with open(os.path.join(path, META_FILENAME)) as f:
+        return json.load(f)
+
+
+def is_table(path):
+    return os.path.exists(os.path.join(path, META_FILENAME))
+
+
+def read_table(path, columns=None):
+    """
+    Read a table as dict of column arrays, like overlap.read_bed() returns them (strings as object
+    arrays). Numeric columns are memory-mapped; columns restricts the table to the given names.
+    """
+    meta = read_meta(path)
+    table = {}
+    for name, dtype in meta["columns"]:
+        if columns is not None and name not in columns:
+            continue
+        stored_dtype = CODE_DTYPE if dtype == DICTIONARY else np.dtype(dtype)
+        if meta["rows"]:
+            values = np.memmap(_column_file(path, name), dtype=stored_dtype, mode="r", shape=(meta["rows"],))
+        else:
+            values = np.zeros(0, dtype=stored_dtype)
+        if dtype == DICTIONARY:
+            values = np.array(meta["dictionaries"][name], dtype=object)[values]
+        table[name] = values
+    return table
+
+
+def take(table, rows):
+    """The rows (index or boolean array) of a table"""
+    return dict((name, values[rows]) for name, values in table.items())
+
+
+def concatenate(paths, output_path, kind="reads"):
+    """
+    Concatenate the tables of schema kind at paths (skipping missing ones) into a table at output_path.
+    Clusters are numbered on from one table to the next.
+    """
+    clusters = 0
+    with TableWriter(output_path, kind) as writer:
+        for path in paths:
+            if not is_table(path):
+                continue
+            table = read_table(path)
+            if kind == "clusters":
+                table["cluster"] = table["cluster"] + clusters
+                clusters = int(table["cluster"].max()) if len(table["cluster"]) else clusters
+            writer.append(table)
+
+
+def write_bed(table, output_file):
+    """Write a reads table as BED file (tag name dario_N in column 4, read count in column 7)"""
+    with open(output_file, "w") as f:
+        f.writelines(
+            "%s\t%d\t%d\tdario_%d\t%s\t%s\t%s\n"
+            % (chrom, start, end, tag, overlap.format_perl_number(expr), strand, overlap.format_perl_number(count))
+            for chrom, start, end, tag, expr, strand, count in zip(*[table[name] for name, dtype in READS])
+        )
+
+
+def cluster_heights(table):
+    """First block of each cluster of a clusters table, and the cluster heights (sums of the block heights)"""
+    first = (
+        np.flatnonzero(np.append(True, table["cluster"][1:] != table["cluster"][:-1])) if len(table["start"]) else []
+    )
+    heights = []
+    for start, end in zip(first, np.append(first[1:], len(table["start"])).astype(np.int64)):
+        height = 0.0
+        for block_height in table["height"][start:end]:
+            height += block_height  # summed up one after the other, as blockbuster sums its block heights
+        heights.append(height)
+    return np.asarray(first, dtype=np.int64), np.array(heights)
+
+
+def write_clusters(table, output_file):
+    """Write a clusters table in the .clusters text format of clustering.py"""
+    first, heights = cluster_heights(table)
+    ends = np.append(first[1:], len(table["start"])).astype(np.int64)
+    with open(output_file, "w") as f:
+        for i, (start, end) in enumerate(zip(first, ends)):
+            f.write(
+                ">cluster_%d\t%s\t%d\t%d\t%s\t%.2f\t%d\t%d\n"
+                % (
+                    table["cluster"][start],
+                    table["chrom"][start],
+                    table["start"][start:end].min(),
+                    table["end"][start:end].max(),
+                    table["strand"][start],
+                    heights[i],
+                    table["tags"][start:end].sum(),
+                    end - start,
+                )
+            )
+            for block, row in enumerate(range(start, end), 1):
+                f.write(
+                    "%d\t%s\t%d\t%d\t%s\t%.2f\t%d\n"
+                    % (
+                        block,
+                        table["chrom"][row],
+                        table["start"][row],
+                        table["end"][row],
+                        table["strand"][row],
+                        table["height"][row],
+                        table["tags"][row],
+                    )
+                )
+
+
+def export(path, output_file):
+    """Write the table at path in its text format (BED for reads, .clusters for clusters)"""
+    table = read_table(path)
+    if read_meta(path)["kind"] == "clusters":
+        write_clusters(table, output_file)
+    else:
+        write_bed(table, output_file)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (2, 3) or not is_table(sys.argv[1]):
+        sys.exit("usage: columnar.py TABLE_DIR [OUTPUT_FILE]")
+    export(sys.argv[1], sys.argv[2] if len(sys.argv) == 3 else "/dev/stdout")
@@ -15,21 +15,59 @@ WEBSERVER_TEMPLATES_PATH = "/u/dario/dario-app/src/templates/"
 WEBSERVER_JOBS_PATH = "/u/dario/computations/wrk/"
 WEBSERVER_RESULTS_PATH = "/u/dario/public_html/result/"
 WEBSERVER_EXAMPLE_DATA_PATH = "/u/dario/public_html/example/"
+MAX_UPLOAD_SIZE = 500 * 1024 * 1024  # uploads are stored compressed while being received, see ingest.py
+UPLOAD_COMPRESSION_LEVEL = 6
+# Cache of finished results keyed by input content (see result_cache.py)
+RESULT_CACHE_PATH = "/u/dario/computations/result_cache/"
+RESULT_CACHE_MAX_BYTES = 20 * 1024 * 1024 * 1024
+RESULT_CACHE_VERSION = "2"  # change to invalidate all cached results, e.g. after analysis changes
+# Annotation updates change the keys themselves, the species dirs must be readable on the webserver
 
 WORKER_SSH_MACHINE = "k74"
 WORKER_TEMPLATES_PATH = "/scratch/dario/src/templates/"
+TEMPLATE_MODULE_PATH = "/tmp/dario-mako/"  # compiled templates (see templating.py), None to compile in memory only
 WORKER_JOBS_PATH = "/scratch/dario/computations/"
 WORKER_SOURCE_PATH = "/scratch/dario/src/"
-WORKER_THREADS = 3
+WORKER_THREADS = 3  # maximal number of concurrent jobs
+# Resources shared by the jobs of the worker, see worker_pool.py
+WORKER_MEMORY_BUDGET = 48 * 1024**3
+WORKER_CORE_BUDGET = 16
+WORKER_CGROUP_PATH = "/sys/fs/cgroup/dario/"  # delegated cgroup v2 subtree, rlimits are used if not writable
+# Estimation of the resources of a job from its (uncompressed) upload size
+JOB_MEMORY_BASE = 512 * 1024**2
+JOB_MEMORY_PER_UPLOAD_BYTE = 4
+JOB_MEMORY_PER_PROCESS = 256 * 1024**2
+JOB_MEMORY_HEADROOM = 1.5  # limit enforced per job, relative to the estimate
+JOB_UPLOAD_BYTES_PER_CORE = 64 * 1024**2
+JOB_COMPRESSION_RATIO = 4
 
 WEB_URL = "http://dario.bioinf.uni-leipzig.de/"
 FINISHED_LIST_CODE = "123"
+# Rows per page of the expression tables of results, and the most the table API returns at once
+TABLE_PAGE_SIZE = 100
+TABLE_MAX_PAGE_SIZE = 1000
 
-NEW_PROCESS_FILENAME = "new_process.list"
-JOB_QUEUE_FILENAME = "auto.list"
+JOB_DB_FILENAME = "jobs.sqlite"
+JOB_CATALOG_FILENAME = "catalog.sqlite"  # all jobs of the webserver, see job_catalog.py
+CATALOG_PAGE_SIZE = 100
+CATALOG_MAX_PAGE_SIZE = 1000
+# Sockets the daemons are woken up on (in their jobs directory), and the fallback wakeup interval in seconds
+WAKEUP_SOCKET_FILENAME = "daemon.sock"
+DAEMON_POLL_INTERVAL = 60
+# Failed transfers of a job to the worker (one per daemon round) after which the job is marked as failed
+TRANSFER_MAX_ATTEMPTS = 10
+# Job status of the wait pages (see job_status.py): refresh interval, keep-alive and maximal duration of event streams
+STATUS_REFRESH_INTERVAL = 1
+STATUS_KEEPALIVE_INTERVAL = 15
+STATUS_STREAM_TIMEOUT = 600
+# Transfers between webserver and worker, see transport.py ("ssh", or "local" if both run on one machine)
+TRANSPORT = "ssh"
+SSH_CONTROL_PATH = "/tmp/dario-ssh-%r@%h:%p"  # socket of the shared ssh connection
+SSH_CONTROL_PERSIST = 600  # seconds the idle connection is kept open
+TRANSPORT_COMPRESSION_LEVEL = 6
 ALL_JOBS_FILENAME = "all_jobs.list"
-WORKON_JOBS_FILENAME = "workon.list"
 PARAMS_FILENAME = "job_params.txt"
+METRICS_FILENAME = "job_metrics.json"  # resource usage per step, see metrics.py
 STDERR_FILENAME = "stderror.log"
 RUNLOG_FILENAME = "run2.log"
 ERROR_FILENAME = "error.log"
@@ -42,8 +80,14 @@ WORKHORSE_THREADS = 3
 
 WEBPATH = "http://dario.bioinf.uni-leipzig.de/"
 
+# Trained classifier models reused by jobs with similar known ncRNA clusters (see model_store.py)
+MODEL_STORE_PATH = "/scratch/dario/data/model_store/"
+MODEL_STORE_MAX_ENTRIES = 500
+MODEL_STORE_VERSION = "1"  # change to invalidate all stored models, e.g. after classifier changes
 # Supported annotations
 ANNOTATION_DIR_WH = "/scratch/dario/data/annotations/"
+# Prebuilt memory-mapped annotation indexes, one directory per species id (see annotation_index.py)
+ANNOTATION_INDEX_DIR_WH = "/scratch/dario/data/annotation_index/"
 SPECIES = {
     "Human (hg18)": {"dir": ANNOTATION_DIR_WH + "hg18/", "id": "hg18", "test_data": "GSM450599.hg18.bed.gz"},
     "Human (hg19)": {"dir": ANNOTATION_DIR_WH + "hg19/", "id": "hg19"},
@@ -60,6 +104,18 @@ SPECIES = {
     "Spotted Garr (lepOcu1)": {"dir": ANNOTATION_DIR_WH + "lepOcu1/", "id": "lepOcu1"},
 }
 
+# Number of mapping loci held in memory while collapsing reads to tags, larger uploads are sorted on disk
+TAG_SORT_CHUNK_SIZE = 2000000
+
+# Threads inflating the compressed blocks of BAM uploads
+BAM_THREADS = 4
+
+# Format of the read density tracks: "wig" (variableStep, one line per base) or "bedgraph" (run-length encoded)
+COVERAGE_TRACK_FORMAT = "wig"
+
+# Worker processes for the per-chromosome shards of quantification and clustering (1 = run serially)
+SHARD_WORKERS = 8
+
 RETURN_CODE_OK = 0
 RETURN_CODE_ERROR = 1
 
@@ -0,0 +1,113 @@
+"""
+Read coverage tracks (read density per base) for the UCSC genome browser.
+
+Coverage is built per chromosome/strand as runs between the sorted breakpoints
+(read starts and ends): the value of a run adds up the expression of the reads
+covering it one after the other in their order, as writeWig.pl did for each base,
+so the values are the same to the last digit. A running sum of differences would
+accumulate rounding errors. Runs are streamed out either as variableStep wiggle
+(one line per covered base, as writeWig.pl wrote it) or as bedGraph (one line per run).
+"""
+
+import numpy as np
+
+import columnar
+
+TRACK_HEADER = (
+    'track type={type} name="DARIO - read density ({strand})" description="DARIO - read density ({strand})" '
+    "visibility=full\nbrowser hide all\nbrowser full wgRna tRNAs rnaGene refGene multiz28way\n"
+)
+# Contributions of reads to runs (at most a read's length each) computed at once, few enough
+# that runs and ranks are numbered in 16 bits, which numpy sorts with a radix sort
+CHUNK_CONTRIBUTIONS = 1 << 15
+
+
+def _narrow(numbers):
+    """Non-negative numbers as uint16 if they fit"""
+    return numbers.astype(np.uint16) if len(numbers) and numbers.max() < 1 << 16 else numbers
+
+
+def _chunk_runs(starts, ends, values):
+    """coverage_runs() of intervals whose runs fit into memory at once"""
+    breakpoints = np.unique(np.concatenate([starts, ends + 1]))
+    first = np.searchsorted(breakpoints, starts)
+    counts = np.searchsorted(breakpoints, ends + 1) - first
+    # (run, interval) of each interval covering a run, the intervals of a run in their order
+    interval = np.repeat(np.arange(len(starts)), counts)
+    run = np.repeat(first - (np.cumsum(counts) - counts), counts) + np.arange(counts.sum())
+    order = np.argsort(_narrow(run), kind="stable")
+    run, interval = run[order], interval[order]
+    depth = np.bincount(run, minlength=len(breakpoints) - 1)
+    rank = np.arange(len(run)) - np.repeat(np.cumsum(depth) - depth, depth)
+
+    # add the first interval of every run, then the second one, ...
+    by_rank = np.argsort(_narrow(rank), kind="stable")
+    level_bounds = np.searchsorted(rank[by_rank], np.arange(depth.max() + 1))
+    value = np.zeros(len(depth))
+    for lo, hi in zip(level_bounds[:-1], level_bounds[1:]):
+        rows = by_rank[lo:hi]
+        value[run[rows]] += values[interval[rows]]
+    covered = depth > 0
+    return breakpoints[:-1][covered], breakpoints[1:][covered], value[covered]
+
+
+def coverage_runs(starts, ends, values):
+    """
+    Return run-length encoded coverage of closed intervals as arrays
+    (run start, run end (exclusive), value), leaving out uncovered runs.
+    The value of a run adds up the values of the intervals covering it in their order.
+    """
+    if len(starts) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0)
+    # chunks of intervals separated by uncovered bases
+    by_start = np.argsort(starts, kind="stable")
+    reach = np.maximum.accumulate(ends[by_start])
+    gaps = np.flatnonzero(starts[by_start][1:] > reach[:-1]) + 1
+    contributions = np.cumsum(ends[by_start] - starts[by_start] + 1)
+    gaps = gaps[np.diff(np.concatenate([[0], contributions[gaps - 1] // CHUNK_CONTRIBUTIONS])) > 0]
+    runs = []
+    for lo, hi in zip(np.concatenate([[0], gaps]), np.concatenate([gaps, [len(starts)]])):
+        rows = np.sort(by_start[lo:hi])
+        runs.append(_chunk_runs(starts[rows], ends[rows], values[rows]))
+    return tuple(np.concatenate(arrays) for arrays in zip(*runs))
+
+
+def _write_runs(f, chrom, run_starts, run_ends, values, track_format):
+    """Write the coverage runs of one chromosome/strand"""
+    if track_format == "bedgraph":
+        for start, end, value in zip(run_starts, run_ends, values):
+            f.write("%s\t%d\t%d\t%.15g\n" % (chrom, start - 1, end - 1, value))
+    else:
+        lengths = run_ends - run_starts
+        positions = np.repeat(run_ends - np.cumsum(lengths), lengths) + np.arange(lengths.sum())
+        per_base = np.repeat(values, lengths)
+        f.writelines("%d\t%.15g\n" % (pos, value) for pos, value in zip(positions, per_base))
+
+
+def track_header(strand, track_format="wig"):
+    """Header lines of the coverage track of one strand"""
+    return TRACK_HEADER.format(type="bedGraph" if track_format == "bedgraph" else "wiggle_0", strand=strand)
+
+
+def write_coverage_tracks(reads_file, pos_file, neg_file, track_format="wig", header=True):
+    """
+    Write the read density of the reads table reads_file (see columnar.py) for the plus
+    and minus strand to pos_file and neg_file. track_format is "wig" or "bedgraph".
+    Without header, only the track data is written (e.g. to be concatenated later).
+    """
+    reads = columnar.read_table(reads_file, ("chrom", "start", "end", "strand", "expr"))
+    with open(pos_file, "w") as pos, open(neg_file, "w") as neg:
+        if header:
+            pos.write(track_header("+", track_format))
+            neg.write(track_header("-", track_format))
+        chroms, chrom_index = np.unique(reads["chrom"], return_inverse=True)
+        order = np.argsort(chrom_index, kind="stable")
+        bounds = np.searchsorted(chrom_index[order], np.arange(len(chroms) + 1))
+        for i, chrom in enumerate(chroms):
+            rows = order[bounds[i] : bounds[i + 1]]
+            for strand, f in (("+", pos), ("-", neg)):
+                if track_format != "bedgraph":
+                    f.write("variableStep chrom=%s\n" % chrom)
+                on_strand = rows[reads["strand"][rows] == strand]
+                runs = coverage_runs(reads["start"][on_strand], reads["end"][on_strand], reads["expr"][on_strand])
+                _write_runs(f, chrom, *runs, track_format)
@@ -1,71 +1,98 @@
 #!/usr/bin/env python3
 import config
 from config import logger
-from time import sleep
-from subprocess import call
+import result_cache
+import job_catalog
+import job_queue
+import metrics
+import notify
+import transport
 
+# Shared connection to the worker
+worker = transport.connect(config.WORKER_SSH_MACHINE, config.WORKER_SOURCE_PATH)
 
-def submit_jobs():
-    """
-    Checks for new jobs that have been received by the webserver, move them
-    to the worker machine, and update the jobs status file
-    """
-    with open(config.WEBSERVER_JOBS_PATH + config.NEW_PROCESS_FILENAME) as f:
-        lines = f.readlines()
 
-    # Are there are new processes?
-    if len(lines) > 0: 
-        # Get job parameters
-        job = lines[0].strip()
-        cols = job.split("|")
-        job_hash = cols[0]
+def submit_job(job):
+    """Move the work directory of a claimed job to the worker and queue it there, returns whether it worked"""
+    job_hash = job["hash"]
 
-        # Remove first job from new processed file and move job to workhorse queue
-        # @todo Beware of race conditions, potentially lock file
-        del lines[0]
-        with open(config.WEBSERVER_JOBS_PATH + config.NEW_PROCESS_FILENAME, "w") as f:
-            for line in lines:
-                f.write(line)
+    # Move work directory to worker (compressed and verified)
+    rc = worker.send_dir(config.WEBSERVER_JOBS_PATH + job_hash, config.WORKER_JOBS_PATH + job_hash)
 
-        # Move to worker
-        rc = 0
-        # Copy work directory
-        rc = rc | call(
-            [
-                "scp",
-                "-r",
-                config.WEBSERVER_JOBS_PATH + job_hash,
-                config.WORKER_SSH_MACHINE + ":" + config.WORKER_JOBS_PATH,
-            ]
+    # Append to job queue
+    if rc == 0:
+        rc = job_queue.remote(
+            worker,
+            "worker",
+            "submit",
+            job_hash,
+            job["email"],
+            job["code"],
+            job["filename"],
+            job_queue.QUEUED,
         )
+    return rc == 0
 
-        # Append to job queue...
-        rc = rc | call(
-            [
-                "ssh",
-                config.WORKER_SSH_MACHINE,
-                "echo '" + job + "'>>" + config.WORKER_JOBS_PATH + config.JOB_QUEUE_FILENAME,
-            ]
-        )
 
-        # ... and update local mirror of job list
-        rc = rc | call(
-            [
-                "scp",
-                config.WORKER_SSH_MACHINE + ":" + config.WORKER_JOBS_PATH + config.JOB_QUEUE_FILENAME,
-                config.WEBSERVER_JOBS_PATH,
-            ]
-        )
+def give_up(job):
+    """Mark a job that could not be transferred as failed and tell the user"""
+    job_hash = job["hash"]
+    job_queue.set_state(job_queue.WEBSERVER_DB, job_hash, job_queue.FAILED, job_queue.TRANSFERRING)
+    logger.error(f"Job {job_hash} failed: not transferred after {config.TRANSFER_MAX_ATTEMPTS} attempts")
+    msg = f"Your request on file {job['filename']} could not be processed, please submit it again.\n"
+    if (job["email"] or "").strip():
+        notify.send_email(job["email"].strip(), "DARIO job failed", msg)
+    notify.send_email(config.FAILURE_EMAIL, "DARIO job failed", f"The DARIO job {job_hash} could not be transferred.\n")
+
+
+def submit_jobs():
+    """
+    Checks for new jobs that have been received by the webserver, move them
+    to the worker machine, and update the jobs status. Each new job is tried once
+    per round; a failed transfer is repeated in the next round, until the job
+    has failed config.TRANSFER_MAX_ATTEMPTS times.
+    """
+    tried = []
+    while True:
+        # Claim the oldest new job not tried yet, so no other process transfers it
+        job = job_queue.claim(job_queue.WEBSERVER_DB, job_queue.NEW, job_queue.TRANSFERRING, tried)
+        if job is None:
+            return
+        tried.append(job["hash"])
+        if submit_job(job):
+            job_queue.set_state(job_queue.WEBSERVER_DB, job["hash"], job_queue.QUEUED, job_queue.TRANSFERRING)
+            logger.info(f"Job {job['hash']} has been added")
+        elif job_queue.count_attempt(job_queue.WEBSERVER_DB, job["hash"]) >= config.TRANSFER_MAX_ATTEMPTS:
+            give_up(job)
+        else:
+            # try again in the next round
+            job_queue.set_state(job_queue.WEBSERVER_DB, job["hash"], job_queue.NEW, job_queue.TRANSFERRING)
+            logger.error(f"Job {job['hash']} could not be transferred to the worker")
+
 
-        # @todo give back some error to the user if return_code != 0
-        logger.info(f"Job {job_hash} has been added")
+def record_results():
+    """Update the job catalog and the step metrics with the results that have arrived from the worker"""
+    for job_hash in job_catalog.pending():
+        job = job_queue.get(job_queue.WEBSERVER_DB, job_hash)
+        if job is not None and job["state"] in (job_queue.DONE, job_queue.FAILED):
+            metrics.record_job(job_hash)
+            job_catalog.record_result(job_hash, job_catalog.read_result_params(job_hash))
 
 
 if __name__ == "__main__":
     logger.info("The daemon starts")
+    # Transfers interrupted by a restart are repeated (submitting to the worker twice is a no-op)
+    job_queue.reset(job_queue.WEBSERVER_DB, job_queue.TRANSFERRING, job_queue.NEW)
+    wakeup = notify.Listener(job_queue.WEBSERVER_SOCKET)
     try:
         while True:
-            submit_jobs()
-            sleep(15)
+            # Move all pending jobs, then sleep until the upload handler or the worker wakes us up
+            try:
+                submit_jobs()
+                record_results()
+                result_cache.admit_finished()
+            except Exception:
+                logger.exception("Jobs or results could not be handled")
+            wakeup.wait(config.DAEMON_POLL_INTERVAL)
     except:
         logger.error("The daemon dies")
@@ -2,66 +2,56 @@
 """
 Deamon-like process that checks for jobs and starts analysis on them
 """
+
 import config
 from config import logger
 import os
-from time import sleep, ctime
+from time import ctime
 import threading
-from smtplib import SMTP
 import sys
 import traceback
 from subprocess import call
+import annotation_index
+import job_queue
+import notify
+import templating
+import transport
+import worker_pool
 
+# Shared connection to the webserver
+webserver = transport.connect(config.WEBSERVER_SSH_MACHINE, config.WEBSERVER_SOURCE_PATH)
 
-def send_email(to, subject, msg_body):
-    """
-    Send out an email about the status of the finished job
-    """
-    msg = f"To: {to}\n"
-    msg += f"Subject: {subject}\n\n"
-    msg += "Dear DARIO user,\n"
-    msg += msg_body
 
-    # Send e-mail
-    try:
-        server = SMTP()
-        server.connect("bierdepot.bioinf.uni-leipzig.de")
-        server.sendmail("dario@bioinf.uni-leipzig.de", to, msg)
-        server.close()
-    except Exception as inst:
-        logger.error("Email Address error: " + str(inst))
+def report_state(job_hash, state):
+    """Update the state of a job in the webserver queue (shown on the wait page)"""
+    return job_queue.remote(webserver, "webserver", "set-state", job_hash, state)
 
 
-def workon(job):
+def workon(job, memory, cores):
     """
     Run on new analysis job
     """
     # Extract job parameters
-    cols = job.strip().split("|")
-    job_hash = cols[0]
-    email = cols[2].strip()
-    filename = cols[4]
+    job_hash = job["hash"]
+    email = (job["email"] or "").strip()
+    filename = job["filename"]
 
-    # Try to run analyzer
+    # Try to run analyzer with the resources granted
     runpath = config.WORKER_JOBS_PATH + job_hash + "/"
     logger.info(" -- Starting DARIO Analysis in " + runpath + "\n")
-    return_code_analysis = call("python " + config.WORKER_SOURCE_PATH + "/analysis.py -i " + runpath, shell=True)
+    return_code_analysis = worker_pool.run_analysis(runpath, job_hash, memory, cores)
     logger.info(" -- Finished DARIO Analysis in " + runpath + "\n")
 
-    # Update wokon file
-    workon_filename = config.WORKER_JOBS_PATH + config.WORKON_JOBS_FILENAME
-    with open(workon_filename) as workon_file:
-        lines = workon_file.readlines()
-    lines.remove(job)
-    with open(workon_filename, "w") as workon_file:
-        for line in lines:
-            workon_file.write(line)
-
-    # Move files to public_html
-    return_code = call(["scp", "-r", runpath, f"{config.WEBSERVER_SSH_MACHINE}:{config.WEBSERVER_RESULTS_PATH}"])
-    # Workon file on server
-    webserver_scp_path = f"{config.WEBSERVER_SSH_MACHINE}:{config.WEBSERVER_JOBS_PATH}"
-    call(["scp", workon_filename, webserver_scp_path + config.WORKON_JOBS_FILENAME])
+    # Move files to public_html (compressed and verified)
+    return_code = webserver.send_dir(runpath, config.WEBSERVER_RESULTS_PATH + job_hash)
+
+    # Update job state, locally and on the server
+    if return_code_analysis == 0 and return_code == 0:
+        job_queue.complete(job_queue.WORKER_DB, job_hash)
+        report_state(job_hash, job_queue.DONE)
+    else:
+        job_queue.fail(job_queue.WORKER_DB, job_hash)
+        report_state(job_hash, job_queue.FAILED)
 
     # Remove files locally
     if return_code == 0:
@@ -73,59 +63,102 @@ def workon(job):
     webpath = f"{config.WEB_URL}sresult/{job_hash}/index.html"
     if email:
         msg = f"The results of your request file {filename} can be found at:\n{webpath}\n"
-        send_email(email, "DARIO computation completed", msg)
+        notify.send_email(email, "DARIO computation completed", msg)
 
     # Write internal failure e-mail
     if return_code_analysis != 0 or return_code != 0:
         msg = f"The DARIO job {job_hash} on file {filename} has failed. See:\n{webpath}\n"
-        send_email(config.FAILURE_EMAIL, "DARIO job failed", msg)
+        notify.send_email(config.FAILURE_EMAIL, "DARIO job failed", msg)
 
 
-# The Python main method
-if __name__ == "__main__":
-    logger.info("The daemon starts")
-    while True:
-        # list of new jobs
-        with open(config.WORKER_JOBS_PATH + config.JOB_QUEUE_FILENAME) as f:
-            lines = f.readlines()
-
-        if len(lines) > 0 and threading.activeCount() <= config.WORKER_THREADS:
-            # Remove first thread from auto_file
-            job = lines[0]
-            del lines[0]
-            with open(config.WORKER_JOBS_PATH + config.JOB_QUEUE_FILENAME, "w") as f:
-                for line in lines:
-                    f.write(line)
-
-            # Add to currently-on-work list
-            with open(config.WORKER_JOBS_PATH + config.WORKON_JOBS_FILENAME, "a") as workon_file:
-                workon_file.write(job)
-
-            # Update Queue files on server
-            webserver_scp_path = f"{config.WEBSERVER_SSH_MACHINE}:{config.WEBSERVER_JOBS_PATH}"
-            call(
-                [
-                    "scp",
-                    config.WORKER_JOBS_PATH + config.JOB_QUEUE_FILENAME,
-                    webserver_scp_path + config.JOB_QUEUE_FILENAME,
-                ]
-            )
-            call(
-                [
-                    "scp",
-                    config.WORKER_JOBS_PATH + config.WORKON_JOBS_FILENAME,
-                    webserver_scp_path + config.WORKON_JOBS_FILENAME,
-                ]
-            )
+# Resources of the jobs being processed
+pool = worker_pool.WorkerPool()
+POOL_STATUS_FILENAME = config.WORKER_JOBS_PATH + "worker_pool.json"
 
-            # Note: activeCount includes this program
-            logger.info(f"Starting Thread: {threading.activeCount()} of {config.WORKER_THREADS}")
 
-            P2 = threading.Thread(target=workon, args=[job])
-            P2.start()
+def run_job(job, memory, cores):
+    """
+    Process a job in its own thread; frees its resources and wakes up the main loop when done.
+    A job whose processing raises is marked as failed.
+    """
+    try:
+        workon(job, memory, cores)
+    except Exception:
+        logger.exception(f"Job {job['hash']} failed")
+        # only if still running, the job may have been completed before
+        if job_queue.fail(job_queue.WORKER_DB, job["hash"]):
+            try:
+                report_state(job["hash"], job_queue.FAILED)
+            except Exception:
+                logger.exception(f"State of job {job['hash']} could not be reported")
+            notify.send_email(
+                config.FAILURE_EMAIL,
+                "DARIO job failed",
+                f"The DARIO job {job['hash']} on file {job['filename']} has failed.\n",
+            )
+    finally:
+        pool.release(job["hash"])
+        pool.write_status(POOL_STATUS_FILENAME)
+        notify.notify(job_queue.WORKER_SOCKET)
+
+
+def start_job(job):
+    """Start a queued job if its estimated resources are available, returns whether it could be started"""
+    granted = pool.admit(job["hash"], *worker_pool.estimate(config.WORKER_JOBS_PATH + job["hash"] + "/"))
+    if granted is None:
+        return False  # wait for running jobs to free resources
+    if not job_queue.set_state(job_queue.WORKER_DB, job["hash"], job_queue.RUNNING, job_queue.QUEUED):
+        pool.release(job["hash"])
+        return True  # taken meanwhile, go on with the next job
+    pool.write_status(POOL_STATUS_FILENAME)
+    report_state(job["hash"], job_queue.RUNNING)
+    logger.info(f"Starting Thread: {pool.running()} of {config.WORKER_THREADS}")
+    threading.Thread(target=run_job, args=[job, *granted]).start()
+    return True
+
+
+def fail_job(job):
+    """Mark a job that could not be started as failed, here and on the webserver"""
+    pool.release(job["hash"])
+    job_queue.set_state(job_queue.WORKER_DB, job["hash"], job_queue.FAILED)
+    try:
+        report_state(job["hash"], job_queue.FAILED)
+    except Exception:
+        logger.exception(f"State of job {job['hash']} could not be reported")
+    notify.send_email(config.FAILURE_EMAIL, "DARIO job failed", f"The DARIO job {job['hash']} could not be started.\n")
+
+
+def start_jobs():
+    """Start queued jobs in queue order as long as their estimated resources are available"""
+    while pool.running() < config.WORKER_THREADS:
+        job = job_queue.peek(job_queue.WORKER_DB, job_queue.QUEUED)
+        if job is None:
+            return
+        try:
+            if not start_job(job):
+                return
+        except Exception:
+            logger.exception(f"Job {job['hash']} could not be started")
+            fail_job(job)
 
-            # occasionally reload config to allow change of WORKHORSE_THREADS
-            # reload(config)
-        sleep(15)
 
-    logger.error("The daemon dies")
+# The Python main method
+if __name__ == "__main__":
+    logger.info("The daemon starts")
+    wakeup = notify.Listener(job_queue.WORKER_SOCKET)
+    # Build missing or outdated annotation indexes before the first job needs them
+    annotation_index.build_all()
+    # Compile the templates once, the analysis processes load the compiled modules
+    templating.preload(config.WORKER_TEMPLATES_PATH)
+    # Jobs interrupted by a restart are run again
+    job_queue.reset(job_queue.WORKER_DB, job_queue.RUNNING, job_queue.QUEUED)
+    try:
+        while True:
+            # Woken up by new jobs (job_queue.py submit) and by finished jobs
+            try:
+                start_jobs()
+            except Exception:
+                logger.exception("Queued jobs could not be started")
+            wakeup.wait(config.DAEMON_POLL_INTERVAL)
+    except:
+        logger.error("The daemon dies")
@@ -2,31 +2,54 @@
 import os
 import sys
 from subprocess import call
-from mako.template import Template
-from mako.lookup import TemplateLookup
 from hashlib import md5
 import traceback
+import json
+import time
 from time import ctime, localtime, strftime
 from itertools import groupby
 
 
-from flask import Flask, request, stream_with_context, send_from_directory
+from flask import Flask, Request, request, stream_with_context, send_from_directory, jsonify, abort
 
 app = Flask(__name__)
 
 sys.path.append(os.path.dirname(app.instance_path))  # to import config.py file from the same path
 import config as config
+import expression_index
+import ingest
+import result_cache
+import job_catalog
+import job_queue
+import job_status
+import metrics
+import notify
+import templating
+
+
+class UploadRequest(Request):
+    """
+    Request that receives uploaded files straight into the jobs directory, hashed
+    and compressed on the fly (see ingest.py)
+    """
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return ingest.IngestFile(config.WEBSERVER_JOBS_PATH)
 
-app.config["MAX_CONTENT_LENGTH"] = 70 * 1024 * 1024
+
+app.request_class = UploadRequest
+app.config["MAX_CONTENT_LENGTH"] = config.MAX_UPLOAD_SIZE
 
 
 def render_template(template_name, **kwargs):
     """
     Custom rendering function that uses the Mako template engine instead of Flask-default Jinja2
     """
-    mako_lookup = TemplateLookup(directories=[config.WEBSERVER_TEMPLATES_PATH])
-    mytemplate = Template(filename=config.WEBSERVER_TEMPLATES_PATH + template_name + ".mako.html", lookup=mako_lookup)
-    return mytemplate.render(WEBPATH=config.WEB_URL, phase=3, **kwargs)
+    return templating.render(config.WEBSERVER_TEMPLATES_PATH, template_name, WEBPATH=config.WEB_URL, phase=3, **kwargs)
+
+
+# Compile all templates at startup instead of on the first request
+templating.preload(config.WEBSERVER_TEMPLATES_PATH)
 
 
 @app.route("/")
@@ -51,6 +74,31 @@ def serve_result(path):
     return send_from_directory(config.WEBSERVER_RESULTS_PATH, path)
 
 
+@app.route("/api/result/<job_hash>/<table>/<ncrna_type>")
+def serve_expression_table(job_hash, table, ncrna_type):
+    """
+    Returns a page of an expression table of a result as JSON (see expression_index.py).
+    Query parameters: sort (column), order (asc or desc), offset, limit, chrom and q (part of the ID)
+    """
+    if not job_hash.isalnum():
+        abort(404)
+    table_index = expression_index.open_table(config.WEBSERVER_RESULTS_PATH + job_hash + "/", table, ncrna_type)
+    if table_index is None:
+        abort(404)
+    try:
+        page = table_index.page(
+            sort=request.args.get("sort"),
+            descending=request.args.get("order") == "desc",
+            offset=max(0, int(request.args.get("offset", 0))),
+            limit=min(max(0, int(request.args.get("limit", config.TABLE_PAGE_SIZE))), config.TABLE_MAX_PAGE_SIZE),
+            chrom=request.args.get("chrom"),
+            query=request.args.get("q"),
+        )
+    except (KeyError, ValueError):
+        abort(400)
+    return jsonify(page)
+
+
 @app.route("/example/<path:path>")
 def serve_example(path):
     return send_from_directory(config.WEBSERVER_EXAMPLE_DATA_PATH, path)
@@ -110,22 +158,9 @@ def upload_file():
             # Begin with upload
             yield '<script type="text/javascript">document.getElementById("Begin").style.visibility = "visible";</script>'
 
-            dir = "%s%s/" % (config.WEBSERVER_JOBS_PATH, hash)
-            os.mkdir(dir)
-
-            if not use_test_data:
-                coverage_file.save(dir + "mapping_loci.upload")
-            else:
-                call(["cp", config.WEBSERVER_EXAMPLE_DATA_PATH + filename, dir + "mapping_loci.upload"])
-
-            # Upload user_annotation file
-            user_annotation = "NONE"
-            if not use_test_data and "user_annotation" in request.files:
-                user_annotation_file = request.files["user_annotation"]
-                user_annotation_file.save(dir + "mapping_loci.upload")
-
             # Store run parameters
             jtime = strftime("%Y-%m-%d %H:%M:%S", localtime())
+            user_annotation = "NONE"
             params = {
                 "hash": hash,
                 "email": email,
@@ -136,16 +171,48 @@ def upload_file():
                 "user_annotation": user_annotation,
                 "use_test_data": use_test_data,
             }
-            with open(dir + config.PARAMS_FILENAME, "w") as f:
-                for k, v in params.items():
-                    f.write(k + "\t" + str(v) + "\n")
-
-            # Add to queue
-            with open(config.WEBSERVER_JOBS_PATH + config.NEW_PROCESS_FILENAME, "a") as f:
-                f.write("%s|NONE|%s|%s|%s\n" % (hash, email, species_code, filename))
 
-            # Add to debug file which stores all started jobs
+            # Serve identical inputs from the result cache, test data without copying it at all
+            dir = "%s%s/" % (config.WEBSERVER_JOBS_PATH, hash)
+            if use_test_data:
+                example_file = config.WEBSERVER_EXAMPLE_DATA_PATH + filename
+                cache_key = result_cache.cache_key(species_code, *ingest.describe(example_file))
+            else:
+                # The uploads have been stored while receiving the request
+                upload = coverage_file.stream
+                user_annotation_file = request.files.get("user_annotation")
+                cache_key = result_cache.cache_key(
+                    species_code,
+                    upload.hexdigest(),
+                    upload.format,
+                    user_annotation_file.stream.hexdigest() if user_annotation_file else None,
+                )
+            cached = result_cache.restore(cache_key, hash, params)
+
+            if not cached:
+                os.mkdir(dir)
+                if use_test_data:
+                    ingest.ingest_file(example_file, dir, "mapping_loci")
+                else:
+                    upload.save(dir, "mapping_loci")
+                    if user_annotation_file:
+                        user_annotation_file.stream.save(dir, "user_annotation")
+
+                params["cache_key"] = cache_key
+                with open(dir + config.PARAMS_FILENAME, "w") as f:
+                    for k, v in params.items():
+                        f.write(k + "\t" + str(v) + "\n")
+
+                # Add to queue
+                result_cache.register(hash, cache_key)
+                job_queue.submit(job_queue.WEBSERVER_DB, hash, email, species_code, filename)
+                notify.notify(job_queue.WEBSERVER_SOCKET)
+
+            # Add to the job catalog, and to debug file which stores all started jobs
             remote_ip = request.remote_addr[:-3] + "0"
+            job_catalog.add(hash, jtime, species_code, filename, email, remote_ip, cached)
+            if cached:
+                job_catalog.record_result(hash, job_catalog.read_result_params(hash))
             with open(config.WEBSERVER_JOBS_PATH + config.ALL_JOBS_FILENAME, "a") as f:
                 f.write("%s|%s|%s|%s|%s|%s\n" % (jtime, hash, species_code, filename, email, remote_ip))
 
@@ -163,51 +230,133 @@ def upload_file():
 
 @app.errorhandler(413)
 def upload_too_large(e):
-    return "You file exceeded maximum size of 60MB. Please try to compress your file, using e.g. gzip.", 413
+    return "You file exceeded maximum size of %dMB. Please try to compress your file, using e.g. gzip." % (
+        config.MAX_UPLOAD_SIZE // (1024 * 1024)
+    ), 413
+
+
+# States and queue positions of the jobs, kept up to date in the background
+status_index = job_status.StatusIndex(job_queue.WEBSERVER_DB)
+
+
+def job_wait_status(job_hash):
+    """
+    Status of a job for the wait page as dict with state (waiting, running, finished, failed or new),
+    message and, when finished, the URL of the result
+    """
+    job = status_index.get(job_hash)
+    if job is not None and job["state"] in job_queue.WAITING_STATES:
+        return {"state": "waiting", "message": f"Your job is on position {job['position']} in the queue."}
+    elif job is not None and job["state"] == job_queue.RUNNING:
+        return {"state": "running", "message": "Your job is on work.<br>\n"}
+    has_result = os.path.exists(config.WEBSERVER_RESULTS_PATH + job_hash + "/index.html")
+    if job is not None and job["state"] == job_queue.FAILED and not has_result:
+        # failed before the analysis, e.g. not transferred to the worker
+        return {"state": "failed", "message": "Your job could not be processed. Please submit it again."}
+    if (job is not None and job["state"] in (job_queue.DONE, job_queue.FAILED)) or has_result:
+        return {
+            "state": "finished",
+            "message": "Your job is finished. You will forwarded to the results.",
+            "result_url": f"/result/{job_hash}/index.html",
+        }
+    return {"state": "new", "message": "Adding your job to the queue."}
 
 
 @app.route("/wait/<job_hash>")
 def show_wait_page(job_hash):
     """
-    Shows the user his position in the job queue
-    """
-    found_msg = ""
-    with open(config.WEBSERVER_JOBS_PATH + config.JOB_QUEUE_FILENAME) as f:
-        for i, line in enumerate(f):
-            if line.split("|", 1)[0] == job_hash:
-                found_msg = f"Your job is on position {i+1} in the queue."
-                break
-    if found_msg == "":
-        with open(config.WEBSERVER_JOBS_PATH + config.WORKON_JOBS_FILENAME) as f:
-            for line in f:
-                if line.split("|", 1)[0] == job_hash:
-                    found_msg = "Your job is on work.<br>\n"
-                    break
-    if found_msg == "" and os.path.exists(config.WEBSERVER_RESULTS_PATH + job_hash + "/index.html"):
-        found_msg = "Your job is finished. You will forwarded to the results."
+    Shows the user his position in the job queue, updated by the events of stream_wait_status
+    """
+    status = job_wait_status(job_hash)
+    found_msg = status["message"]
+    if status["state"] == "finished":
         found_msg += (
-            f'<script type="text/javascript">window.setTimeout("location.replace(\\"/result/%s/index.html\\")", 5000);</script>'
-            % (job_hash)
+            f'<script type="text/javascript">window.setTimeout("location.replace(\\"%s\\")", 5000);</script>'
+            % (status["result_url"])
         )
-    if found_msg == "":
-        found_msg = "Adding your job to the queue."
-    return render_template("job_wait", found=found_msg, pagelink=f"wait/{job_hash}")
+    return render_template(
+        "job_wait", found=found_msg, pagelink=f"wait/{job_hash}", events_url=f"{config.WEB_URL}wait/{job_hash}/events"
+    )
+
+
+@app.route("/wait/<job_hash>/events")
+def stream_wait_status(job_hash):
+    """
+    Server-sent events with the status of a job (see job_wait_status), one per change until the
+    job is finished. The stream ends after config.STATUS_STREAM_TIMEOUT, browsers then reconnect.
+    """
+
+    def events():
+        deadline = time.time() + config.STATUS_STREAM_TIMEOUT
+        status = None
+        while time.time() < deadline:
+            version = status_index.version  # before the lookup, so that no change is missed
+            new_status = job_wait_status(job_hash)
+            if new_status != status:
+                status = new_status
+                yield "data: %s\n\n" % json.dumps(status)
+                if status["state"] in ("finished", "failed"):
+                    return
+            else:
+                yield ": keep-alive\n\n"
+            status_index.wait(version, config.STATUS_KEEPALIVE_INTERVAL)
+
+    return app.response_class(events(), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
+def finished_jobs_query():
+    """Page and filters of the finished jobs page from the query parameters, as arguments of job_catalog.search"""
+    page = max(1, int(request.args.get("page", 1)))
+    per_page = min(max(1, int(request.args.get("per_page", config.CATALOG_PAGE_SIZE))), config.CATALOG_MAX_PAGE_SIZE)
+    return dict(
+        offset=(page - 1) * per_page,
+        limit=per_page,
+        code=request.args.get("species"),
+        status=request.args.get("status"),
+        since=request.args.get("from"),
+        until=request.args.get("to"),
+    )
 
 
 @app.route("/finished_jobs/<secret_code>")
 def show_finished_jobs(secret_code):
     """
-    Provides a page with finished jobs
+    Provides a page with finished jobs, paginated and filtered (see finished_jobs_query)
     """
     if secret_code == config.FINISHED_LIST_CODE:
-        with open(config.WEBSERVER_JOBS_PATH + config.ALL_JOBS_FILENAME, encoding='utf-8') as f:
-            lines = [x.split("|") for x in f.readlines()]
-        for job in lines:
-            job.append(os.path.exists(config.WEBSERVER_RESULTS_PATH + job[1] + "/ncRNA.expression.bed"))
-            job.append(os.path.exists(config.WEBSERVER_RESULTS_PATH + job[1] + "/predictions.expression.bed"))
-        return render_template("finished_jobs", job_infos=lines)
+        try:
+            query = finished_jobs_query()
+        except ValueError:
+            abort(400)
+        jobs, total = job_catalog.search(**query)
+        return render_template("finished_jobs", job_infos=jobs, total=total, query=query, args=request.args)
     else:
         return "Access not permitted"
 
 
+@app.route("/finished_jobs/<secret_code>/json")
+def list_finished_jobs(secret_code):
+    """
+    JSON variant of the finished jobs page
+    """
+    if secret_code != config.FINISHED_LIST_CODE:
+        abort(403)
+    try:
+        query = finished_jobs_query()
+    except ValueError:
+        abort(400)
+    jobs, total = job_catalog.search(**query)
+    return jsonify({"total": total, "offset": query["offset"], "jobs": jobs})
+
+
+@app.route("/metrics")
+def serve_metrics():
+    """
+    Metrics for Prometheus: queue depth, worker slot usage and resource usage per analysis step (see metrics.py)
+    """
+    job_states = status_index.counts()
+    text = metrics.render(job_states, job_states.get(job_queue.RUNNING, 0), config.WORKER_THREADS)
+    return app.response_class(text, mimetype="text/plain; version=0.0.4")
+
+
 application = app  # @todo: remove. WSGI script reloading for testing
@@ -0,0 +1,215 @@
+"""
+Expression quantification of annotated regions (ncRNAs, predictions, user annotations).
+
+For every annotation row the number of overlapping reads (readCnt), their
+normalized read count (normReadCnt) and the expression (expr) - the read
+expression distributed uniformly over the bases of each read and summed over
+the annotated bases - are computed. Reads and annotations are swept once per
+chromosome/strand: expr is read off a cumulative integral of the read density,
+read counts off prefix sums over sorted read starts and ends.
+"""
+
+import os
+import numpy as np
+
+import columnar
+from overlap import KEY_SHIFT, read_bed, format_perl_number
+
+# Annotation columns needed for the expression table
+ANNOTATION_COLUMNS = {"id": (3, object), "score": (4, object), "type": (6, object)}
+# Columns of the reads tables (see columnar.py) quantified
+READ_COLUMNS = ("chrom", "start", "end", "strand", "expr", "count")
+
+UCSC_LINK = "http://genome.ucsc.edu/cgi-bin/hgTracks?db={species}&position={chrom}:{start}-{end}&hgct_customText={wig}"
+ARABIDOPSIS_LINK = (
+    "http://chualab.rockefeller.edu/cgi-bin/gb2/gbrowse/arabidopsis/?start={start};stop={end};ref={chrom};eurl={wig}"
+)
+
+
+def read_total_read_count(upload_info):
+    """Return the number of reads of the library stored in upload.info"""
+    with open(upload_info) as f:
+        for line in f:
+            cols = line.strip().split(":")
+            if cols[0] == "reads":
+                return float(cols[1])
+    raise ValueError("No read count found in " + upload_info)
+
+
+def _group_rows(chroms, strands):
+    """Return a dict mapping (chromosome, strand) to the row indices of that pair"""
+    groups = {}
+    for i, pair in enumerate(zip(chroms, strands)):
+        groups.setdefault(pair, []).append(i)
+    return dict((pair, np.array(rows, dtype=np.int64)) for pair, rows in groups.items())
+
+
+def _sweep(read_starts, read_ends, read_expr, read_counts, starts, ends):
+    """
+    Quantify the annotations [starts, ends] against the reads of one chromosome/strand.
+    Returns arrays (expr, normReadCnt, readCnt, number of overlapping reads) with one entry per annotation.
+    """
+    # read density: each read spreads its expression evenly over its bases
+    density = read_expr / (read_ends - read_starts + 1)
+    breakpoints, inverse = np.unique(np.concatenate([read_starts, read_ends + 1]), return_inverse=True)
+    level = np.cumsum(np.bincount(inverse, weights=np.concatenate([density, -density]), minlength=len(breakpoints)))
+    integral = np.concatenate([[0.0], np.cumsum(level[:-1] * np.diff(breakpoints))])
+
+    def integral_at(x):
+        k = np.searchsorted(breakpoints, x, side="right") - 1
+        inside = k >= 0
+        result = np.zeros(len(x))
+        result[inside] = integral[k[inside]] + level[k[inside]] * (x[inside] - breakpoints[k[inside]])
+        result[k == len(breakpoints) - 1] = integral[-1]
+        return result
+
+    expr = integral_at(ends + 1) - integral_at(starts)
+
+    # reads overlapping [s, e]: reads starting at or before e, minus those that already ended before s
+    by_start = np.argsort(read_starts, kind="stable")
+    by_end = np.argsort(read_ends, kind="stable")
+    sorted_starts, sorted_ends = read_starts[by_start], read_ends[by_end]
+    result = []
+    for values in (read_expr, read_counts, np.ones(len(read_starts), dtype=np.int64)):
+        started = np.concatenate([[0], np.cumsum(values[by_start])])
+        ended = np.concatenate([[0], np.cumsum(values[by_end])])
+        result.append(
+            started[np.searchsorted(sorted_starts, ends, side="right")]
+            - ended[np.searchsorted(sorted_ends, starts, side="left")]
+        )
+    return expr, result[0], result[1], result[2]
+
+
+def quantify(reads, annotations):
+    """
+    Compute (expr, normReadCnt, readCnt, number of overlapping reads) arrays for the annotation
+    rows, given reads with expression ("expr") and read count ("count") columns as loaded by read_bed()
+    """
+    return tuple(values[0] for values in quantify_samples([reads], annotations))
+
+
+def quantify_samples(samples, annotations):
+    """
+    quantify() for the reads of several samples, grouping the annotations once. Returns
+    (expr, normReadCnt, readCnt, number of overlapping reads) arrays of samples x annotation rows.
+    """
+    shape = (len(samples), len(annotations["start"]))
+    expr, norm_reads, read_counts = np.zeros(shape), np.zeros(shape), np.zeros(shape)
+    overlapping = np.zeros(shape, dtype=np.int64)
+    annotation_groups = _group_rows(annotations["chrom"], annotations["strand"])
+    for s, reads in enumerate(samples):
+        read_groups = _group_rows(reads["chrom"], reads["strand"])
+        for pair, rows in annotation_groups.items():
+            if pair not in read_groups:
+                continue
+            r = read_groups[pair]
+            expr[s, rows], norm_reads[s, rows], read_counts[s, rows], overlapping[s, rows] = _sweep(
+                reads["start"][r],
+                reads["end"][r],
+                reads["expr"][r],
+                reads["count"][r],
+                annotations["start"][rows],
+                annotations["end"][rows],
+            )
+    return expr, norm_reads, read_counts, overlapping
+
+
+def rnaz_markers(rnaz):
+    """
+    Sample RNAz loci (as loaded by read_bed()) every 10 bases plus their last base,
+    like getExpression.pl did. Returns the chromosome codes and the sorted
+    (chromosome, position) keys of the samples; strand is ignored.
+    """
+    chrom_codes = dict((chrom, i) for i, chrom in enumerate(dict.fromkeys(rnaz["chrom"])))
+    codes = np.array([chrom_codes[chrom] for chrom in rnaz["chrom"]], dtype=np.int64)
+    counts = (rnaz["end"] - rnaz["start"]) // 10 + 1
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    positions = np.concatenate([np.repeat(rnaz["start"], counts) + 10 * offsets, rnaz["end"]])
+    keys = np.concatenate([np.repeat(codes, counts), codes]) * KEY_SHIFT + positions
+    return chrom_codes, np.unique(keys)
+
+
+def rnaz_flags(markers, annotations):
+    """Flag annotations containing an RNAz sample position of markers (see rnaz_markers())"""
+    chrom_codes, keys = markers
+    codes = np.array([chrom_codes.get(chrom, -1) for chrom in annotations["chrom"]], dtype=np.int64)
+    first = np.searchsorted(keys, codes * KEY_SHIFT + annotations["start"], side="left")
+    last = np.searchsorted(keys, codes * KEY_SHIFT + annotations["end"], side="right")
+    return ((first < last) & (codes >= 0)).astype(int)
+
+
+def _with_commas(text):
+    """Insert thousands separators into the leading integer digits of a formatted number"""
+    sign = "-" if text.startswith("-") else ""
+    text = text.lstrip("-")
+    digits = len(text) - len(text.lstrip("0123456789"))
+    integer, rest = text[:digits], text[digits:]
+    groups = [integer[max(0, i - 3) : i] for i in range(len(integer), 0, -3)][::-1]
+    return sign + ",".join(groups) + rest
+
+
+def browser_link(species_id, folder_id, chrom, start, end, wig):
+    """Link to the annotation in the genome browser, displaying the read density track"""
+    template = ARABIDOPSIS_LINK if species_id.startswith("ath") else UCSC_LINK
+    wig_url = "http://dario.bioinf.uni-leipzig.de/result/%s/%s" % (folder_id, wig)
+    return template.format(species=species_id, chrom=chrom, start=start - 50, end=end + 50, wig=wig_url)
+
+
+def expression_rows(reads_file, annotations):
+    """
+    Quantify annotations (a table as loaded by read_bed() with ANNOTATION_COLUMNS) with
+    the reads table reads_file (see columnar.py). Returns the indices of the annotation
+    rows with overlapping reads and their (expr, normReadCnt, readCnt) arrays.
+    """
+    reads = columnar.read_table(reads_file, READ_COLUMNS)
+    expr, norm_reads, read_counts, overlapping = quantify(reads, annotations)
+    rows = np.flatnonzero(overlapping > 0)
+    return rows, expr[rows], norm_reads[rows], read_counts[rows]
+
+
+def write_expression_rows(rows, annotations, output_file, rundir, pos_wig, neg_wig, species_id, rnaz=None):
+    """
+    Write the expression table (format of the former getExpression.pl) for rows as
+    returned by expression_rows(); rnaz are optional RNAz markers (see rnaz_markers()).
+    """
+    rows, expr, norm_reads, read_counts = rows
+    flags = rnaz_flags(rnaz, annotations) if rnaz else np.zeros(len(annotations["start"]), dtype=int)
+    lengths = annotations["end"][rows] - annotations["start"][rows] + 1
+    rpm = expr / lengths / read_total_read_count(os.path.join(rundir, "upload.info")) * 1000000
+    folder_id = os.path.basename(os.path.normpath(rundir))
+    with open(output_file, "w") as f:
+        for j, i in enumerate(rows):
+            chrom, start, end = annotations["chrom"][i], annotations["start"][i], annotations["end"][i]
+            strand = annotations["strand"][i]
+            link = browser_link(species_id, folder_id, chrom, start, end, pos_wig if strand == "+" else neg_wig)
+            cols = [
+                chrom,
+                str(start),
+                str(end),
+                annotations["id"][i],
+                annotations["score"][i],
+                strand,
+                annotations["type"][i],
+                "%.2e" % rpm[j],
+                _with_commas(format_perl_number(read_counts[j])),
+                _with_commas("%.2f" % norm_reads[j]),
+                link,
+                str(flags[i]),
+            ]
+            f.write("\t".join(cols) + "\n")
+
+
+def load_annotations(annotations):
+    """Load an annotation BED file with the ANNOTATION_COLUMNS; tables already loaded are passed through"""
+    return read_bed(annotations, ANNOTATION_COLUMNS) if isinstance(annotations, str) else annotations
+
+
+def write_expression_table(reads_file, annotations, output_file, rundir, pos_wig, neg_wig, species_id, rnaz=None):
+    """
+    Quantify annotations with the reads of reads_file and write the expression table
+    to output_file, see write_expression_rows(). Annotations without expression are
+    left out. annotations is a BED file name or a table as returned by load_annotations().
+    """
+    annotations = load_annotations(annotations)
+    rows = expression_rows(reads_file, annotations)
+    write_expression_rows(rows, annotations, output_file, rundir, pos_wig, neg_wig, species_id, rnaz)
@@ -0,0 +1,122 @@
+"""
+Columnar, pre-sorted index of the expression tables of a result, for serving
+sorted, filtered pages of them without reading whole tables (see the table API
+of dario_app.py).
+
+The analysis writes, for each table and ncRNA type, a directory
+tables/<table>/<ncRNA type>/ in the result directory with
+    meta.json            columns and number of rows
+    <column>.npy         values of a column (as shown), rows in the default order
+    <column>.order.npy   permutation of the rows sorting them by the column
+The webserver memory-maps these arrays, so a page costs about its rows.
+"""
+
+import json
+import os
+
+import numpy as np
+
+INDEX_DIR = "tables/"
+TABLES = ("ncRNA", "predictions", "user_annotation")
+# Indexed columns of an expression table (see expression.write_expression_rows) as (name, column)
+COLUMNS = [
+    ("chrom", 0),
+    ("start", 1),
+    ("end", 2),
+    ("id", 3),
+    ("score", 4),
+    ("strand", 5),
+    ("rpm", 7),
+    ("reads", 8),
+    ("normalized", 9),
+    ("link", 10),
+    ("rnaz", 11),
+]
+UNSORTED_COLUMNS = ("link",)
+# Stands for the job hash in stored links, so that results copied to another job hash stay valid
+JOB_PLACEHOLDER = "$JOB"
+
+
+def _sort_key(value):
+    """Numbers (also with thousands separators) by value before other values in text order"""
+    try:
+        return (0, float(value.replace(",", "")), "")
+    except ValueError:
+        return (1, 0.0, value)
+
+
+def _index_dir(result_dir, table, ncrna_type):
+    return os.path.join(result_dir, INDEX_DIR, table, ncrna_type)
+
+
+def write_table(result_dir, table, ncrna_type, rows):
+    """Index the rows (lists of strings, in the default order) of one ncRNA type of an expression table"""
+    directory = _index_dir(result_dir, table, ncrna_type)
+    os.makedirs(directory, exist_ok=True)
+    job_hash = os.path.basename(os.path.normpath(result_dir))
+    for name, column in COLUMNS:
+        values = [row[column] if column < len(row) else "" for row in rows]
+        if name == "link":
+            values = [v.replace(job_hash, JOB_PLACEHOLDER) for v in values]
+        np.save(os.path.join(directory, name + ".npy"), np.array([v.encode("utf-8") for v in values], dtype=bytes))
+        if name not in UNSORTED_COLUMNS:
+            order = sorted(range(len(values)), key=lambda i: _sort_key(values[i]))
+            np.save(os.path.join(directory, name + ".order.npy"), np.array(order, dtype=np.int32))
+    with open(os.path.join(directory, "meta.json"), "w") as f:
+        json.dump({"columns": [name for name, _ in COLUMNS], "rows": len(rows)}, f)
+
+
+class ExpressionTable:
+    """Index of one ncRNA type of an expression table, as written by write_table()"""
+
+    def __init__(self, directory, job_hash):
+        self.directory = directory
+        self.job_hash = job_hash
+        with open(os.path.join(directory, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.columns = self.meta["columns"]
+
+    def _load(self, name):
+        array = np.load(os.path.join(self.directory, name + ".npy"), mmap_mode="r")
+        return array if len(array) else np.zeros(0, dtype="S1")
+
+    def page(self, sort=None, descending=False, offset=0, limit=100, chrom=None, query=None):
+        """
+        Rows offset to offset + limit (as dicts by column) of the table sorted by column sort
+        (default order if None), with chromosome chrom and IDs containing query only, if given.
+        Raises KeyError for unknown columns.
+        """
+        if sort is None:
+            order = np.arange(self.meta["rows"])
+        elif sort in self.columns and sort not in UNSORTED_COLUMNS:
+            order = np.load(os.path.join(self.directory, sort + ".order.npy"), mmap_mode="r")
+        else:
+            raise KeyError(sort)
+        if descending:
+            order = order[::-1]
+
+        if chrom or query:
+            mask = np.ones(self.meta["rows"], dtype=bool)
+            if chrom:
+                mask &= self._load("chrom") == chrom.encode("utf-8")
+            if query:
+                ids = np.char.lower(np.asarray(self._load("id")))
+                mask &= np.char.find(ids, query.lower().encode("utf-8")) >= 0
+            order = order[mask[order]]
+
+        selected = np.asarray(order[offset : offset + limit])
+        values = {name: self._load(name)[selected] for name in self.columns}
+        rows = [{name: values[name][j].decode("utf-8") for name in self.columns} for j in range(len(selected))]
+        for row in rows:
+            row["link"] = row["link"].replace(JOB_PLACEHOLDER, self.job_hash)
+        return {"total": len(order), "offset": offset, "rows": rows}
+
+
+def open_table(result_dir, table, ncrna_type):
+    """The index of one ncRNA type of an expression table of a result, None if there is none"""
+    if table not in TABLES or ncrna_type in ("", ".", "..") or "/" in ncrna_type:
+        return None
+    directory = _index_dir(result_dir, table, ncrna_type)
+    if not os.path.exists(os.path.join(directory, "meta.json")):
+        return None
+    return ExpressionTable(directory, os.path.basename(os.path.normpath(result_dir)))
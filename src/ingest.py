@@ -0,0 +1,223 @@
+"""
+Ingestion of uploaded mapping loci and annotations.
+
+The webserver receives an upload in chunks into an IngestFile (the file stream
+of the upload request), which hashes the data, sniffs its format from the first
+bytes and stores a single compressed copy: plain BED is gzip-compressed on the
+fly, gzip (of BED or BAM), BAM and archives are stored as received. On the worker, unpack()
+turns that copy into the BED or BAM file the analysis starts from.
+"""
+
+import gzip
+import hashlib
+import os
+import shutil
+import tarfile
+import tempfile
+import zipfile
+import zlib
+
+import config
+from config import logger
+
+GZIP_MAGIC = b"\x1f\x8b"
+ZIP_MAGIC = b"PK\x03\x04"
+BAM_MAGIC = b"BAM\x01"
+# Bytes of an upload looked at to determine its format
+SNIFF_BYTES = 64 * 1024
+# Suffix of the stored copy per format; "bed" is compressed on ingestion
+SUFFIXES = {
+    "bed": ".bed.gz",
+    "gzip": ".bed.gz",
+    "bam": ".bam",
+    "gzip_bam": ".bam.gz",
+    "zip": ".zip",
+    "tar": ".tar.gz",
+}
+# Files archivers add next to the actual content
+ARCHIVE_METADATA = ("__MACOSX/", ".DS_Store", "Thumbs.db")
+
+
+def sniff(head):
+    """
+    Format of data starting with head: "bam", "zip", "tar" (gzip-compressed tar),
+    "gzip_bam" (gzip-compressed BAM, e.g. x.bam.gz), "gzip" (gzip-compressed BED) or "bed"
+    """
+    if head.startswith(ZIP_MAGIC):
+        return "zip"
+    if head.startswith(GZIP_MAGIC):
+        try:
+            data = zlib.decompressobj(31).decompress(head, 4096)
+        except zlib.error:
+            return "gzip"
+        if data.startswith(BAM_MAGIC):
+            return "bam"  # BGZF, whose first block starts with the BAM header
+        if data[257:262] == b"ustar":
+            return "tar"
+        if data.startswith(GZIP_MAGIC):
+            try:
+                if zlib.decompressobj(31).decompress(data, 4).startswith(BAM_MAGIC):
+                    return "gzip_bam"
+            except zlib.error:
+                pass
+        return "gzip"
+    return "bed"
+
+
+class IngestFile:
+    """
+    Writable file receiving an upload into a temporary file in directory; see
+    the module description. Werkzeug seeks to the start once the upload is
+    complete, which finishes the file.
+    """
+
+    def __init__(self, directory):
+        fd, self.tmp_path = tempfile.mkstemp(prefix=".ingest-", dir=directory)
+        self.file = os.fdopen(fd, "wb")
+        self.digest = hashlib.sha256()
+        self.size = 0
+        self.format = None
+        self.head = b""
+        self.compressor = None
+        self.path = None
+
+    def write(self, data):
+        self.digest.update(data)
+        self.size += len(data)
+        if self.format is not None:
+            self._write(data)
+        else:
+            self.head += data
+            if len(self.head) >= SNIFF_BYTES:
+                self._start()
+        return len(data)
+
+    def _start(self):
+        self.format = sniff(self.head)
+        if self.format == "bed":
+            self.compressor = zlib.compressobj(config.UPLOAD_COMPRESSION_LEVEL, zlib.DEFLATED, 31)
+        head, self.head = self.head, b""
+        self._write(head)
+
+    def _write(self, data):
+        if self.compressor:
+            data = self.compressor.compress(data)
+        self.file.write(data)
+
+    def finish(self):
+        """Write out all received data"""
+        if self.file.closed:
+            return
+        if self.format is None:
+            self._start()
+        if self.compressor:
+            self.file.write(self.compressor.flush())
+        self.file.close()
+
+    def seek(self, offset, whence=0):
+        self.finish()
+        return 0
+
+    def hexdigest(self):
+        """SHA-256 of the upload as received"""
+        self.finish()
+        return self.digest.hexdigest()
+
+    def save(self, directory, basename):
+        """Move the stored copy to directory as basename plus the suffix of its format, returns the filename"""
+        self.finish()
+        self.path = directory + basename + SUFFIXES[self.format]
+        os.rename(self.tmp_path, self.path)
+        return self.path
+
+    def close(self):
+        """Remove the stored copy unless it was saved"""
+        self.finish()
+        if self.path is None and os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+
+def ingest_file(filename, directory, basename):
+    """Store the file filename in directory like an upload, returns the IngestFile"""
+    upload = IngestFile(directory)
+    try:
+        with open(filename, "rb") as f:
+            shutil.copyfileobj(f, upload, 1024 * 1024)
+        upload.save(directory, basename)
+    finally:
+        upload.close()
+    return upload
+
+
+def describe(filename):
+    """(SHA-256, format) of a file, as an IngestFile would report for it"""
+    digest = hashlib.sha256()
+    with open(filename, "rb") as f:
+        head = f.read(SNIFF_BYTES)
+        digest.update(head)
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest(), sniff(head)
+
+
+def stored_file(directory, basename):
+    """Filename of the stored upload basename in directory, None if there is none"""
+    for suffix in sorted(set(SUFFIXES.values())):
+        if os.path.exists(directory + basename + suffix):
+            return directory + basename + suffix
+    return None
+
+
+def _is_metadata(name):
+    return any(name.startswith(m) or os.path.basename(name) == m for m in ARCHIVE_METADATA)
+
+
+def _unpack_member(source, directory, basename):
+    """Write the single file of an archive to directory as basename.bed or basename.bam"""
+    head = source.read(SNIFF_BYTES)
+    file_format = sniff(head)
+    if file_format not in ("bed", "bam"):
+        raise IOError(f"Archive contains a {file_format} file instead of a BED or BAM file")
+    target = directory + basename + "." + file_format
+    with open(target, "wb") as f:
+        f.write(head)
+        shutil.copyfileobj(source, f, 1024 * 1024)
+    return target
+
+
+def unpack(directory, basename):
+    """
+    Turn the stored upload basename in directory into basename.bed or basename.bam
+    (a stored BAM is used as is) and return its filename. Raises IOError if there is
+    no upload or an archive does not contain exactly one file.
+    """
+    legacy = directory + basename + ".upload"
+    if os.path.exists(legacy):
+        # jobs received before ingestion on upload
+        ingest_file(legacy, directory, basename)
+        os.remove(legacy)
+
+    stored = stored_file(directory, basename)
+    if stored is None:
+        raise IOError(f"No upload {basename} found in {directory}")
+    logger.info(f"Unpacking {stored}")
+
+    if stored.endswith(".bam"):
+        return stored
+    if stored.endswith(".bed.gz") or stored.endswith(".bam.gz"):
+        target = stored[: -len(".gz")]
+        with gzip.open(stored, "rb") as source, open(target, "wb") as f:
+            shutil.copyfileobj(source, f, 1024 * 1024)
+        return target
+    if stored.endswith(".zip"):
+        with zipfile.ZipFile(stored) as archive:
+            members = [m for m in archive.infolist() if not m.is_dir() and not _is_metadata(m.filename)]
+            if len(members) != 1:
+                raise IOError(f"Archive contains {len(members)} files instead of one")
+            with archive.open(members[0]) as source:
+                return _unpack_member(source, directory, basename)
+    with tarfile.open(stored, "r:gz") as archive:
+        members = [m for m in archive.getmembers() if m.isfile() and not _is_metadata(m.name)]
+        if len(members) != 1:
+            raise IOError(f"Archive contains {len(members)} files instead of one")
+        return _unpack_member(archive.extractfile(members[0]), directory, basename)
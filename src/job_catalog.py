@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+"""
+Catalog of all jobs received by the webserver, for the finished jobs page.
+
+One row per job in a SQLite database (config.JOB_CATALOG_FILENAME in the
+webserver jobs directory), indexed by time, species and status. Jobs are added
+on upload and updated by the webserver daemon once their result has arrived,
+from the job parameters of the result, so listing jobs never touches the
+results directory. Jobs of the former all_jobs.list are imported with
+    python3 job_catalog.py import
+"""
+
+import sqlite3
+import sys
+from contextlib import closing
+
+import config
+
+SUBMITTED = "submitted"
+DONE = "done"
+FAILED = "failed"
+
+CATALOG_DB = config.WEBSERVER_JOBS_PATH + config.JOB_CATALOG_FILENAME
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS catalog (
+    hash TEXT PRIMARY KEY,
+    received_at TEXT NOT NULL,
+    code TEXT,
+    filename TEXT,
+    email TEXT,
+    remote_ip TEXT,
+    status TEXT NOT NULL,
+    cached INTEGER NOT NULL DEFAULT 0,
+    analysis_ok INTEGER,
+    prediction_ok INTEGER
+);
+CREATE INDEX IF NOT EXISTS catalog_time ON catalog (received_at);
+CREATE INDEX IF NOT EXISTS catalog_code ON catalog (code, received_at);
+CREATE INDEX IF NOT EXISTS catalog_status ON catalog (status, received_at);
+"""
+COLUMNS = (
+    "hash",
+    "received_at",
+    "code",
+    "filename",
+    "email",
+    "remote_ip",
+    "status",
+    "cached",
+    "analysis_ok",
+    "prediction_ok",
+)
+
+
+def connect(db_path=None):
+    """Open the catalog in autocommit mode, creating the schema if needed"""
+    connection = sqlite3.connect(db_path or CATALOG_DB, timeout=30, isolation_level=None)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def add(job_hash, received_at, code, filename, email, remote_ip, cached=False):
+    """Add a job received at received_at ("%Y-%m-%d %H:%M:%S")"""
+    with closing(connect()) as db:
+        db.execute(
+            "INSERT OR IGNORE INTO catalog (hash, received_at, code, filename, email, remote_ip, status, cached) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (job_hash, received_at, code, filename, email, remote_ip, SUBMITTED, int(cached)),
+        )
+
+
+def read_result_params(job_hash):
+    """Job parameters of the result of a job, empty if there is no result"""
+    params = {}
+    try:
+        with open(config.WEBSERVER_RESULTS_PATH + job_hash + "/" + config.PARAMS_FILENAME) as f:
+            for line in f:
+                cols = line.rstrip("\n").split("\t", 1)
+                if len(cols) > 1:
+                    params[cols[0]] = cols[1]
+    except IOError:
+        pass
+    return params
+
+
+def record_result(job_hash, params):
+    """Update a job from the job parameters of its result"""
+    analysis_ok = params.get("job_completed_succesfully") == "1"
+    with closing(connect()) as db:
+        db.execute(
+            "UPDATE catalog SET status = ?, analysis_ok = ?, prediction_ok = ? WHERE hash = ?",
+            (
+                DONE if analysis_ok else FAILED,
+                int(analysis_ok),
+                int(params.get("prediction_succesful") == "1"),
+                job_hash,
+            ),
+        )
+
+
+def pending():
+    """Hashes of the jobs without result yet"""
+    with closing(connect()) as db:
+        return [row[0] for row in db.execute("SELECT hash FROM catalog WHERE status = ?", (SUBMITTED,))]
+
+
+def search(offset=0, limit=100, code=None, status=None, since=None, until=None):
+    """
+    Jobs (as dicts, newest first) offset to offset + limit, with species code, status and
+    received between the dates since and until (inclusive, "%Y-%m-%d"), if given; and the
+    number of all matching jobs
+    """
+    conditions, args = [], []
+    if code:
+        conditions.append("code = ?")
+        args.append(code)
+    if status:
+        conditions.append("status = ?")
+        args.append(status)
+    if since:
+        conditions.append("received_at >= ?")
+        args.append(since)
+    if until:
+        conditions.append("received_at < ?")
+        args.append(until + "~")  # after all times of that day
+    where = (" WHERE " + " AND ".join(conditions)) if conditions else ""
+    with closing(connect()) as db:
+        total = db.execute("SELECT COUNT(*) FROM catalog" + where, args).fetchone()[0]
+        rows = db.execute(
+            "SELECT %s FROM catalog%s ORDER BY received_at DESC LIMIT ? OFFSET ?" % (", ".join(COLUMNS), where),
+            args + [limit, offset],
+        ).fetchall()
+    return [dict(zip(COLUMNS, row)) for row in rows], total
+
+
+def import_list(filename):
+    """Import the jobs of a former all_jobs.list (with their results), returns the number of lines read"""
+    count = 0
+    with open(filename, encoding="utf-8") as f:
+        for line in f:
+            cols = line.rstrip("\n").split("|")
+            if len(cols) < 6:
+                continue
+            received_at, job_hash, code, job_filename, email, remote_ip = cols[:6]
+            add(job_hash, received_at, code, job_filename, email, remote_ip)
+            # jobs without result are long gone, they count as failed
+            record_result(job_hash, read_result_params(job_hash))
+            count += 1
+    return count
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["import"]:
+        sys.exit("usage: job_catalog.py import")
+    print(import_list(config.WEBSERVER_JOBS_PATH + config.ALL_JOBS_FILENAME), "jobs imported")
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+"""
+Job queue backed by SQLite (WAL mode), one database on the webserver and one on the worker.
+
+A job moves through the states
+    new -> transferring -> queued -> running -> done | failed
+where the webserver database tracks all of them (for the wait page) and the
+worker database the states from queued on. Every transition is a single
+transaction, so concurrent daemons and threads can neither lose nor duplicate
+jobs; jobs are looked up by their hash through a unique index.
+
+The other machine updates a database through the command line, which also
+wakes up the daemon of that machine:
+    python3 job_queue.py {webserver|worker} submit HASH EMAIL CODE FILENAME [STATE]
+    python3 job_queue.py {webserver|worker} set-state HASH STATE
+"""
+
+import sqlite3
+import sys
+import time
+from contextlib import closing
+
+import config
+import notify
+
+NEW = "new"
+TRANSFERRING = "transferring"
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+WAITING_STATES = (NEW, TRANSFERRING, QUEUED)
+
+WEBSERVER_DB = config.WEBSERVER_JOBS_PATH + config.JOB_DB_FILENAME
+WORKER_DB = config.WORKER_JOBS_PATH + config.JOB_DB_FILENAME
+DATABASES = {"webserver": WEBSERVER_DB, "worker": WORKER_DB}
+
+# Wakeup sockets of the daemons processing the queues, see notify.py
+WEBSERVER_SOCKET = config.WEBSERVER_JOBS_PATH + config.WAKEUP_SOCKET_FILENAME
+WORKER_SOCKET = config.WORKER_JOBS_PATH + config.WAKEUP_SOCKET_FILENAME
+SOCKETS = {"webserver": WEBSERVER_SOCKET, "worker": WORKER_SOCKET}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    hash TEXT NOT NULL UNIQUE,
+    email TEXT,
+    code TEXT,
+    filename TEXT,
+    state TEXT NOT NULL,
+    submitted_at REAL,
+    updated_at REAL,
+    attempts INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, id);
+CREATE INDEX IF NOT EXISTS jobs_updated ON jobs (updated_at);
+"""
+COLUMNS = ("id", "hash", "email", "code", "filename", "state", "submitted_at", "updated_at", "attempts")
+
+
+def connect(db_path):
+    """Open the database in autocommit mode (transactions are explicit), creating the schema if needed"""
+    connection = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    connection.executescript(SCHEMA)
+    if "attempts" not in [row[1] for row in connection.execute("PRAGMA table_info(jobs)")]:
+        try:  # databases of older versions
+            connection.execute("ALTER TABLE jobs ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0")
+        except sqlite3.OperationalError:
+            pass  # added by another process meanwhile
+    return connection
+
+
+def _as_dict(row):
+    return dict(zip(COLUMNS, row)) if row else None
+
+
+def submit(db_path, job_hash, email, code, filename, state=NEW):
+    """Add a job; submitting a hash twice is a no-op. Returns whether the job was added."""
+    now = time.time()
+    with closing(connect(db_path)) as db:
+        cursor = db.execute(
+            "INSERT OR IGNORE INTO jobs (hash, email, code, filename, state, submitted_at, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (job_hash, email, code, filename, state, now, now),
+        )
+        return cursor.rowcount == 1
+
+
+def claim(db_path, from_state, to_state, exclude=()):
+    """
+    Atomically move the oldest job in from_state, except the hashes in exclude, to to_state
+    and return it (None if there is none)
+    """
+    exclude = list(exclude)
+    with closing(connect(db_path)) as db:
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            job = _as_dict(
+                db.execute(
+                    "SELECT %s FROM jobs WHERE state = ? AND hash NOT IN (%s) ORDER BY id LIMIT 1"
+                    % (", ".join(COLUMNS), ", ".join("?" * len(exclude))),
+                    [from_state] + exclude,
+                ).fetchone()
+            )
+            if job is not None:
+                db.execute("UPDATE jobs SET state = ?, updated_at = ? WHERE id = ?", (to_state, time.time(), job["id"]))
+                job["state"] = to_state
+            db.execute("COMMIT")
+        except:
+            db.execute("ROLLBACK")
+            raise
+    return job
+
+
+def peek(db_path, state):
+    """Return the oldest job in state without claiming it (None if there is none)"""
+    with closing(connect(db_path)) as db:
+        return _as_dict(
+            db.execute(
+                "SELECT %s FROM jobs WHERE state = ? ORDER BY id LIMIT 1" % ", ".join(COLUMNS), (state,)
+            ).fetchone()
+        )
+
+
+def set_state(db_path, job_hash, state, expected=None):
+    """Set the state of a job, only if it is in the expected state (if given). Returns whether it changed."""
+    with closing(connect(db_path)) as db:
+        if expected is None:
+            cursor = db.execute(
+                "UPDATE jobs SET state = ?, updated_at = ? WHERE hash = ?", (state, time.time(), job_hash)
+            )
+        else:
+            cursor = db.execute(
+                "UPDATE jobs SET state = ?, updated_at = ? WHERE hash = ? AND state = ?",
+                (state, time.time(), job_hash, expected),
+            )
+        return cursor.rowcount == 1
+
+
+def count_attempt(db_path, job_hash):
+    """Count a failed attempt to process a job, returns the number of failed attempts so far"""
+    with closing(connect(db_path)) as db:
+        db.execute("UPDATE jobs SET attempts = attempts + 1 WHERE hash = ?", (job_hash,))
+        row = db.execute("SELECT attempts FROM jobs WHERE hash = ?", (job_hash,)).fetchone()
+    return row[0] if row else 0
+
+
+def complete(db_path, job_hash):
+    """Mark a running job as done"""
+    return set_state(db_path, job_hash, DONE, RUNNING)
+
+
+def fail(db_path, job_hash):
+    """Mark a running job as failed"""
+    return set_state(db_path, job_hash, FAILED, RUNNING)
+
+
+def reset(db_path, from_state, to_state):
+    """Move all jobs in from_state back to to_state, e.g. jobs interrupted by a daemon restart"""
+    with closing(connect(db_path)) as db:
+        return db.execute(
+            "UPDATE jobs SET state = ?, updated_at = ? WHERE state = ?", (to_state, time.time(), from_state)
+        ).rowcount
+
+
+def get(db_path, job_hash):
+    """Return the job with the given hash as dict, None if unknown"""
+    with closing(connect(db_path)) as db:
+        return _as_dict(db.execute("SELECT %s FROM jobs WHERE hash = ?" % ", ".join(COLUMNS), (job_hash,)).fetchone())
+
+
+def position(db_path, job):
+    """1-based position of a waiting job among all waiting jobs"""
+    with closing(connect(db_path)) as db:
+        return sum(
+            db.execute("SELECT COUNT(*) FROM jobs WHERE state = ? AND id <= ?", (state, job["id"])).fetchone()[0]
+            for state in WAITING_STATES
+        )
+
+
+def remote(transport, database, *args):
+    """Run this module's command line on another machine through a transport.py transport, returns the exit code"""
+    return transport.call(["python3", transport.source_path + "job_queue.py", database] + [str(arg) for arg in args])
+
+
+if __name__ == "__main__":
+    usage = "usage: job_queue.py {webserver|worker} {submit HASH EMAIL CODE FILENAME [STATE] | set-state HASH STATE}"
+    if len(sys.argv) < 4 or sys.argv[1] not in DATABASES:
+        sys.exit(usage)
+    db_path, command, args = DATABASES[sys.argv[1]], sys.argv[2], sys.argv[3:]
+    if command == "submit" and len(args) in (4, 5):
+        submit(db_path, *args)
+    elif command == "set-state" and len(args) == 2:
+        set_state(db_path, *args)
+    else:
+        sys.exit(usage)
+    # let the daemon of this machine act on the change right away
+    notify.notify(SOCKETS[sys.argv[1]])
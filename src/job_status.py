@@ -0,0 +1,109 @@
+"""
+In-memory index of the states and queue positions of the jobs in the webserver
+queue, for the wait pages.
+
+The index is loaded from the job database once per process. A background thread
+then reads only the jobs changed since its last refresh (every
+config.STATUS_REFRESH_INTERVAL seconds), so looking up a job needs no database
+access, and wakes up everybody waiting for changes (see wait()).
+"""
+
+import bisect
+import threading
+import time
+from contextlib import closing
+
+import config
+import job_queue
+from config import logger
+
+# Changes committed this many seconds after their timestamp (by concurrent transactions) are still picked up
+REFRESH_OVERLAP = 5
+
+
+class StatusIndex:
+    """States and queue positions of the jobs of a job database"""
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.jobs = {}  # hash -> (id, state)
+        self.waiting = []  # sorted ids of the waiting jobs
+        self.version = 0  # increased by each refresh that changed jobs
+        self.last_update = 0
+        self.condition = threading.Condition()
+        self.start_lock = threading.Lock()
+        self.thread = None
+
+    def _apply(self, rows):
+        """Apply changed jobs, returns whether any job changed"""
+        changed = False
+        for job_id, job_hash, state in rows:
+            old = self.jobs.get(job_hash)
+            if old == (job_id, state):
+                continue
+            if old is not None and old[1] in job_queue.WAITING_STATES:
+                del self.waiting[bisect.bisect_left(self.waiting, old[0])]
+            if state in job_queue.WAITING_STATES:
+                bisect.insort(self.waiting, job_id)
+            self.jobs[job_hash] = (job_id, state)
+            changed = True
+        return changed
+
+    def refresh(self):
+        """Read the jobs changed since the last refresh"""
+        with closing(job_queue.connect(self.db_path)) as db:
+            rows = db.execute(
+                "SELECT id, hash, state, updated_at FROM jobs WHERE updated_at >= ?",
+                (self.last_update - REFRESH_OVERLAP,),
+            ).fetchall()
+        with self.condition:
+            if rows:
+                self.last_update = max(self.last_update, max(row[3] for row in rows))
+            if self._apply(row[:3] for row in rows):
+                self.version += 1
+                self.condition.notify_all()
+
+    def _run(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception:
+                logger.exception("Job status could not be refreshed")
+            time.sleep(config.STATUS_REFRESH_INTERVAL)
+
+    def start(self):
+        """Load the index and start refreshing it in the background, if not done yet"""
+        if self.thread is not None:
+            return
+        with self.start_lock:
+            if self.thread is None:
+                self.refresh()
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+
+    def get(self, job_hash):
+        """State and (for waiting jobs) 1-based queue position of a job as dict, None if unknown"""
+        self.start()
+        with self.condition:
+            job = self.jobs.get(job_hash)
+            if job is None:
+                return None
+            job_id, state = job
+            position = bisect.bisect_right(self.waiting, job_id) if state in job_queue.WAITING_STATES else None
+            return {"state": state, "position": position}
+
+    def wait(self, version, timeout):
+        """Block until a refresh after version changed jobs, or timeout seconds passed; returns the current version"""
+        self.start()
+        with self.condition:
+            self.condition.wait_for(lambda: self.version != version, timeout)
+            return self.version
+
+    def counts(self):
+        """Number of jobs per state"""
+        self.start()
+        with self.condition:
+            counts = {}
+            for _, state in self.jobs.values():
+                counts[state] = counts.get(state, 0) + 1
+            return counts
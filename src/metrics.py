@@ -0,0 +1,212 @@
+"""
+Resource usage of the analysis steps, and its aggregation for monitoring.
+
+The pipeline measures every step: wall time, CPU time of the step's thread and
+of the processes it started (resource.RUSAGE_CHILDREN), and the peak memory of
+the job so far. analyze() adds the sizes of the step outputs and stores the figures
+in job_params.txt (one "step:value,..." key per figure, as step_seconds) and in
+full in the JSON sidecar config.METRICS_FILENAME of the result.
+
+On the webserver, the daemon loads the sidecars of arriving results into the job
+catalog database. The /metrics endpoint of dario_app.py serves totals per step
+from there, in the Prometheus text format, together with the queue depth and the
+worker slot usage.
+"""
+
+import json
+import os
+import resource
+from contextlib import closing
+
+import config
+import job_catalog
+import job_queue
+
+# Per thread CPU time where available (Linux), concurrent steps run in threads
+RUSAGE_THREAD = getattr(resource, "RUSAGE_THREAD", resource.RUSAGE_SELF)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS step_metrics (
+    hash TEXT NOT NULL,
+    step TEXT NOT NULL,
+    status TEXT NOT NULL,
+    wall_seconds REAL,
+    cpu_seconds REAL,
+    children_cpu_seconds REAL,
+    peak_rss_kb INTEGER,
+    output_bytes INTEGER,
+    PRIMARY KEY (hash, step)
+);
+"""
+STEP_FIELDS = ("status", "wall_seconds", "cpu_seconds", "children_cpu_seconds", "peak_rss_kb", "output_bytes")
+# Figures stored in job_params.txt as key "step_<figure>"
+PARAMS_FIGURES = ("cpu_seconds", "children_cpu_seconds", "peak_rss_kb", "output_bytes")
+
+
+def _cpu_seconds(usage):
+    return usage.ru_utime + usage.ru_stime
+
+
+def snapshot():
+    """Resource usage of the current thread and of the finished child processes, for usage_since()"""
+    return resource.getrusage(RUSAGE_THREAD), resource.getrusage(resource.RUSAGE_CHILDREN)
+
+
+def usage_since(start):
+    """
+    CPU time of the current thread and of the child processes finished since snapshot start,
+    and the peak memory (kB) of this process and its children so far. The child figures
+    are process-wide, so steps running concurrently share them.
+    """
+    thread, children = snapshot()
+    return {
+        "cpu_seconds": _cpu_seconds(thread) - _cpu_seconds(start[0]),
+        "children_cpu_seconds": _cpu_seconds(children) - _cpu_seconds(start[1]),
+        "peak_rss_kb": max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, children.ru_maxrss),
+    }
+
+
+def output_bytes(rundir, outputs):
+    """Total size of the existing outputs (files or directories) of a step"""
+    total = 0
+    for output in outputs:
+        path = os.path.join(rundir, output)
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                total += sum(os.path.getsize(os.path.join(root, f)) for f in files)
+        elif os.path.exists(path):
+            total += os.path.getsize(path)
+    return total
+
+
+def step_metrics(steps, rundir):
+    """Figures of the steps run by a pipeline.Pipeline, as dict step -> dict of STEP_FIELDS"""
+    metrics = {}
+    for name, seconds in steps.durations().items():
+        figures = {"status": steps.status.get(name, "running"), "wall_seconds": round(seconds, 3)}
+        figures.update((k, round(v, 3)) for k, v in steps.usage.get(name, {}).items())
+        figures["output_bytes"] = output_bytes(rundir, steps.steps[name].outputs)
+        metrics[name] = figures
+    return metrics
+
+
+def params_figures(metrics):
+    """Figures of step_metrics() as job_params.txt entries"""
+    return dict(
+        (
+            "step_" + figure,
+            ",".join("%s:%s" % (name, _format(figures.get(figure, 0))) for name, figures in metrics.items()),
+        )
+        for figure in PARAMS_FIGURES
+    )
+
+
+def _format(value):
+    return "%.1f" % value if isinstance(value, float) else str(value)
+
+
+def write_sidecar(rundir, job_infos, metrics):
+    """Write the metrics of a job to its JSON sidecar, with the totals of the analysis process"""
+    own, children = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+    with open(rundir + config.METRICS_FILENAME, "w") as f:
+        json.dump(
+            {
+                "hash": job_infos.get("hash"),
+                "code": job_infos.get("code"),
+                "job_start_time": job_infos.get("job_start_time"),
+                "critical_path": job_infos.get("critical_path"),
+                "cpu_seconds": round(_cpu_seconds(own), 3),
+                "children_cpu_seconds": round(_cpu_seconds(children), 3),
+                "peak_rss_kb": max(own.ru_maxrss, children.ru_maxrss),
+                "steps": metrics,
+            },
+            f,
+            indent=1,
+        )
+
+
+def connect():
+    """The job catalog database with the step metrics table"""
+    db = job_catalog.connect()
+    db.executescript(SCHEMA)
+    return db
+
+
+def record_job(job_hash):
+    """Load the sidecar of the result of a job, returns whether there was one"""
+    try:
+        with open(config.WEBSERVER_RESULTS_PATH + job_hash + "/" + config.METRICS_FILENAME) as f:
+            steps = json.load(f)["steps"]
+    except (IOError, ValueError, KeyError):
+        return False
+    with closing(connect()) as db:
+        db.executemany(
+            "INSERT OR REPLACE INTO step_metrics (hash, step, %s) VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+            % ", ".join(STEP_FIELDS),
+            [(job_hash, name) + tuple(figures.get(field) for field in STEP_FIELDS) for name, figures in steps.items()],
+        )
+    return True
+
+
+def _sample(name, labels, value):
+    label_text = ",".join('%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in labels)
+    return "%s{%s} %s" % (name, label_text, value) if label_text else "%s %s" % (name, value)
+
+
+def _metric(lines, name, metric_type, help_text, samples):
+    lines.append("# HELP %s %s" % (name, help_text))
+    lines.append("# TYPE %s %s" % (name, metric_type))
+    lines.extend(_sample(name, labels, value) for labels, value in samples)
+
+
+def render(job_states, slots_busy, slots_total):
+    """
+    The metrics in the Prometheus text format, from the numbers of webserver queue jobs per state,
+    the busy and total worker slots and the step metrics of all recorded jobs
+    """
+    with closing(connect()) as db:
+        steps = db.execute(
+            "SELECT step, status, COUNT(*), SUM(wall_seconds), SUM(cpu_seconds + children_cpu_seconds), "
+            "MAX(peak_rss_kb), SUM(output_bytes) FROM step_metrics GROUP BY step, status ORDER BY step, status"
+        ).fetchall()
+        catalog = db.execute("SELECT status, COUNT(*) FROM catalog GROUP BY status ORDER BY status").fetchall()
+
+    lines = []
+    _metric(
+        lines,
+        "dario_queue_jobs",
+        "gauge",
+        "Jobs in the webserver queue by state",
+        [((("state", state),), count) for state, count in sorted(job_states.items())],
+    )
+    _metric(
+        lines,
+        "dario_queue_depth",
+        "gauge",
+        "Jobs waiting for a worker slot",
+        [((), sum(count for state, count in job_states.items() if state in job_queue.WAITING_STATES))],
+    )
+    _metric(lines, "dario_worker_slots_busy", "gauge", "Worker slots running a job", [((), slots_busy)])
+    _metric(lines, "dario_worker_slots_total", "gauge", "Worker slots", [((), slots_total)])
+    _metric(
+        lines,
+        "dario_jobs_total",
+        "counter",
+        "Jobs received by the webserver by status",
+        [((("status", status),), count) for status, count in catalog],
+    )
+    for name, metric_type, help_text, column, scale in (
+        ("dario_step_runs_total", "counter", "Runs of analysis steps", 2, 1),
+        ("dario_step_wall_seconds_total", "counter", "Wall time of analysis steps", 3, 1),
+        ("dario_step_cpu_seconds_total", "counter", "CPU time of analysis steps and their subprocesses", 4, 1),
+        ("dario_step_peak_rss_bytes", "gauge", "Highest peak memory of a job by the end of a step", 5, 1024),
+        ("dario_step_output_bytes_total", "counter", "Size of the outputs of analysis steps", 6, 1),
+    ):
+        _metric(
+            lines,
+            name,
+            metric_type,
+            help_text,
+            [((("step", row[0]), ("status", row[1])), (row[column] or 0) * scale) for row in steps],
+        )
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+"""
+Store of trained classifier models on the worker, shared by all jobs.
+
+Training the cluster classifier (classifier.py) costs far more than applying it,
+and jobs of a species often have similar known ncRNA clusters. Models are stored
+with their statistics under a fingerprint of the training clusters: per ncRNA
+class, its size on a logarithmic scale and the histograms of the features over
+logarithmic bins, with the shares rounded to multiples of 1 / SHARE_LEVELS. A job
+whose training clusters have the fingerprint of a stored model reuses it instead
+of training; its statistics then hold the error of the stored model on the job's
+own clusters, under the fingerprint. Entries live in config.MODEL_STORE_PATH, one directory per
+fingerprint, and are evicted least recently used first beyond
+config.MODEL_STORE_MAX_ENTRIES. Hits and misses are counted in a small SQLite
+database there, shown by
+    python3 model_store.py
+"""
+
+import hashlib
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+from contextlib import closing
+
+import numpy as np
+
+import config
+from config import logger
+import classifier
+
+MODEL_FILENAME = "my.model"
+STATISTICS_FILENAME = "my.modelstat"
+LAST_USED_FILENAME = ".last_used"
+COUNTERS_FILENAME = "counters.db"
+# Width of the histogram bins of the features, in sign(x) * log2(1 + |x|)
+BIN_WIDTH = 0.5
+SHARE_LEVELS = 20
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+
+def fingerprint(X, y, species_id):
+    """Fingerprint of a training set (feature matrix X, class indexes y) of a species"""
+    digest = hashlib.sha256(
+        "\0".join([config.MODEL_STORE_VERSION, species_id, str(classifier.TREES), str(classifier.FOLDS)]).encode()
+    )
+    sizes = np.bincount(y, minlength=len(classifier.CLASSES))
+    digest.update(np.round(2 * np.log2(sizes + 1)).astype(np.int64).tobytes())
+    bins = np.floor(np.sign(X) * np.log2(1 + np.abs(X)) / BIN_WIDTH).astype(np.int64)
+    for c in range(len(classifier.CLASSES)):
+        rows = bins[y == c]
+        for f in range(rows.shape[1] if len(rows) else 0):
+            values, counts = np.unique(rows[:, f], return_counts=True)
+            shares = np.round(counts * SHARE_LEVELS / float(len(rows))).astype(np.int64)
+            digest.update(np.array([c, f]).tobytes() + values[shares > 0].tobytes() + shares[shares > 0].tobytes())
+    return digest.hexdigest()
+
+
+def _entry_dir(key):
+    return config.MODEL_STORE_PATH + key + "/"
+
+
+def connect():
+    """Open the counters database in autocommit mode, creating the store if needed"""
+    os.makedirs(config.MODEL_STORE_PATH, exist_ok=True)
+    connection = sqlite3.connect(config.MODEL_STORE_PATH + COUNTERS_FILENAME, timeout=30, isolation_level=None)
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def count(name):
+    with closing(connect()) as db:
+        db.execute("INSERT OR IGNORE INTO counters (name, value) VALUES (?, 0)", (name,))
+        db.execute("UPDATE counters SET value = value + 1 WHERE name = ?", (name,))
+
+
+def counters():
+    """Counters of the store (hits, misses, stored, evicted) as dict"""
+    with closing(connect()) as db:
+        return dict(db.execute("SELECT name, value FROM counters").fetchall())
+
+
+def fetch(key, model_file):
+    """Copy the model stored under key, returns False if there is none"""
+    entry = _entry_dir(key)
+    try:
+        shutil.copyfile(entry + MODEL_FILENAME, model_file)
+    except IOError:
+        return False
+    with open(entry + LAST_USED_FILENAME, "w"):
+        pass  # the modification time tracks the last use
+    return True
+
+
+def store(key, model_file, statistics_file):
+    """Add a trained model and its statistics under key"""
+    entry = _entry_dir(key)
+    if os.path.exists(entry):
+        return
+    tmp = tempfile.mkdtemp(prefix="." + key, dir=config.MODEL_STORE_PATH)
+    try:
+        shutil.copyfile(model_file, tmp + "/" + MODEL_FILENAME)
+        shutil.copyfile(statistics_file, tmp + "/" + STATISTICS_FILENAME)
+        with open(tmp + "/" + LAST_USED_FILENAME, "w"):
+            pass
+        os.rename(tmp, entry)
+    except OSError:
+        shutil.rmtree(tmp, ignore_errors=True)
+        if not os.path.exists(entry):  # else stored by a concurrent job meanwhile
+            raise
+        return
+    count("stored")
+
+
+def evict(max_entries=None):
+    """Remove least recently used entries until at most max_entries are left"""
+    max_entries = config.MODEL_STORE_MAX_ENTRIES if max_entries is None else max_entries
+    entries = []
+    for key in os.listdir(config.MODEL_STORE_PATH):
+        if key.startswith("."):
+            continue  # being written
+        try:
+            entries.append((os.path.getmtime(_entry_dir(key) + LAST_USED_FILENAME), key))
+        except OSError:
+            continue  # the counters
+    for _, key in sorted(entries)[: max(len(entries) - max_entries, 0)]:
+        shutil.rmtree(_entry_dir(key), ignore_errors=True)
+        count("evicted")
+        logger.info(f"Evicted stored classifier model {key}")
+
+
+def train_file(training_file, model_file, statistics_file, species_id):
+    """
+    As classifier.train_file(), but reuses the stored model of the fingerprint of the training
+    clusters if there is one. Returns the fingerprint if the model was reused, else None.
+    """
+    X, y = classifier.read_training_set(training_file)
+    key = fingerprint(X, y, species_id)
+    if fetch(key, model_file):
+        count("hits")
+        model = classifier.load_model(model_file)
+        # the statistics of the stored model count the clusters of the job it was trained for
+        classifier.write_statistics(
+            statistics_file, training_file, model, classifier.confusion_matrix(model, X, y), None, 0, key
+        )
+        return key
+    count("misses")
+    classifier.train_file(training_file, model_file, statistics_file)
+    store(key, model_file, statistics_file)
+    evict()
+    return None
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        sys.exit("usage: model_store.py")
+    values = counters()
+    lookups = values.get("hits", 0) + values.get("misses", 0)
+    entries = [key for key in os.listdir(config.MODEL_STORE_PATH) if os.path.isdir(_entry_dir(key)) and key[0] != "."]
+    print("entries\t%d (max %d)" % (len(entries), config.MODEL_STORE_MAX_ENTRIES))
+    for name in ("hits", "misses", "stored", "evicted"):
+        print("%s\t%d" % (name, values.get(name, 0)))
+    print("hit rate\t%.1f%%" % (100.0 * values.get("hits", 0) / lookups if lookups else 0.0))
@@ -0,0 +1,77 @@
+"""
+Wakeups for the daemons over local UNIX datagram sockets, and e-mails to users.
+
+A daemon listens on its socket and sleeps until it receives a datagram (or a
+fallback timeout passes); anybody on the same machine - the upload handler,
+the job queue command line, finished job threads - wakes it with notify().
+Wakeups are coalesced: all datagrams pending at a wakeup are consumed at once,
+the daemon then handles all pending work.
+"""
+
+import os
+import select
+import socket
+from smtplib import SMTP
+
+from config import logger
+
+
+class Listener:
+    """Socket a daemon waits on for wakeups"""
+
+    def __init__(self, path):
+        self.path = path
+        if os.path.exists(path):
+            os.remove(path)  # left over by a previous daemon
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(path)
+        self.sock.setblocking(False)
+        os.chmod(path, 0o666)  # the web application may run as another user
+
+    def wait(self, timeout):
+        """Block until woken up or timeout seconds passed; returns whether a wakeup arrived"""
+        readable, _, _ = select.select([self.sock], [], [], timeout)
+        woken = False
+        while readable:
+            try:
+                self.sock.recv(64)
+                woken = True
+            except BlockingIOError:
+                break
+        return woken
+
+    def close(self):
+        self.sock.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def notify(path):
+    """Wake up the daemon listening on path; does nothing if no daemon is listening"""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        sock.setblocking(False)
+        sock.sendto(b"1", path)
+    except OSError:
+        pass  # daemon not running, or already plenty of wakeups pending
+    finally:
+        sock.close()
+
+
+def send_email(to, subject, msg_body):
+    """
+    Send out an email about the status of a job
+    """
+    msg = f"To: {to}\n"
+    msg += f"Subject: {subject}\n\n"
+    msg += "Dear DARIO user,\n"
+    msg += msg_body
+
+    # Send e-mail
+    try:
+        server = SMTP()
+        server.connect("bierdepot.bioinf.uni-leipzig.de")
+        server.sendmail("dario@bioinf.uni-leipzig.de", to, msg)
+        server.close()
+    except Exception as inst:
+        logger.error("Email Address error: " + str(inst))
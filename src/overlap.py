@@ -0,0 +1,257 @@
+"""
+Interval overlap engine used to assign reads to genome annotations.
+
+Annotations are kept as start/end arrays sorted per chromosome/strand, and all
+reads of a library are queried at once with vectorized searchsorted calls.
+Coordinates are treated as closed intervals, like genomeIntervals did in the
+former overlap.R / overlapPredictions.R scripts.
+"""
+
+import numpy as np
+
+import columnar
+
+# Offset used to combine chromosome/strand codes and positions into one sortable int64 key
+KEY_SHIFT = 1 << 40
+
+
+def read_bed(filename, extra_columns=None):
+    """
+    Read the chromosome, start, end and strand columns of a BED file into numpy arrays.
+    extra_columns maps names to (column index, dtype) of further columns to load.
+    Lines are split on whitespace, as R's read.table and the Perl scripts do.
+    """
+    extra_columns = extra_columns or {}
+    chroms, starts, ends, strands = [], [], [], []
+    extras = dict((name, []) for name in extra_columns)
+    with open(filename) as f:
+        for line in f:
+            if line.startswith("#"):
+                continue
+            cols = line.split()
+            if len(cols) < 6:
+                continue
+            chroms.append(cols[0])
+            starts.append(cols[1])
+            ends.append(cols[2])
+            strands.append(cols[5])
+            for name, (index, dtype) in extra_columns.items():
+                extras[name].append(cols[index] if index < len(cols) else "")
+
+    bed = {
+        "chrom": np.array(chroms, dtype=object),
+        "start": np.array(starts, dtype=np.int64),
+        "end": np.array(ends, dtype=np.int64),
+        "strand": np.array(strands, dtype=object),
+    }
+    for name, (index, dtype) in extra_columns.items():
+        bed[name] = np.array(extras[name], dtype=dtype)
+    return bed
+
+
+class IntervalIndex:
+    """
+    Sorted, stranded interval set supporting vectorized "overlaps any" queries.
+
+    Intervals are ordered by a combined (chromosome/strand, start) key. A running
+    maximum over the combined end keys allows answering whether a query interval
+    overlaps any indexed interval with a single binary search.
+    """
+
+    def __init__(self, chroms, strands, starts, ends, keys=None):
+        # keys may be shared between indexes, so that queries need to be encoded only once
+        self.keys = {} if keys is None else keys
+        for pair in zip(chroms, strands):
+            if pair not in self.keys:
+                self.keys[pair] = len(self.keys)
+        codes = self.encode(chroms, strands)
+        order = np.lexsort((starts, codes))
+        self.start_keys = codes[order] * KEY_SHIFT + np.asarray(starts, dtype=np.int64)[order]
+        end_keys = codes[order] * KEY_SHIFT + np.asarray(ends, dtype=np.int64)[order]
+        self.max_end_keys = np.maximum.accumulate(end_keys) if len(end_keys) else end_keys
+
+    @classmethod
+    def from_sorted_keys(cls, keys, start_keys, max_end_keys):
+        """Create an index from the arrays of an index built before, e.g. memory-mapped from disk"""
+        index = cls.__new__(cls)
+        index.keys = keys
+        index.start_keys = start_keys
+        index.max_end_keys = max_end_keys
+        return index
+
+    @classmethod
+    def from_bed(cls, bed, mask=None, keys=None):
+        """Build an index from a dict as returned by read_bed(), optionally restricted to mask"""
+        if mask is None:
+            return cls(bed["chrom"], bed["strand"], bed["start"], bed["end"], keys)
+        return cls(bed["chrom"][mask], bed["strand"][mask], bed["start"][mask], bed["end"][mask], keys)
+
+    def encode(self, chroms, strands):
+        """Map chromosome/strand pairs to index codes, -1 for pairs without intervals"""
+        return np.fromiter(
+            (self.keys.get(pair, -1) for pair in zip(chroms, strands)), dtype=np.int64, count=len(chroms)
+        )
+
+    def overlaps_any(self, chroms, strands, starts, ends):
+        """Return a boolean array telling for each query interval whether it overlaps any indexed interval"""
+        return self.overlaps_any_encoded(self.encode(chroms, strands), starts, ends)
+
+    def overlaps_any_encoded(self, codes, starts, ends):
+        """Like overlaps_any(), for chromosome/strand pairs already mapped by encode()"""
+        result = np.zeros(len(codes), dtype=bool)
+        if len(self.start_keys) == 0:
+            return result
+        known = codes >= 0
+        base = codes[known] * KEY_SHIFT
+        idx = np.searchsorted(self.start_keys, base + np.asarray(ends)[known], side="right")
+        hit = idx > 0
+        hit[hit] = self.max_end_keys[idx[hit] - 1] >= base[hit] + np.asarray(starts)[known][hit]
+        result[known] = hit
+        return result
+
+
+def format_r_number(x):
+    """Format a number the way R's cat() prints it (7 significant digits)"""
+    x = float(x)
+    if x.is_integer() and abs(x) < 1e15:
+        return "%d" % x
+    mantissa, exponent = ("%.6e" % x).split("e")
+    exponent = int(exponent)
+    mantissa = mantissa.rstrip("0").rstrip(".")
+    sci = "%se%s%02d" % (mantissa, "-" if exponent < 0 else "+", abs(exponent))
+    fixed = "%.*f" % (max(0, 6 - exponent), x)
+    if "." in fixed:
+        fixed = fixed.rstrip("0").rstrip(".")
+    return fixed if len(fixed) <= len(sci) else sci
+
+
+def format_perl_number(x):
+    """Format a number the way Perl prints it"""
+    return "%d" % x if float(x).is_integer() else "%.15g" % x
+
+
+def format_r_pretty(x):
+    """Format a number like R's prettyNum(x, big.mark=",")"""
+    text = format_r_number(x)
+    if "e" in text:
+        return text
+    sign = "-" if text.startswith("-") else ""
+    integer, _, fraction = text.lstrip("-").partition(".")
+    groups = []
+    while len(integer) > 3:
+        groups.insert(0, integer[-3:])
+        integer = integer[:-3]
+    groups.insert(0, integer)
+    return sign + ",".join(groups) + ("." + fraction if fraction else "")
+
+
+def _matching_types(label, types):
+    """Types containing the label, mirroring the grepl() matching of overlap.R"""
+    return [t for t in types if label in t]
+
+
+def classify_reads(reads, annotations):
+    """
+    Assign each read to one of the classes "ncRNA", "exon", "intron" or "intergenic".
+
+    annotations maps annotation types (exon, intron and the ncRNA classes) to
+    IntervalIndex objects sharing one key dictionary. Returns the class per read
+    and, for every type, the boolean overlap array of the reads.
+    """
+    hits = {}
+    codes = None
+    for t, index in annotations.items():
+        if codes is None:
+            codes = index.encode(reads["chrom"], reads["strand"])
+        hits[t] = index.overlaps_any_encoded(codes, reads["start"], reads["end"])
+    n = len(reads["start"])
+    any_hit = np.zeros(n, dtype=bool)
+    ncrna_hit = np.zeros(n, dtype=bool)
+    intron_hit = np.zeros(n, dtype=bool)
+    for t, hit in hits.items():
+        any_hit |= hit
+        if "exon" in t or "intron" in t:
+            if "intron" in t:
+                intron_hit |= hit
+        else:
+            ncrna_hit |= hit
+
+    classes = np.full(n, "intergenic", dtype=object)
+    classes[any_hit & ~ncrna_hit & ~intron_hit] = "exon"
+    classes[any_hit & ~ncrna_hit & intron_hit] = "intron"
+    classes[ncrna_hit] = "ncRNA"
+    return classes, hits
+
+
+def build_type_indexes(ncrnas, exons, introns, keys=None):
+    """
+    Build one IntervalIndex per annotation type - exon, intron and the ncRNA classes
+    of column 7 of the ncRNA annotation - all sharing one key dictionary
+    """
+    types = np.concatenate(
+        [
+            np.full(len(exons["start"]), "exon", dtype=object),
+            np.full(len(introns["start"]), "intron", dtype=object),
+            ncrnas["type"],
+        ]
+    )
+    combined = dict(
+        (col, np.concatenate([exons[col], introns[col], ncrnas[col]])) for col in ("chrom", "strand", "start", "end")
+    )
+    keys = {} if keys is None else keys
+    return dict((t, IntervalIndex.from_bed(combined, types == t, keys)) for t in dict.fromkeys(types))
+
+
+def quantify_ncrna_overlap(annotations, labels, reads_file, ncrna_output, unknown_output):
+    """
+    Overlap the reads of a library with ncRNA, exon and intron annotations.
+
+    annotations are the per type indexes as returned by build_type_indexes(), labels
+    the ncRNA classes to report. Of the reads table reads_file (see columnar.py), reads
+    overlapping an annotated ncRNA are written to the table ncrna_output, intronic and
+    intergenic reads to unknown_output (keeping their order). Returns the (name, read
+    count, expression) summary per class, see write_reads_info().
+    """
+    reads = columnar.read_table(reads_file)
+    classes, hits = classify_reads(reads, annotations)
+    columnar.write_table(ncrna_output, columnar.take(reads, classes == "ncRNA"))
+    columnar.write_table(unknown_output, columnar.take(reads, (classes != "ncRNA") & (classes != "exon")))
+
+    # Summarize counts and expression per class
+    info = []
+    for read_class in ("ncRNA", "exon", "intron"):
+        mask = classes == read_class
+        info.append((read_class + "s", reads["count"][mask].sum(), reads["expr"][mask].sum()))
+    is_ncrna = classes == "ncRNA"
+    for label in labels:
+        label_hit = np.zeros(len(classes), dtype=bool)
+        for t in _matching_types(label, annotations):
+            label_hit |= hits[t]
+        mask = is_ncrna & label_hit
+        info.append((label, reads["count"][mask].sum(), reads["expr"][mask].sum()))
+    # as in overlap.R, intergenic reports the number of tags rather than the read count
+    mask = classes == "intergenic"
+    info.append(("intergenic", mask.sum(), reads["expr"][mask].sum()))
+    return info
+
+
+def write_reads_info(info, info_output):
+    """Write the summary returned by quantify_ncrna_overlap() in the "reads.info" format"""
+    with open(info_output, "w") as f:
+        f.write(
+            "\n".join(
+                ":".join([name, format_r_number(cnt), format_r_number(exp), format_r_pretty(cnt), format_r_pretty(exp)])
+                for name, cnt, exp in info
+            )
+        )
+
+
+def write_overlapping_reads(annotations, reads_file, output_file):
+    """
+    Write all reads of the reads table reads_file that overlap any interval of annotations (same strand),
+    a BED file name or a table as returned by read_bed()
+    """
+    reads = columnar.read_table(reads_file)
+    index = IntervalIndex.from_bed(read_bed(annotations) if isinstance(annotations, str) else annotations)
+    hit = index.overlaps_any(reads["chrom"], reads["strand"], reads["start"], reads["end"])
+    columnar.write_table(output_file, columnar.take(reads, hit))
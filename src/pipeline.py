@@ -0,0 +1,144 @@
+"""
+Declarative step graph for the analysis of a job.
+
+Each step declares the files it reads and writes (names relative to the run
+directory); a step depends on the steps producing its inputs and, for ordering
+only, on the steps listed in after. Steps whose dependencies are done run
+concurrently in a thread pool (the heavy lifting happens in subprocesses and
+process pools). A failing optional step only skips the steps that need its
+outputs, a failing required step stops the graph. Start and end time and the
+resource usage (see metrics.py) of each step are recorded, so the critical path
+of a job can be read off.
+"""
+
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import metrics
+from config import logger
+
+DONE = "done"
+FAILED = "failed"
+SKIPPED = "skipped"
+
+
+class Step:
+    """A step of the graph: func is called without arguments"""
+
+    def __init__(self, name, func, inputs=(), outputs=(), after=(), optional=False):
+        self.name = name
+        self.func = func
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.after = list(after)
+        self.optional = optional
+
+
+class StepFailed(Exception):
+    """Raised when a required step fails; the original exception is kept in cause"""
+
+    def __init__(self, step, cause):
+        Exception.__init__(self, f"Step {step.name} failed: {cause}")
+        self.step = step
+        self.cause = cause
+
+
+class Pipeline:
+    """A graph of steps, run with run()"""
+
+    def __init__(self, steps, max_workers=4):
+        self.steps = dict((step.name, step) for step in steps)
+        self.max_workers = max_workers
+        self.status = {}
+        self.timings = {}
+        self.usage = {}
+
+        producers = {}
+        for step in steps:
+            for output in step.outputs:
+                producers[output] = step.name
+        # hard dependencies (need the outputs) and ordering-only dependencies
+        self.requires = dict(
+            (step.name, set(producers[f] for f in step.inputs if f in producers) - {step.name}) for step in steps
+        )
+        self.waits_for = dict(
+            (step.name, self.requires[step.name] | set(a for a in step.after if a in self.steps)) for step in steps
+        )
+
+    def _run_step(self, step):
+        start = time.time()
+        start_usage = metrics.snapshot()
+        try:
+            step.func()
+        finally:
+            self.timings[step.name] = (start, time.time())
+            self.usage[step.name] = metrics.usage_since(start_usage)
+
+    def _skip_unreachable(self, pending):
+        """Skip pending steps whose required inputs will never be produced"""
+        skipped = True
+        while skipped:
+            skipped = False
+            for name in sorted(pending):
+                if any(self.status.get(dep) in (FAILED, SKIPPED) for dep in self.requires[name]):
+                    logger.info(f"Step {name} skipped")
+                    self.status[name] = SKIPPED
+                    pending.discard(name)
+                    skipped = True
+
+    def run(self):
+        """Run all steps; raises StepFailed for the first failing required step"""
+        pending = set(self.steps)
+        running = {}
+        failure = None
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            while pending or running:
+                self._skip_unreachable(pending)
+                if failure is None:
+                    for name in sorted(pending):
+                        if all(dep in self.status for dep in self.waits_for[name]):
+                            pending.discard(name)
+                            running[pool.submit(self._run_step, self.steps[name])] = name
+                elif not running:
+                    break
+                if not running:
+                    if pending:
+                        raise ValueError("Cyclic step dependencies: " + ", ".join(sorted(pending)))
+                    break
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    step = self.steps[name]
+                    exception = future.exception()
+                    if exception is None:
+                        self.status[name] = DONE
+                        continue
+                    self.status[name] = FAILED
+                    if step.optional:
+                        logger.warning(f"Optional step {name} failed: {exception}")
+                    elif failure is None:
+                        failure = StepFailed(step, exception)
+        if failure is not None:
+            raise failure
+        return self.timings
+
+    def durations(self):
+        """Seconds spent per step, in order of start"""
+        return dict(
+            (name, end - start) for name, (start, end) in sorted(self.timings.items(), key=lambda item: item[1][0])
+        )
+
+    def critical_path(self):
+        """Chain of steps that determined the total runtime, following the dependency that finished last"""
+        if not self.timings:
+            return []
+        name = max(self.timings, key=lambda n: self.timings[n][1])
+        path = [name]
+        while True:
+            deps = [dep for dep in self.waits_for[name] if dep in self.timings]
+            if not deps:
+                break
+            name = max(deps, key=lambda n: self.timings[n][1])
+            path.insert(0, name)
+        return path
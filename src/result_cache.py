@@ -0,0 +1,245 @@
+"""
+Content-addressed cache of finished results on the webserver.
+
+Jobs are keyed by a hash over the content of the uploaded mapping loci, its
+format, the species with the version of its annotation files (see
+annotation_index.annotation_version()) and the user annotation. Finished results are admitted into
+config.RESULT_CACHE_PATH by the webserver daemon (as hard links, so they cost no
+extra space while the result directory exists). An upload with a known key gets
+its result restored under the new job hash right away: files are hard linked,
+only files mentioning the job hash (HTML pages, tables, job parameters and
+metrics, members of the results zip) are rewritten. Entries are evicted least recently used first once the cache exceeds
+config.RESULT_CACHE_MAX_BYTES.
+"""
+
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+import zipfile
+
+import annotation_index
+import config
+from config import logger
+
+# Files that reference the job hash and are rewritten on restore
+TEXT_SUFFIXES = (".html", ".bed", ".txt", ".json")
+SOURCE_HASH_FILENAME = ".source_hash"
+SIZE_FILENAME = ".size"
+LAST_USED_FILENAME = ".last_used"
+PENDING_DIR = "pending/"
+# Pending jobs without result after this many seconds are forgotten
+PENDING_TIMEOUT = 14 * 24 * 3600
+
+
+def file_digest(filename):
+    """SHA-256 hex digest of a file, read in chunks"""
+    digest = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def cache_key(species_code, upload_digest, upload_format, user_annotation_digest=None):
+    """
+    Key of a job: hash over species and the version of its annotation, uploaded content
+    and its format (see ingest.py) and the user annotation content, if any
+    """
+    parts = [
+        config.RESULT_CACHE_VERSION,
+        species_code,
+        annotation_index.annotation_version(config.SPECIES[species_code]["dir"]),
+        upload_format,
+        upload_digest,
+        user_annotation_digest or "NONE",
+    ]
+    return hashlib.sha256("\0".join(parts).encode("utf-8")).hexdigest()
+
+
+def _entry_dir(key):
+    return config.RESULT_CACHE_PATH + key + "/"
+
+
+def _link_or_copy(source, target):
+    """Hard link source to target, copying if linking is not possible (e.g. across file systems)"""
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copy2(source, target)
+
+
+def _rewrite_zip(source, destination, old, new):
+    """
+    Write the zip archive source to destination with old replaced by new in its members.
+    Returns False, writing nothing, if no member mentions old.
+    """
+    old, new = old.encode("utf-8"), new.encode("utf-8")
+    with zipfile.ZipFile(source) as archive:
+        members = [(member, archive.read(member)) for member in archive.infolist()]
+    if not any(old in data for member, data in members):
+        return False
+    with zipfile.ZipFile(destination, "w") as archive:
+        for member, data in members:
+            archive.writestr(member, data.replace(old, new))
+    return True
+
+
+def _read_params(filename):
+    """Read a job parameters file into an ordered dict"""
+    params = {}
+    with open(filename) as f:
+        for line in f:
+            cols = line.rstrip("\n").split("\t", 1)
+            if len(cols) > 1:
+                params[cols[0]] = cols[1]
+    return params
+
+
+def restore(key, job_hash, params):
+    """
+    Create the result directory of job_hash from the cache entry of key, with the job
+    parameters updated by params. Returns False if there is no such entry.
+    """
+    entry = _entry_dir(key)
+    try:
+        with open(entry + SOURCE_HASH_FILENAME) as f:
+            source_hash = f.read().strip()
+    except IOError:
+        return False
+
+    # assemble in a temporary directory, so that the result appears complete at once
+    target = tempfile.mkdtemp(prefix="." + job_hash, dir=config.WEBSERVER_RESULTS_PATH)
+    try:
+        for dirpath, dirnames, filenames in os.walk(entry):
+            relpath = os.path.relpath(dirpath, entry)
+            for dirname in dirnames:
+                os.mkdir(os.path.join(target, relpath, dirname))
+            for filename in filenames:
+                if filename.startswith("."):
+                    continue
+                source = os.path.join(dirpath, filename)
+                destination = os.path.join(target, relpath, filename)
+                if filename == config.PARAMS_FILENAME:
+                    job_params = _read_params(source)
+                    job_params.update((k, str(v)) for k, v in params.items())
+                    job_params["cached_from"] = source_hash
+                    with open(destination, "w") as f:
+                        for k, v in job_params.items():
+                            f.write(k + "\t" + v + "\n")
+                elif filename.endswith(TEXT_SUFFIXES):
+                    with open(source, encoding="utf-8", errors="surrogateescape") as f:
+                        text = f.read()
+                    if source_hash in text:
+                        with open(destination, "w", encoding="utf-8", errors="surrogateescape") as f:
+                            f.write(text.replace(source_hash, job_hash))
+                    else:
+                        _link_or_copy(source, destination)
+                elif filename.endswith(".zip"):
+                    if not _rewrite_zip(source, destination, source_hash, job_hash):
+                        _link_or_copy(source, destination)
+                else:
+                    _link_or_copy(source, destination)
+        os.chmod(target, 0o755)
+        os.rename(target, config.WEBSERVER_RESULTS_PATH + job_hash)
+    except:
+        shutil.rmtree(target, ignore_errors=True)
+        logger.exception(f"Cached result {key} could not be restored")
+        return False
+
+    with open(entry + LAST_USED_FILENAME, "w"):
+        pass  # the modification time tracks the last use
+    logger.info(f"Job {job_hash} restored from cached result of {source_hash}")
+    return True
+
+
+def register(job_hash, key):
+    """Remember the key of a submitted job, so its result is admitted once finished"""
+    os.makedirs(config.RESULT_CACHE_PATH + PENDING_DIR, exist_ok=True)
+    with open(config.RESULT_CACHE_PATH + PENDING_DIR + job_hash, "w") as f:
+        f.write(key)
+
+
+def store(key, result_dir, job_hash):
+    """Admit the finished result directory of job_hash under key"""
+    entry = _entry_dir(key)
+    if os.path.exists(entry):
+        return
+    tmp = tempfile.mkdtemp(prefix="." + key, dir=config.RESULT_CACHE_PATH)
+    size = 0
+    try:
+        for dirpath, dirnames, filenames in os.walk(result_dir):
+            relpath = os.path.relpath(dirpath, result_dir)
+            for dirname in dirnames:
+                os.mkdir(os.path.join(tmp, relpath, dirname))
+            for filename in filenames:
+                source = os.path.join(dirpath, filename)
+                _link_or_copy(source, os.path.join(tmp, relpath, filename))
+                size += os.path.getsize(source)
+        with open(tmp + "/" + SOURCE_HASH_FILENAME, "w") as f:
+            f.write(job_hash)
+        with open(tmp + "/" + SIZE_FILENAME, "w") as f:
+            f.write(str(size))
+        with open(tmp + "/" + LAST_USED_FILENAME, "w"):
+            pass
+        os.rename(tmp, entry)
+    except:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    logger.info(f"Result of job {job_hash} added to the result cache ({size} bytes)")
+
+
+def _is_completed(result_dir):
+    """Check whether the analysis of a result directory finished successfully"""
+    try:
+        return _read_params(result_dir + config.PARAMS_FILENAME).get("job_completed_succesfully") == "1"
+    except IOError:
+        return False
+
+
+def admit_finished():
+    """Admit the results of registered jobs that have finished, then evict down to the budget"""
+    pending_dir = config.RESULT_CACHE_PATH + PENDING_DIR
+    if not os.path.isdir(pending_dir):
+        return
+    admitted = False
+    for job_hash in os.listdir(pending_dir):
+        marker = pending_dir + job_hash
+        result_dir = config.WEBSERVER_RESULTS_PATH + job_hash + "/"
+        if os.path.exists(result_dir + "index.html"):
+            # only successful analyses are worth caching
+            if _is_completed(result_dir):
+                with open(marker) as f:
+                    key = f.read().strip()
+                try:
+                    store(key, result_dir, job_hash)
+                    admitted = True
+                except Exception:
+                    logger.exception(f"Result of job {job_hash} could not be cached")
+            os.remove(marker)
+        elif time.time() - os.path.getmtime(marker) > PENDING_TIMEOUT:
+            os.remove(marker)
+    if admitted:
+        evict()
+
+
+def evict(max_bytes=None):
+    """Remove least recently used entries until the cache fits into max_bytes"""
+    max_bytes = config.RESULT_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    entries = []
+    for key in os.listdir(config.RESULT_CACHE_PATH):
+        entry = _entry_dir(key)
+        try:
+            with open(entry + SIZE_FILENAME) as f:
+                size = int(f.read())
+            entries.append((os.path.getmtime(entry + LAST_USED_FILENAME), size, key))
+        except (IOError, ValueError):
+            continue  # pending jobs and entries being written
+    total = sum(size for _, size, _ in entries)
+    for last_used, size, key in sorted(entries):
+        if total <= max_bytes:
+            break
+        shutil.rmtree(_entry_dir(key), ignore_errors=True)
+        total -= size
+        logger.info(f"Evicted cached result {key}")
@@ -0,0 +1,248 @@
+"""
+Sharded execution of the quantification and clustering steps (steps 5-7 of the analysis).
+
+Overlap, coverage, expression and clustering are independent per chromosome, so
+the tags table upload.tags is split into shards of whole chromosomes, each processed
+in its own directory by a pool of processes. Steps running concurrently (prediction
+and user annotation) share config.SHARD_WORKERS processes, the cores granted to the
+job, see reserve_workers(). Shards are
+contiguous ranges of the sorted chromosome names, hence concatenating the shard
+outputs in shard order yields the same tables and files as a run over the whole
+genome. Expression tables and reads.info counters are merged in the parent process,
+which also flags the known clusters, and annotations are parsed once for all shards.
+"""
+
+import os
+import shutil
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from subprocess import check_call
+
+import numpy as np
+
+import config
+from config import logger
+import annotation_index
+import clustering
+import columnar
+import coverage
+import expression
+import overlap
+
+# Number of shards per worker process, to balance chromosomes of different size
+SHARDS_PER_WORKER = 4
+
+# Shard processes in use by the steps of this job
+_workers_in_use = 0
+_workers_changed = threading.Condition()
+
+
+def split_reads(reads_file, shard_root, shard_count=None):
+    """
+    Split the reads table reads_file into shard directories of whole chromosomes with
+    about the same number of reads. Returns the shard directories in chromosome order;
+    each holds a table of the basename of reads_file.
+    """
+    shard_count = shard_count or config.SHARD_WORKERS * SHARDS_PER_WORKER
+    reads = columnar.read_table(reads_file)
+    chroms, chrom_index, reads_per_chrom = np.unique(reads["chrom"], return_inverse=True, return_counts=True)
+
+    # assign contiguous ranges of sorted chromosomes to shards
+    target = max(1, len(chrom_index) // max(1, shard_count))
+    shard_of_chrom = np.zeros(len(chroms), dtype=np.int64)
+    shard, size = 0, 0
+    for i in range(len(chroms)):
+        if size >= target:
+            shard, size = shard + 1, 0
+        shard_of_chrom[i] = shard
+        size += reads_per_chrom[i]
+
+    shard_of_read = shard_of_chrom[chrom_index]
+    shard_dirs = ["%s%d/" % (shard_root, i) for i in range(shard + 1)]
+    name = os.path.basename(os.path.normpath(reads_file))
+    for i, shard_dir in enumerate(shard_dirs):
+        columnar.write_table(shard_dir + name, columnar.take(reads, shard_of_read == i))
+    logger.info(f"Split {len(chroms)} chromosomes into {len(shard_dirs)} shards")
+    return shard_dirs
+
+
+def reserve_workers(wanted):
+    """
+    Wait until at least one of the config.SHARD_WORKERS shard processes is free and
+    reserve up to wanted of them; returns the number reserved, see release_workers()
+    """
+    global _workers_in_use
+    with _workers_changed:
+        _workers_changed.wait_for(lambda: _workers_in_use < max(1, config.SHARD_WORKERS))
+        workers = min(wanted, max(1, config.SHARD_WORKERS) - _workers_in_use)
+        _workers_in_use += workers
+        return workers
+
+
+def release_workers(workers):
+    global _workers_in_use
+    with _workers_changed:
+        _workers_in_use -= workers
+        _workers_changed.notify_all()
+
+
+def run_shards(func, shard_dirs, *args):
+    """
+    Call func(shard_dir, *args) for all shards in a process pool, of the shard processes
+    not used by concurrent steps; returns the results in shard order
+    """
+    workers = reserve_workers(len(shard_dirs))
+    try:
+        if workers == 1:
+            return [func(shard_dir, *args) for shard_dir in shard_dirs]
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(func, shard_dir, *args) for shard_dir in shard_dirs]
+            return [future.result() for future in futures]
+    finally:
+        release_workers(workers)
+
+
+def merge_tracks(shard_dirs, prefix, rundir, track_format="wig"):
+    """Merge the header-less coverage tracks prefix.pos.wig and prefix.neg.wig of the shards"""
+    for strand, suffix in (("+", ".pos.wig"), ("-", ".neg.wig")):
+        with open(rundir + prefix + suffix, "w") as out:
+            out.write(coverage.track_header(strand, track_format))
+            for shard_dir in shard_dirs:
+                with open(shard_dir + prefix + suffix) as f:
+                    shutil.copyfileobj(f, out)
+
+
+def merge_reads_info(infos):
+    """Sum up the per shard (name, read count, expression) summaries of overlap.quantify_ncrna_overlap()"""
+    merged = {}
+    for info in infos:
+        for name, cnt, exp in info:
+            total_cnt, total_exp = merged.get(name, (0, 0.0))
+            merged[name] = (total_cnt + cnt, total_exp + exp)
+    return [(name, cnt, exp) for name, (cnt, exp) in merged.items()]
+
+
+def merge_expression_rows(results):
+    """Merge the per shard results of expression.expression_rows(), ordered by annotation row"""
+    rows, expr, norm_reads, read_counts = [np.concatenate(arrays) for arrays in zip(*results)]
+    order = np.argsort(rows, kind="stable")
+    return rows[order], expr[order], norm_reads[order], read_counts[order]
+
+
+def _quantify_ncrna_shard(shard_dir, index_dir, track_format):
+    """Step 5 on one shard: classify reads, write header-less ncRNA tracks and quantify ncRNAs"""
+    index = annotation_index.AnnotationIndex(index_dir)
+    info = overlap.quantify_ncrna_overlap(
+        index.type_indexes(),
+        index.labels,
+        shard_dir + "upload.tags",
+        shard_dir + "ncRNAs.reads",
+        shard_dir + "unknown.reads",
+    )
+    coverage.write_coverage_tracks(
+        shard_dir + "ncRNAs.reads", shard_dir + "ncRNAs.pos.wig", shard_dir + "ncRNAs.neg.wig", track_format, False
+    )
+    return info, expression.expression_rows(shard_dir + "ncRNAs.reads", index.ncrnas())
+
+
+def quantify_ncrnas(shard_dirs, species, index, rundir):
+    """
+    Overlap the reads with the species annotation (index, see annotation_index.open_index()), write the reads
+    tables ncRNAs.reads and unknown.reads, reads.info, the ncRNA coverage tracks and ncRNA.expression.bed to rundir
+    """
+    track_format = config.COVERAGE_TRACK_FORMAT
+    results = run_shards(_quantify_ncrna_shard, shard_dirs, index.index_dir, track_format)
+    overlap.write_reads_info(merge_reads_info([info for info, rows in results]), rundir + "reads.info")
+    for name in ("ncRNAs.reads", "unknown.reads"):
+        columnar.concatenate([shard_dir + name for shard_dir in shard_dirs], rundir + name)
+    merge_tracks(shard_dirs, "ncRNAs", rundir, track_format)
+    expression.write_expression_rows(
+        merge_expression_rows([rows for info, rows in results]),
+        index.ncrnas(),
+        rundir + "ncRNA.expression.bed",
+        rundir,
+        "ncRNAs.pos.wig",
+        "ncRNAs.neg.wig",
+        species["id"],
+    )
+
+
+def _cluster_shard(shard_dir, final_shards):
+    """
+    Step 6 on one shard: cluster known and unknown reads into blocks. final_shards are the
+    shards holding the last reads of the genome, by reads name.
+    """
+    for name in ("unknown", "ncRNAs"):
+        clustering.write_clusters(
+            shard_dir + name + ".reads", shard_dir + name + ".clusters", final=shard_dir == final_shards[name]
+        )
+
+
+def cluster_reads(shard_dirs, species, rundir, stderr_file):
+    """
+    Write the clusters tables ncRNAs.clusters and unknown.clusters to rundir, and the known
+    clusters flagged with their ncRNA to ncRNAs.clusters.flagged (text)
+    """
+    # as in a run over the whole genome, only the very last cluster is exempt from the height filter
+    final_shards = {}
+    for name in ("unknown", "ncRNAs"):
+        with_reads = [d for d in shard_dirs if columnar.read_meta(d + name + ".reads")["rows"]]
+        final_shards[name] = with_reads[-1] if with_reads else None
+    run_shards(_cluster_shard, shard_dirs, final_shards)
+    for name in ("ncRNAs.clusters", "unknown.clusters"):
+        columnar.concatenate([shard_dir + name for shard_dir in shard_dirs], rundir + name, "clusters")
+
+    # once for all shards, flagKnownClusters.pl parses the whole annotation; it reads the text format
+    columnar.export(rundir + "ncRNAs.clusters", rundir + "ncRNAs.clusters.txt")
+    with open(stderr_file, "a") as stderr, open(rundir + "ncRNAs.clusters.flagged", "w") as flagged:
+        check_call(
+            [
+                config.WORKER_SOURCE_PATH + "analysis/flagKnownClusters.pl",
+                "-c",
+                rundir + "ncRNAs.clusters.txt",
+                "-a",
+                species["dir"] + "ncRNAs.bed",
+                "-p",
+                "1",
+            ],
+            stdout=flagged,
+            stderr=stderr,
+        )
+    os.remove(rundir + "ncRNAs.clusters.txt")
+
+
+def _quantify_annotation_shard(shard_dir, annotations, reads_name, prefix, track_format):
+    """Quantify an annotation on one shard: select overlapping reads, write header-less tracks"""
+    overlap.write_overlapping_reads(annotations, shard_dir + reads_name, shard_dir + prefix + ".reads")
+    coverage.write_coverage_tracks(
+        shard_dir + prefix + ".reads",
+        shard_dir + prefix + ".pos.wig",
+        shard_dir + prefix + ".neg.wig",
+        track_format,
+        False,
+    )
+    return expression.expression_rows(shard_dir + prefix + ".reads", annotations)
+
+
+def quantify_annotation(shard_dirs, annotation_file, reads_name, prefix, rundir, species_id, rnaz=None):
+    """
+    Quantify the annotation of annotation_file (e.g. predictions.bed) with the shard reads
+    tables reads_name. Writes the reads table prefix.reads, the prefix coverage tracks and prefix.expression.bed
+    to rundir; rnaz are optional RNAz markers, see expression.rnaz_markers().
+    """
+    track_format = config.COVERAGE_TRACK_FORMAT
+    # parsed once, the shards get the table
+    annotations = expression.load_annotations(annotation_file)
+    results = run_shards(_quantify_annotation_shard, shard_dirs, annotations, reads_name, prefix, track_format)
+    columnar.concatenate([shard_dir + prefix + ".reads" for shard_dir in shard_dirs], rundir + prefix + ".reads")
+    merge_tracks(shard_dirs, prefix, rundir, track_format)
+    expression.write_expression_rows(
+        merge_expression_rows(results),
+        annotations,
+        rundir + prefix + ".expression.bed",
+        rundir,
+        prefix + ".pos.wig",
+        prefix + ".neg.wig",
+        species_id,
+        rnaz,
+    )
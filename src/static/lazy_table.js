@@ -0,0 +1,116 @@
+/*
+  Lazy expression tables of the result pages: the page contains the first rows
+  only, further pages are fetched sorted and filtered from the table API
+  (api/result/HASH/TABLE/TYPE, see dario_app.py). Tables are marked with
+  class="lazytable" and data-api, data-columns, data-total and data-page-size;
+  header cells with data-sort="COLUMN" sort the table, a second click reverses.
+*/
+
+function lazyTable(table) {
+  var state = {
+    api: table.getAttribute("data-api"),
+    columns: table.getAttribute("data-columns").split(","),
+    pageSize: parseInt(table.getAttribute("data-page-size")),
+    total: parseInt(table.getAttribute("data-total")),
+    offset: 0,
+    sort: null,
+    descending: false,
+    query: ""
+  };
+  var controls = document.getElementById(table.id + "-controls");
+  var status = controls.getElementsByClassName("lazytable-status")[0];
+  var tbody = table.getElementsByTagName("tbody")[0];
+
+  function cell(column, value) {
+    var td = document.createElement("td");
+    if (column == "link") {
+      var a = document.createElement("a");
+      a.href = value;
+      a.target = "_blank";
+      a.appendChild(document.createTextNode("View at UCSC"));
+      td.appendChild(a);
+    } else if (column == "rnaz") {
+      td.appendChild(document.createTextNode(value == "1" ? "yes" : ""));
+    } else {
+      td.appendChild(document.createTextNode(value));
+    }
+    return td;
+  }
+
+  function showStatus() {
+    var last = Math.min(state.offset + state.pageSize, state.total);
+    status.innerHTML = state.total == 0 ? "no rows" :
+      "rows " + (state.offset + 1) + " - " + last + " of " + state.total;
+  }
+
+  function load() {
+    var url = state.api + "?offset=" + state.offset + "&limit=" + state.pageSize;
+    if (state.sort) {
+      url += "&sort=" + state.sort + "&order=" + (state.descending ? "desc" : "asc");
+    }
+    if (state.query) {
+      url += "&q=" + encodeURIComponent(state.query);
+    }
+    var request = new XMLHttpRequest();
+    request.open("GET", url);
+    request.onload = function() {
+      if (request.status != 200) {
+        status.innerHTML = "The table could not be loaded.";
+        return;
+      }
+      var page = JSON.parse(request.responseText);
+      state.total = page.total;
+      while (tbody.firstChild) {
+        tbody.removeChild(tbody.firstChild);
+      }
+      for (var i = 0; i < page.rows.length; i++) {
+        var tr = document.createElement("tr");
+        for (var j = 0; j < state.columns.length; j++) {
+          tr.appendChild(cell(state.columns[j], page.rows[i][state.columns[j]]));
+        }
+        tbody.appendChild(tr);
+      }
+      showStatus();
+    };
+    request.send();
+  }
+
+  var headers = table.getElementsByTagName("th");
+  for (var i = 0; i < headers.length; i++) {
+    if (headers[i].getAttribute("data-sort")) {
+      headers[i].style.cursor = "pointer";
+      headers[i].onclick = function() {
+        var column = this.getAttribute("data-sort");
+        state.descending = state.sort == column ? !state.descending : false;
+        state.sort = column;
+        state.offset = 0;
+        load();
+      };
+    }
+  }
+  controls.getElementsByClassName("lazytable-previous")[0].onclick = function() {
+    if (state.offset > 0) {
+      state.offset = Math.max(0, state.offset - state.pageSize);
+      load();
+    }
+  };
+  controls.getElementsByClassName("lazytable-next")[0].onclick = function() {
+    if (state.offset + state.pageSize < state.total) {
+      state.offset += state.pageSize;
+      load();
+    }
+  };
+  controls.getElementsByClassName("lazytable-filter")[0].onchange = function() {
+    state.query = this.value;
+    state.offset = 0;
+    load();
+  };
+  showStatus();
+}
+
+window.addEventListener("load", function() {
+  var tables = document.getElementsByClassName("lazytable");
+  for (var i = 0; i < tables.length; i++) {
+    lazyTable(tables[i]);
+  }
+});
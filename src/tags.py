@@ -0,0 +1,175 @@
+"""
+Collapsing of mapped reads into tags (step 4 of the analysis).
+
+Mapping loci of a BED upload are aggregated into tags, i.e. unique
+(chromosome, strand, start, end) loci, whose expression is the number of reads
+mapped there, each read weighted by the inverse of its number of mapping loci.
+The upload is read once; grouping by read id and by locus is done with
+external sorts that spill sorted runs to temporary files, so peak memory is
+bounded by config.TAG_SORT_CHUNK_SIZE records regardless of the upload size.
+"""
+
+import heapq
+import pickle
+import tempfile
+from itertools import groupby
+
+import columnar
+import config
+from config import logger
+from overlap import format_perl_number
+
+
+def normalize_chrom(chrom):
+    """Bring chromosome names into UCSC style (chr1, chrX, ...)"""
+    chrom = chrom.replace("chromosome", "chr", 1).replace("chrom", "chr", 1)
+    if chrom.isdigit() or chrom in ("X", "Y", "M"):
+        chrom = "chr" + chrom
+    return chrom
+
+
+def parse_score(score):
+    """
+    Read count of a BED score column as readsToTags.pl took it: fractional counts are
+    kept, and scores that are no number (e.g. ".") count as 0, which is read as 1 like
+    a score of 0
+    """
+    try:
+        return int(score)
+    except ValueError:
+        pass
+    try:
+        return float(score)
+    except ValueError:
+        return 0
+
+
+def iter_bed_records(bed_file):
+    """Yield (chromosome, start, end, read id, expression, strand) records of a mapping loci BED file"""
+    with open(bed_file) as f:
+        for line in f:
+            if line.startswith("#"):
+                continue
+            cols = line.split()
+            if len(cols) < 6:
+                continue
+            yield cols[0], int(cols[1]), int(cols[2]), cols[3], parse_score(cols[4]), cols[5]
+
+
+def _external_sort(records, key, chunk_size, tmpdir):
+    """
+    Yield records sorted by key. Sorted runs of chunk_size records are spilled to
+    temporary files and merged lazily; records must be picklable.
+    """
+    buffer = []
+    runs = []
+    for record in records:
+        buffer.append(record)
+        if len(buffer) >= chunk_size:
+            runs.append(_spill(sorted(buffer, key=key), tmpdir))
+            buffer = []
+    buffer.sort(key=key)
+    if not runs:
+        yield from buffer
+        return
+    runs.append(_spill(buffer, tmpdir))
+    try:
+        yield from heapq.merge(*[_read_run(run) for run in runs], key=key)
+    finally:
+        for run in runs:
+            run.close()
+
+
+def _spill(records, tmpdir):
+    """Write sorted records to a temporary file, which is deleted when closed"""
+    run = tempfile.TemporaryFile(dir=tmpdir)
+    for record in records:
+        pickle.dump(record, run, pickle.HIGHEST_PROTOCOL)
+    run.seek(0)
+    return run
+
+
+def _read_run(run):
+    """Read back the records of a run written by _spill()"""
+    while True:
+        try:
+            yield pickle.load(run)
+        except EOFError:
+            return
+
+
+def _with_commas(number):
+    """Format a number like Perl, with thousands separators in its integer part"""
+    integer, point, fraction = format_perl_number(number).partition(".")
+    return "{:,}".format(int(integer)) + point + fraction
+
+
+def collapse_records(records, output_file, summary_file, length_file, multimap_file, tmpdir=None, chunk_size=None):
+    """
+    Collapse (chromosome, start, end, read id, expression, strand) records into tags
+    written to the reads table output_file (see columnar.py, normalized expression in
+    column expr and the read count in column count). Also writes the read length distribution, the multiple mapping
+    distribution and the summary file (reads, tags, entries, uniquely mapping tags).
+    """
+    chunk_size = chunk_size or config.TAG_SORT_CHUNK_SIZE
+    lengths = {}
+    stats = {"entries": 0, "reads": 0}
+
+    def by_read(records):
+        for chrom, start, end, read_id, expr, strand in records:
+            if expr == 0:
+                expr = 1
+            lengths[end - start + 1] = lengths.get(end - start + 1, 0) + expr
+            stats["entries"] += 1
+            yield read_id, normalize_chrom(chrom), strand, start, end, expr
+
+    # Group mapping loci of each read to weight them by the number of loci
+    multi = {}
+
+    def by_locus(sorted_by_read):
+        for read_id, loci in groupby(sorted_by_read, key=lambda r: r[0]):
+            loci = list(loci)
+            multi[len(loci)] = multi.get(len(loci), 0) + 1
+            stats["reads"] += loci[0][5]
+            for _, chrom, strand, start, end, expr in loci:
+                yield chrom, strand, start, end, expr / len(loci), expr
+
+    sorted_by_read = _external_sort(by_read(records), lambda r: r[0], chunk_size, tmpdir)
+    sorted_by_locus = _external_sort(by_locus(sorted_by_read), lambda r: r[:4], chunk_size, tmpdir)
+
+    # Sum up expression of identical loci and write tags
+    tag_count = 0
+    with columnar.TableWriter(output_file, "reads") as table:
+        for (chrom, strand, start, end), loci in groupby(sorted_by_locus, key=lambda r: r[:4]):
+            expr = 0
+            read_count = 0
+            for locus in loci:
+                expr += locus[4]
+                read_count += locus[5]
+            tag_count += 1
+            # expression with the precision of the former BED file, for the same results
+            table.add(chrom, start, end, tag_count, float(format_perl_number(expr)), strand, read_count)
+
+    with open(length_file, "w") as f:
+        for length in sorted(lengths):
+            f.write("%d\t%s\n" % (length, format_perl_number(lengths[length])))
+    with open(multimap_file, "w") as f:
+        for m in sorted(multi):
+            f.write("%d\t%d\n" % (m, multi[m]))
+
+    read_ids = sum(multi.values())
+    unique_mapping = multi.get(1, 0)
+    with open(summary_file, "w") as f:
+        for name, value in (
+            ("reads", stats["reads"]),
+            ("tags", read_ids),
+            ("entries", stats["entries"]),
+            ("uniqueMappingTags", unique_mapping),
+        ):
+            f.write("%s:%s:%s\n" % (name, format_perl_number(value), _with_commas(value)))
+    logger.info(f"Collapsed {stats['entries']} mapping loci into {tag_count} tags")
+
+
+def collapse_tags(bed_file, output_file, summary_file, length_file, multimap_file, tmpdir=None):
+    """Collapse the mapping loci of bed_file into tags, see collapse_records()"""
+    collapse_records(iter_bed_records(bed_file), output_file, summary_file, length_file, multimap_file, tmpdir)
@@ -0,0 +1,60 @@
+"""
+Compiled Mako templates, shared by all renderings of a process.
+
+There is one TemplateLookup per templates directory. It keeps compiled templates
+in memory and as Python modules below config.TEMPLATE_MODULE_PATH, so a template
+is compiled once per change instead of once per rendering; the analysis
+processes of the worker load the modules compiled at daemon startup. A template
+is recompiled when its file is newer than the compiled one.
+"""
+
+import glob
+import hashlib
+import os
+import threading
+
+from mako.lookup import TemplateLookup
+
+import config
+
+TEMPLATE_SUFFIX = ".mako.html"
+
+_lookups = {}
+_lock = threading.Lock()
+
+
+def get_lookup(templates_path):
+    """The shared lookup of a templates directory"""
+    with _lock:
+        lookup = _lookups.get(templates_path)
+        if lookup is None:
+            module_directory = None
+            if config.TEMPLATE_MODULE_PATH:
+                # one module directory per templates directory, as templates of different directories share names
+                module_directory = config.TEMPLATE_MODULE_PATH + hashlib.md5(templates_path.encode("utf-8")).hexdigest()
+            lookup = TemplateLookup(
+                directories=[templates_path], module_directory=module_directory, filesystem_checks=True
+            )
+            _lookups[templates_path] = lookup
+    return lookup
+
+
+def get_template(templates_path, template_name):
+    """The compiled template template_name (without suffix) of a templates directory"""
+    return get_lookup(templates_path).get_template("/" + template_name + TEMPLATE_SUFFIX)
+
+
+def render(templates_path, template_name, **kwargs):
+    """Render a template of a templates directory"""
+    return get_template(templates_path, template_name).render(**kwargs)
+
+
+def preload(templates_path):
+    """Compile all templates of a directory, e.g. at startup; returns the number of templates"""
+    names = [
+        os.path.basename(filename)[: -len(TEMPLATE_SUFFIX)]
+        for filename in glob.glob(os.path.join(templates_path, "*" + TEMPLATE_SUFFIX))
+    ]
+    for name in names:
+        get_template(templates_path, name)
+    return len(names)
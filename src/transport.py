@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+"""
+Transfer of job directories and remote commands between webserver and worker.
+
+A directory is sent as one gzip-compressed tar stream followed by a manifest
+with the SHA-256 checksum of every file. The receiving side (this module's
+command line, "receive DEST_DIR") unpacks into a temporary directory, verifies
+all checksums and only then moves the directory into place, so readers never
+see partial transfers.
+
+SSHTransport runs everything over one persistent, multiplexed ssh connection
+(ControlMaster) per machine; LocalTransport runs the same commands on the local
+machine, for single-machine setups and tests. connect() returns the transport
+selected by config.TRANSPORT.
+"""
+
+import gzip
+import hashlib
+import io
+import json
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+
+import config
+from config import logger
+
+MANIFEST_NAME = ".manifest.json"
+
+
+class _HashingReader:
+    """File wrapper computing the SHA-256 of everything read"""
+
+    def __init__(self, f):
+        self.f = f
+        self.digest = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.digest.update(data)
+        return data
+
+
+def pack(local_dir, fileobj):
+    """Write local_dir as gzip-compressed tar stream to fileobj, followed by the checksum manifest"""
+    if not os.path.isdir(local_dir):
+        raise IOError(f"{local_dir} is not a directory")
+    manifest = {}
+    with gzip.GzipFile(
+        fileobj=fileobj, mode="wb", compresslevel=config.TRANSPORT_COMPRESSION_LEVEL
+    ) as stream, tarfile.open(fileobj=stream, mode="w|") as tar:
+        for dirpath, dirnames, filenames in os.walk(local_dir):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                path = os.path.join(dirpath, filename)
+                name = os.path.relpath(path, local_dir)
+                info = tar.gettarinfo(path, name)
+                if not info.isfile():
+                    continue
+                with open(path, "rb") as f:
+                    reader = _HashingReader(f)
+                    tar.addfile(info, reader)
+                manifest[name] = reader.digest.hexdigest()
+        data = json.dumps(manifest).encode("utf-8")
+        info = tarfile.TarInfo(MANIFEST_NAME)
+        info.size = len(data)
+        tar.addfile(info, io.BytesIO(data))
+    return manifest
+
+
+def _file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def receive(fileobj, dest_dir):
+    """
+    Unpack a stream written by pack() into dest_dir (replacing it), after verifying
+    the checksums of all files. Raises IOError if the transfer is incomplete or corrupt.
+    """
+    parent = os.path.dirname(os.path.normpath(dest_dir))
+    tmp = tempfile.mkdtemp(prefix=".incoming-", dir=parent)
+    try:
+        with tarfile.open(fileobj=fileobj, mode="r|gz") as tar:
+            if hasattr(tarfile, "data_filter"):
+                tar.extractall(tmp, filter="data")
+            else:
+                tar.extractall(tmp)
+        try:
+            with open(os.path.join(tmp, MANIFEST_NAME)) as f:
+                manifest = json.load(f)
+        except IOError:
+            raise IOError("Transfer incomplete, no manifest received")
+        os.remove(os.path.join(tmp, MANIFEST_NAME))
+
+        received = set()
+        for dirpath, dirnames, filenames in os.walk(tmp):
+            received.update(os.path.relpath(os.path.join(dirpath, f), tmp) for f in filenames)
+        if received != set(manifest):
+            raise IOError("Transferred files do not match the manifest")
+        for name, checksum in manifest.items():
+            if _file_digest(os.path.join(tmp, name)) != checksum:
+                raise IOError("Checksum mismatch for " + name)
+
+        os.chmod(tmp, 0o755)
+        if os.path.exists(dest_dir):
+            shutil.rmtree(dest_dir)
+        os.rename(tmp, os.path.normpath(dest_dir))
+    except:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+
+
+class LocalTransport:
+    """Runs commands and transfers on the local machine"""
+
+    def __init__(self, source_path=None):
+        self.source_path = source_path or os.path.dirname(os.path.abspath(__file__)) + "/"
+
+    def popen(self, args, **kwargs):
+        """Start the command args (a list) on the target machine"""
+        return subprocess.Popen(args, **kwargs)
+
+    def call(self, args):
+        """Run the command args on the target machine and return its exit code"""
+        return self.popen(args).wait()
+
+    def send_dir(self, local_dir, remote_dir):
+        """Copy local_dir to remote_dir on the target machine; returns 0 on success"""
+        process = self.popen(
+            ["python3", self.source_path + "transport.py", "receive", remote_dir], stdin=subprocess.PIPE
+        )
+        try:
+            manifest = pack(local_dir, process.stdin)
+        except (OSError, ValueError):
+            logger.exception(f"Sending {local_dir} failed")
+            process.stdin.close()
+            process.wait()
+            return 1
+        process.stdin.close()
+        return_code = process.wait()
+        if return_code == 0:
+            logger.info(f"Sent {len(manifest)} files of {local_dir} to {remote_dir}")
+        return return_code
+
+
+class SSHTransport(LocalTransport):
+    """Runs commands and transfers on another machine over a multiplexed ssh connection"""
+
+    def __init__(self, machine, source_path):
+        LocalTransport.__init__(self, source_path)
+        self.machine = machine
+
+    def ssh_options(self):
+        return [
+            "-o",
+            "ControlMaster=auto",
+            "-o",
+            "ControlPath=" + config.SSH_CONTROL_PATH,
+            "-o",
+            "ControlPersist=%d" % config.SSH_CONTROL_PERSIST,
+        ]
+
+    def popen(self, args, **kwargs):
+        command = " ".join(shlex.quote(str(arg)) for arg in args)
+        return subprocess.Popen(["ssh"] + self.ssh_options() + [self.machine, command], **kwargs)
+
+
+def connect(machine, source_path):
+    """Transport to the machine whose DARIO sources are in source_path, as configured by config.TRANSPORT"""
+    if config.TRANSPORT == "local":
+        return LocalTransport(source_path)
+    return SSHTransport(machine, source_path)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3 or sys.argv[1] != "receive":
+        sys.exit("usage: transport.py receive DEST_DIR  (reads a stream written by pack() from stdin)")
+    try:
+        receive(sys.stdin.buffer, sys.argv[2])
+    except Exception as e:
+        sys.exit(f"Receiving {sys.argv[2]} failed: {e}")
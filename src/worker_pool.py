@@ -0,0 +1,181 @@
+"""
+Resource-aware admission of analysis jobs on the worker.
+
+The memory and cores a job needs are estimated from its upload size and the
+species (see estimate()). Jobs are admitted in queue order as long as they fit
+into config.WORKER_MEMORY_BUDGET and config.WORKER_CORE_BUDGET; the first job
+in the queue waits until enough resources are free, so big jobs do not starve.
+Each analysis runs in its own process with the granted number of shard
+processes and a memory limit: a cgroup (memory.max, cpu.max) if
+config.WORKER_CGROUP_PATH is usable, otherwise a data segment rlimit set by
+prlimit(1) (memory-mapped annotation indexes do not count against it).
+"""
+
+import json
+import math
+import os
+import shutil
+import subprocess
+import threading
+
+import config
+import ingest
+from config import logger
+
+
+def _read_params(runpath):
+    """Read job_params.txt of a job directory"""
+    params = {}
+    try:
+        with open(runpath + config.PARAMS_FILENAME) as f:
+            for line in f:
+                cols = line.rstrip("\n").split("\t", 1)
+                if len(cols) > 1:
+                    params[cols[0]] = cols[1]
+    except IOError:
+        pass
+    return params
+
+
+def _index_size(species):
+    """Size of the annotation index of a species, which each shard process reads"""
+    index_dir = config.ANNOTATION_INDEX_DIR_WH + species["id"]
+    try:
+        return sum(entry.stat().st_size for entry in os.scandir(index_dir))
+    except OSError:
+        return 0
+
+
+def estimate(runpath):
+    """
+    Estimate (memory in bytes, cores) for the job in runpath from the size of its
+    stored upload (scaled up, as it is compressed) and the annotation of its species
+    """
+    params = _read_params(runpath)
+    stored = ingest.stored_file(runpath, "mapping_loci")
+    if stored:
+        # uploads are stored compressed
+        upload_size = os.path.getsize(stored) * config.JOB_COMPRESSION_RATIO
+    else:
+        try:
+            upload_size = int(params.get("total_upload_size"))
+        except (TypeError, ValueError):
+            upload_size = 0
+
+    cores = max(1, min(config.SHARD_WORKERS, math.ceil(upload_size / config.JOB_UPLOAD_BYTES_PER_CORE)))
+    species = config.SPECIES.get(params.get("code"))
+    memory = (
+        config.JOB_MEMORY_BASE
+        + upload_size * config.JOB_MEMORY_PER_UPLOAD_BYTE
+        + cores * (config.JOB_MEMORY_PER_PROCESS + (_index_size(species) if species else 0))
+    )
+    return memory, cores
+
+
+class WorkerPool:
+    """Bookkeeping of the resources granted to running jobs"""
+
+    def __init__(self, memory_budget=None, core_budget=None):
+        self.memory_budget = memory_budget or config.WORKER_MEMORY_BUDGET
+        self.core_budget = core_budget or config.WORKER_CORE_BUDGET
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    def admit(self, job_hash, memory, cores):
+        """
+        Reserve resources for a job if they are available and return the (memory, cores)
+        granted, else None. A job exceeding the whole budget is admitted alone, clamped
+        to the budget.
+        """
+        with self.lock:
+            if not self.jobs:
+                memory, cores = min(memory, self.memory_budget), min(cores, self.core_budget)
+            used_memory, used_cores = self._used()
+            if used_memory + memory > self.memory_budget or used_cores + cores > self.core_budget:
+                return None
+            self.jobs[job_hash] = (memory, cores)
+        logger.info(f"Admitted job {job_hash} ({memory / 2**30:.1f} GiB, {cores} cores): {self.utilization()}")
+        return memory, cores
+
+    def release(self, job_hash):
+        """Free the resources of a finished job"""
+        with self.lock:
+            self.jobs.pop(job_hash, None)
+        logger.info(f"Released job {job_hash}: {self.utilization()}")
+
+    def _used(self):
+        return sum(m for m, c in self.jobs.values()), sum(c for m, c in self.jobs.values())
+
+    def running(self):
+        """Number of running jobs"""
+        return len(self.jobs)
+
+    def utilization(self):
+        """Running jobs and fraction of memory and cores in use"""
+        with self.lock:
+            used_memory, used_cores = self._used()
+            return {
+                "jobs": len(self.jobs),
+                "memory_used": used_memory,
+                "memory_budget": self.memory_budget,
+                "memory_utilization": round(used_memory / self.memory_budget, 3),
+                "cores_used": used_cores,
+                "core_budget": self.core_budget,
+                "core_utilization": round(used_cores / self.core_budget, 3),
+            }
+
+    def write_status(self, filename):
+        """Write utilization() as JSON, e.g. for monitoring"""
+        with open(filename, "w") as f:
+            json.dump(self.utilization(), f)
+
+
+def _create_cgroup(job_hash, memory, cores):
+    """Create a cgroup v2 with memory and CPU limits for a job, None if cgroups are not available"""
+    if not config.WORKER_CGROUP_PATH or not os.access(config.WORKER_CGROUP_PATH, os.W_OK):
+        return None
+    path = os.path.join(config.WORKER_CGROUP_PATH, "dario_" + job_hash)
+    try:
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, "memory.max"), "w") as f:
+            f.write(str(int(memory)))
+        with open(os.path.join(path, "cpu.max"), "w") as f:
+            f.write("%d 100000" % (cores * 100000))
+        return path
+    except OSError:
+        logger.exception("cgroup could not be set up, falling back to rlimits")
+        return None
+
+
+def run_analysis(runpath, job_hash, memory, cores):
+    """
+    Run analysis.py on runpath with cores shard processes and at most memory bytes
+    (times config.JOB_MEMORY_HEADROOM); returns its exit code
+    """
+    limit = int(memory * config.JOB_MEMORY_HEADROOM)
+    cgroup = _create_cgroup(job_hash, limit, cores)
+    command = ["python3", config.WORKER_SOURCE_PATH + "analysis.py", "-i", runpath, "-p", str(cores)]
+    if not cgroup:
+        if shutil.which("prlimit"):
+            # per process limit, each shard process gets the same
+            command = ["prlimit", "--data=%d" % limit] + command
+        else:
+            logger.warning(f"Neither cgroups nor prlimit available, {job_hash} runs without memory limit")
+
+    try:
+        process = subprocess.Popen(command)
+        if cgroup:
+            try:
+                with open(os.path.join(cgroup, "cgroup.procs"), "w") as f:
+                    f.write(str(process.pid))
+            except OSError:
+                process.kill()
+                process.wait()
+                raise
+        return process.wait()
+    finally:
+        if cgroup:
+            try:
+                os.rmdir(cgroup)
+            except OSError:
+                logger.warning(f"cgroup {cgroup} could not be removed")
@@ -0,0 +1,109 @@
+"""
+Equivalence tests of the in-process replacements against the scripts they replaced.
+
+The replaced Perl and R scripts are kept unchanged in tests/reference/ (blockbuster
+is compiled from src/analysis/blockbuster-source). Each test generates random inputs,
+runs the original script and its replacement on them and compares the outputs.
+Tests of scripts whose interpreter is missing are skipped.
+
+    python3 -m pytest tests
+"""
+
+import os
+import random
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+REFERENCE_DIR = os.path.join(TESTS_DIR, "reference", "")
+SOURCE_DIR = os.path.join(TESTS_DIR, "..", "src", "")
+sys.path.insert(0, SOURCE_DIR)
+
+import columnar
+import tags
+
+# Random inputs per test
+SEEDS = range(8)
+CHROMS = ("chr1", "chr2", "chrX")
+
+
+def run_reference(script, *args, cwd=None, env=None):
+    """Run a script of tests/reference/ (Perl or R), returns its standard output"""
+    interpreter = "Rscript" if script.endswith(".R") else "perl"
+    if shutil.which(interpreter) is None:
+        pytest.skip(interpreter + " is not installed")
+    command = [interpreter, REFERENCE_DIR + script] + [str(arg) for arg in args]
+    if interpreter == "perl":
+        command[1:1] = ["-I", REFERENCE_DIR, "-MPosixCompat"]
+    return subprocess.run(command, cwd=cwd, env=env, check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+
+
+def read_lines(filename):
+    with open(filename) as f:
+        return f.read().splitlines()
+
+
+def random_mapping_loci(rng, reads=300, hotspots=6, fractional=False):
+    """
+    Mapping loci BED lines (chrom, start, end, read id, score, strand) of random reads piling up at a few
+    hotspots, some of them mapping to several loci. Scores are read counts, 0 or (fractional) floats.
+    """
+    spots = [(rng.choice(CHROMS), rng.randrange(1000, 20000), rng.choice("+-")) for _ in range(hotspots)]
+    lines = []
+    for read in range(reads):
+        score = rng.choice((1, 1, 1, 2, 3, 0, 7, 25))
+        if fractional and rng.random() < 0.3:
+            score = rng.choice((0.5, 1.25, 2.75, 3.1))
+        for _ in range(1 if rng.random() < 0.8 else rng.randint(2, 4)):
+            chrom, center, strand = rng.choice(spots)
+            start = center + int(rng.gauss(0, 40))
+            lines.append(
+                "%s\t%d\t%d\tread_%d\t%s\t%s" % (chrom, start, start + rng.randint(17, 29), read, score, strand)
+            )
+    rng.shuffle(lines)
+    return lines
+
+
+def random_annotation(rng, bed_file, count=30):
+    """
+    ncRNA annotation BED lines (chrom, start, end, id, score, strand, type, source) around random loci of
+    bed_file, a few of them on the other strand
+    """
+    loci = [line.split() for line in read_lines(bed_file)]
+    lines = []
+    for i in range(count):
+        chrom, start, end, _, _, strand = rng.choice(loci)[:6]
+        start, end = int(start) - rng.randint(-10, 60), int(end) + rng.randint(-10, 60)
+        if rng.random() < 0.2:
+            strand = "+" if strand == "-" else "-"
+        ncrna_type = rng.choice(("miRNA", "tRNA", "snoRNA_CD", "snoRNA_HACA", "rRNA"))
+        lines.append("%s\t%d\t%d\tncRNA_%d\t0\t%s\t%s\ttest" % (chrom, start, end, i, strand, ncrna_type))
+    return lines
+
+
+def write_lines(filename, lines):
+    with open(filename, "w") as f:
+        f.writelines(line + "\n" for line in lines)
+    return filename
+
+
+@pytest.fixture(params=SEEDS)
+def rng(request):
+    return random.Random(request.param)
+
+
+@pytest.fixture
+def rundir(rng, tmp_path):
+    """
+    Directory with the tags collapsed from random mapping loci as reads table upload.tags (see columnar.py),
+    its BED export upload.bed (the text the scripts read) and upload.info
+    """
+    path = str(tmp_path / "job") + "/"
+    os.mkdir(path)
+    bed = write_lines(path + "mapping_loci.bed", random_mapping_loci(rng))
+    tags.collapse_tags(bed, path + "upload.tags", path + "upload.info", path + "length.out", path + "multi.out")
+    columnar.export(path + "upload.tags", path + "upload.bed")
+    return path
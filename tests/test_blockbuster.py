@@ -0,0 +1,35 @@
+"""clustering.write_clusters() against blockbuster, compiled from src/analysis/blockbuster-source"""
+
+import os
+import shutil
+import subprocess
+
+import pytest
+
+import clustering
+import columnar
+from conftest import SOURCE_DIR, read_lines
+
+BLOCKBUSTER_SOURCE = os.path.join(SOURCE_DIR, "analysis", "blockbuster-source", "blockbuster.c")
+
+
+@pytest.fixture(scope="session")
+def blockbuster(tmp_path_factory):
+    compiler = shutil.which("cc") or shutil.which("gcc")
+    if compiler is None:
+        pytest.skip("no C compiler to build blockbuster")
+    executable = str(tmp_path_factory.mktemp("blockbuster") / "blockbuster.x")
+    subprocess.run([compiler, "-O2", "-w", "-o", executable, BLOCKBUSTER_SOURCE, "-lm"], check=True)
+    return executable
+
+
+def test_write_clusters(blockbuster, rundir):
+    # as runblockbuster.sh ran it; the header comments hold the time of the run
+    output = subprocess.run(
+        [blockbuster, "-scale", "0.4", rundir + "upload.bed"], check=True, stdout=subprocess.PIPE
+    ).stdout.decode("ascii")
+    expected = [line for line in output.splitlines() if not line.startswith("#")]
+
+    assert clustering.write_clusters(rundir + "upload.tags", rundir + "upload.clusters") > 0
+    columnar.export(rundir + "upload.clusters", rundir + "upload.clusters.txt")
+    assert read_lines(rundir + "upload.clusters.txt") == expected
@@ -0,0 +1,51 @@
+"""expression.write_expression_table() against getExpression.pl"""
+
+import os
+
+import expression
+from conftest import random_annotation, read_lines, run_reference, write_lines
+from overlap import read_bed
+
+
+def test_write_expression_table(rng, rundir):
+    annotation = write_lines(rundir + "annotation.bed", random_annotation(rng, rundir + "upload.bed"))
+    rnaz = write_lines(rundir + "RNAz.bed", random_annotation(rng, rundir + "upload.bed", count=5))
+    species_id = rng.choice(("dm3", "athTAIR10"))  # Arabidopsis has links of its own
+
+    # getExpression.pl links the tracks of the job directory named like its output directory
+    parent, job = os.path.split(os.path.dirname(rundir))
+    run_reference(
+        "getExpression.pl",
+        "-b",
+        rundir + "upload.bed",
+        "-o",
+        job + "/",
+        "-a",
+        annotation,
+        "-f",
+        rundir + "expected.expression.bed",
+        "-p",
+        "ncRNAs.pos.wig",
+        "-n",
+        "ncRNAs.neg.wig",
+        "-r",
+        rnaz,
+        "-s",
+        species_id,
+        cwd=parent,
+    )
+    expression.write_expression_table(
+        rundir + "upload.tags",
+        annotation,
+        rundir + "ncRNA.expression.bed",
+        rundir,
+        "ncRNAs.pos.wig",
+        "ncRNAs.neg.wig",
+        species_id,
+        expression.rnaz_markers(read_bed(rnaz)),
+    )
+
+    # getExpression.pl wrote the annotations in Perl hash order
+    lines = read_lines(rundir + "ncRNA.expression.bed")
+    assert lines
+    assert sorted(lines) == sorted(read_lines(rundir + "expected.expression.bed"))
@@ -0,0 +1,100 @@
+"""bam.iter_tag_records() against map2bed.pl, on BAM files and the same alignments as SAM"""
+
+import os
+import struct
+import sys
+
+import bam
+from conftest import CHROMS, SOURCE_DIR, read_lines, run_reference, write_lines
+
+sys.path.append(os.path.join(SOURCE_DIR, "benchmarks"))
+from synthetic_library import BGZFWriter
+
+CIGARS = ("22M", "3S19M", "10M2I10M", "10M1D11M", "8M100N14M", "5M50N5M30N12M")
+
+
+def parse_cigar(cigar):
+    ops, number = [], ""
+    for c in cigar:
+        if c.isdigit():
+            number += c
+        else:
+            ops.append((int(number), c))
+            number = ""
+    return ops
+
+
+def reverse_complement(seq):
+    return seq[::-1].translate(str.maketrans("ACGT", "TGCA"))
+
+
+def random_alignments(rng, reads=200, sequences=40):
+    """SAM fields (name, flag, chrom, 1-based pos, cigar, sequence, XA tag) of random reads of a few sequences"""
+    tags = []
+    for _ in range(sequences):
+        seq = "".join(rng.choice("ACGT") for _ in range(22))
+        loci = [(rng.choice(CHROMS), rng.randrange(1, 10000), rng.choice("+-"), rng.choice(CIGARS)) for _ in range(3)]
+        tags.append((seq, loci))
+    alignments = []
+    for read in range(reads):
+        seq, loci = rng.choice(tags)
+        chrom, pos, strand, cigar = rng.choice(loci)
+        hits = None
+        if rng.random() < 0.3:
+            hits = "".join("%s,%s%d,%s,0;" % (c, s, p, cg) for c, p, s, cg in rng.sample(loci, 2))
+        elif rng.random() < 0.05:
+            hits = "Q0"  # no alternative hits, ignored by map2bed.pl
+        flag = 16 if strand == "-" else 0
+        stored = reverse_complement(seq) if strand == "-" else seq
+        alignments.append(("read_%d" % read, flag, chrom, pos, cigar, stored, hits))
+        if rng.random() < 0.05:
+            alignments.append(("unmapped_%d" % read, 4, "*", 0, "*", seq, None))
+    return alignments
+
+
+def write_sam(alignments, filename):
+    lines = ["@HD\tVN:1.0\tSO:unsorted"]
+    for name, flag, chrom, pos, cigar, seq, hits in alignments:
+        fields = [name, str(flag), chrom, str(pos), "255", cigar, "*", "0", "0", seq, "I" * len(seq)]
+        lines.append("\t".join(fields + (["XA:Z:" + hits] if hits else [])))
+    write_lines(filename, lines)
+
+
+def _encode_seq(seq):
+    codes = [bam.SEQ_CODES.index(c) for c in seq] + [0]
+    return bytes(codes[i] << 4 | codes[i + 1] for i in range(0, len(seq), 2))
+
+
+def write_bam(alignments, filename):
+    with open(filename, "wb") as f:
+        bgzf = BGZFWriter(f)
+        text = "".join("@SQ\tSN:%s\tLN:100000\n" % chrom for chrom in CHROMS).encode("ascii")
+        bgzf.write(bam.BAM_MAGIC + struct.pack("<i", len(text)) + text + struct.pack("<i", len(CHROMS)))
+        for chrom in CHROMS:
+            bgzf.write(struct.pack("<i", len(chrom) + 1) + chrom.encode("ascii") + b"\0" + struct.pack("<i", 100000))
+        for name, flag, chrom, pos, cigar, seq, hits in alignments:
+            ops = parse_cigar(cigar) if cigar != "*" else []
+            name = name.encode("ascii") + b"\0"
+            ref_id = CHROMS.index(chrom) if chrom != "*" else -1
+            header = struct.pack(
+                "<iiBBHHHiiii", ref_id, pos - 1, len(name), 255, 0, len(ops), flag, len(seq), -1, -1, 0
+            )
+            data = header + name + b"".join(struct.pack("<I", n << 4 | bam.CIGAR_OPS.index(op)) for n, op in ops)
+            data += _encode_seq(seq) + b"\xff" * len(seq)
+            if hits:
+                data += b"XAZ" + hits.encode("ascii") + b"\0"
+            bgzf.write(struct.pack("<i", len(data)) + data)
+        bgzf.close()
+
+
+def test_iter_tag_records(rng, tmp_path):
+    alignments = random_alignments(rng)
+    write_sam(alignments, str(tmp_path / "reads.sam"))
+    write_bam(alignments, str(tmp_path / "reads.bam"))
+
+    # map2bed.pl read BAM through samtools view, i.e. as this SAM text
+    run_reference("map2bed.pl", "-i", tmp_path / "reads.sam", "-f", "1", "-o", tmp_path / "expected.bed", "-z")
+    expected = sorted(tuple(line.split("\t")[:6]) for line in read_lines(tmp_path / "expected.bed"))
+
+    records = bam.iter_tag_records(str(tmp_path / "reads.bam"), tmpdir=str(tmp_path), chunk_size=50)
+    assert sorted(tuple(str(col) for col in record) for record in records) == expected
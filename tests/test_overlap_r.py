@@ -0,0 +1,64 @@
+"""overlap.py against overlap.R and overlapPredictions.R (genomeIntervals)"""
+
+import shutil
+import subprocess
+
+import pytest
+
+import columnar
+import overlap
+from conftest import random_annotation, read_lines, run_reference, write_lines
+from expression import ANNOTATION_COLUMNS
+
+
+@pytest.fixture(scope="session")
+def genome_intervals():
+    if shutil.which("Rscript") is None:
+        pytest.skip("Rscript is not installed")
+    if subprocess.run(["Rscript", "-e", "library(genomeIntervals)"], stderr=subprocess.DEVNULL).returncode:
+        pytest.skip("the R package genomeIntervals is not installed")
+
+
+def test_quantify_ncrna_overlap(genome_intervals, rng, rundir):
+    ncrnas = write_lines(rundir + "ncRNAs.bed", random_annotation(rng, rundir + "upload.bed"))
+    exons = write_lines(rundir + "exons.bed", random_annotation(rng, rundir + "upload.bed", count=10))
+    introns = write_lines(rundir + "introns.bed", random_annotation(rng, rundir + "upload.bed", count=10))
+
+    run_reference(
+        "overlap.R",
+        ncrnas,
+        exons,
+        introns,
+        rundir + "upload.bed",
+        rundir + "expected.ncRNAs.reads",
+        rundir + "expected.unknown.reads",
+        rundir + "expected.reads.info",
+        rundir,
+    )
+    annotation = overlap.read_bed(ncrnas, ANNOTATION_COLUMNS)
+    info = overlap.quantify_ncrna_overlap(
+        overlap.build_type_indexes(annotation, overlap.read_bed(exons), overlap.read_bed(introns)),
+        list(dict.fromkeys(annotation["type"])),
+        rundir + "upload.tags",
+        rundir + "ncRNAs.reads",
+        rundir + "unknown.reads",
+    )
+    overlap.write_reads_info(info, rundir + "reads.info")
+    columnar.export(rundir + "ncRNAs.reads", rundir + "ncRNAs.reads.bed")
+    columnar.export(rundir + "unknown.reads", rundir + "unknown.reads.bed")
+
+    assert read_lines(rundir + "reads.info") == read_lines(rundir + "expected.reads.info")
+    assert read_lines(rundir + "ncRNAs.reads.bed") == read_lines(rundir + "expected.ncRNAs.reads")
+    # overlap.R wrote the intronic reads before the intergenic ones, those quoted
+    expected = [line.replace('"', "") for line in read_lines(rundir + "expected.unknown.reads")]
+    assert sorted(read_lines(rundir + "unknown.reads.bed")) == sorted(expected)
+
+
+def test_write_overlapping_reads(genome_intervals, rng, rundir):
+    annotation = write_lines(rundir + "predictions.bed", random_annotation(rng, rundir + "upload.bed"))
+
+    run_reference("overlapPredictions.R", annotation, rundir + "upload.bed", rundir + "expected.reads", rundir)
+    overlap.write_overlapping_reads(annotation, rundir + "upload.tags", rundir + "predictions.reads")
+    columnar.export(rundir + "predictions.reads", rundir + "predictions.reads.bed")
+
+    assert read_lines(rundir + "predictions.reads.bed") == read_lines(rundir + "expected.reads")
@@ -0,0 +1,45 @@
+"""tags.collapse_tags() against readsToTags.pl"""
+
+import columnar
+import tags
+from conftest import random_mapping_loci, read_lines, run_reference, write_lines
+
+
+def without_names(lines):
+    """BED lines without the tag names, which follow the Perl hash order in readsToTags.pl"""
+    return sorted("\t".join(line.split("\t")[:3] + line.split("\t")[4:]) for line in lines)
+
+
+def test_collapse_tags(rng, tmp_path):
+    lines = random_mapping_loci(rng, fractional=True)
+    # scores that are no number count as one read, like a score of 0
+    lines = [line.replace("\t7\t", "\t.\t") for line in lines]
+    bed = write_lines(str(tmp_path / "reads.bed"), lines)
+
+    expected = tmp_path / "expected"
+    expected.mkdir()
+    run_reference(
+        "readsToTags.pl",
+        "-i",
+        bed,
+        "-s",
+        expected / "upload.info",
+        "-l",
+        expected / "length.out",
+        "-m",
+        expected / "multipleMappings.out",
+        "-o",
+        expected / "tags.bed",
+    )
+    tags.collapse_tags(
+        bed,
+        str(tmp_path / "upload.tags"),
+        str(tmp_path / "upload.info"),
+        str(tmp_path / "length.out"),
+        str(tmp_path / "multipleMappings.out"),
+    )
+    columnar.export(str(tmp_path / "upload.tags"), str(tmp_path / "tags.bed"))
+
+    for name in ("upload.info", "length.out", "multipleMappings.out"):
+        assert read_lines(tmp_path / name) == read_lines(expected / name), name
+    assert without_names(read_lines(tmp_path / "tags.bed")) == without_names(read_lines(expected / "tags.bed"))
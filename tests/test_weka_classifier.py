@@ -0,0 +1,139 @@
+"""
+classifier.py against trainClassifier.pl and runClassifier.pl. WEKA is replaced by a fake java on the PATH
+that keeps the ARFF files the scripts write and predicts with a model of classifier.py.
+"""
+
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+import classifier
+import clustering
+import columnar
+import tags
+from conftest import SOURCE_DIR, random_annotation, random_mapping_loci, read_lines, run_reference, write_lines
+from overlap import format_perl_number
+
+FAKE_JAVA = """#!%s
+import shutil
+import sys
+
+sys.path.insert(0, %r)
+import numpy as np
+
+import classifier
+
+args = sys.argv[1:]
+if "-T" in args:
+    # weka.classifiers.trees.RandomForest -l model -T test.arff -p 0 -distribution
+    shutil.copy(args[args.index("-T") + 1], "test.arff.kept")
+    with open(args[args.index("-T") + 1]) as f:
+        rows = [line.strip().split(",")[:-1] for line in f.read().split("@DATA")[1].splitlines() if line.strip()]
+    X = np.array(rows, dtype=np.float64).reshape(len(rows), len(classifier.FEATURES))
+    model = classifier.load_model(args[args.index("-l") + 1])
+    print(" inst#     actual  predicted error distribution")
+    for inst, p in enumerate(classifier.predict(model, X), 1):
+        best = p.argmax()
+        distribution = [("%%.3f" %% x).rstrip("0").rstrip(".") for x in p]
+        distribution[best] = "*" + distribution[best]
+        predicted = "%%d:%%s" %% (best + 1, classifier.CLASSES[best])
+        print("%%6d %%10s %%10s       %%s" %% (inst, "1:?", predicted, ",".join(distribution)))
+"""
+
+
+@pytest.fixture
+def weka(tmp_path):
+    """Environment with the fake java first on the PATH"""
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    java = bin_dir / "java"
+    java.write_text(FAKE_JAVA % (sys.executable, SOURCE_DIR))
+    java.chmod(0o755)
+    return dict(os.environ, PATH=str(bin_dir) + os.pathsep + os.environ["PATH"])
+
+
+@pytest.fixture
+def clusters(rng, tmp_path):
+    """Clusters (.clusters text) of random reads, as blockbuster wrote them, next to their reads upload.bed"""
+    bed = write_lines(str(tmp_path / "mapping_loci.bed"), random_mapping_loci(rng, reads=1500, hotspots=40))
+    path = str(tmp_path / "upload")
+    tags.collapse_tags(bed, path + ".tags", path + ".info", path + ".length", path + ".multi")
+    clustering.write_clusters(path + ".tags", path + ".clusters")
+    columnar.export(path + ".tags", path + ".bed")
+    columnar.export(path + ".clusters", path + ".clusters.txt")
+    return path + ".clusters.txt"
+
+
+def arff_rows(filename):
+    """Data rows of an ARFF file, which the scripts wrote in Perl hash order"""
+    return sorted(read_lines(filename)[read_lines(filename).index("@DATA") + 1 :])
+
+
+def feature_rows(X, labels):
+    return sorted(",".join([format_perl_number(x) for x in row] + [label]) for row, label in zip(X, labels))
+
+
+def test_training_set(weka, rng, clusters, tmp_path):
+    annotation = write_lines(
+        str(tmp_path / "annotation.bed"), random_annotation(rng, str(tmp_path / "upload.bed"), count=60)
+    )
+    flagged = subprocess.run(
+        ["perl", os.path.join(SOURCE_DIR, "analysis", "flagKnownClusters.pl"), "-c", clusters, "-a", annotation],
+        check=True,
+        stdout=subprocess.PIPE,
+    ).stdout
+    (tmp_path / "flagged.clusters").write_bytes(flagged)
+
+    out = tmp_path / "out"
+    out.mkdir()
+    run_reference(
+        "trainClassifier.pl",
+        "-trainSet",
+        tmp_path / "flagged.clusters",
+        "-model",
+        tmp_path / "model",
+        "-statistic",
+        tmp_path / "statistics",
+        "-o",
+        out,
+        env=weka,
+    )
+    X, y = classifier.read_training_set(str(tmp_path / "flagged.clusters"))
+    assert len(y)
+    assert arff_rows(out / "train.arff") == feature_rows(X, [classifier.CLASSES[i] for i in y])
+
+
+def test_predict_file(weka, rng, clusters, tmp_path):
+    X = classifier.features(classifier.read_clusters(clusters))
+    assert len(X)
+    # any model will do, as long as both sides predict with it
+    y = np.array(rng.choices(range(len(classifier.CLASSES)), k=len(X)))
+    classifier.save_model(classifier.train(X, y, trees=10), str(tmp_path / "model.npz"))
+
+    run_reference(
+        "runClassifier.pl",
+        "-testSet",
+        clusters,
+        "-model",
+        tmp_path / "model.npz",
+        "-predictions",
+        tmp_path / "expected.bed",
+        "-o",
+        tmp_path,
+        cwd=tmp_path,
+        env=weka,
+    )
+    assert arff_rows(tmp_path / "test.arff.kept") == feature_rows(X, "?" * len(X))
+
+    classifier.predict_file(clusters, str(tmp_path / "model.npz"), str(tmp_path / "predictions.bed"))
+    lines = read_lines(tmp_path / "predictions.bed")
+    assert len(lines) == len(X)
+    assert without_numbers(lines) == without_numbers(read_lines(tmp_path / "expected.bed"))
+
+
+def without_numbers(lines):
+    """Predictions without the numbers of their names, which follow the Perl hash order in runClassifier.pl"""
+    return sorted(line.replace("_%s\t" % line.split("\t")[3].rsplit("_", 1)[1], "\t", 1) for line in lines)
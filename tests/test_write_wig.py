@@ -0,0 +1,14 @@
+"""coverage.write_coverage_tracks() against writeWig.pl"""
+
+import coverage
+from conftest import read_lines, run_reference
+
+
+def test_write_coverage_tracks(rundir, tmp_path):
+    expected = tmp_path / "expected"
+    expected.mkdir()
+    run_reference("writeWig.pl", "-i", rundir + "upload.bed", "-o", expected, "-p", "pos.wig", "-n", "neg.wig")
+    coverage.write_coverage_tracks(rundir + "upload.tags", rundir + "pos.wig", rundir + "neg.wig")
+
+    for name in ("pos.wig", "neg.wig"):
+        assert read_lines(rundir + name) == read_lines(expected / name), name